@@ -1,19 +1,17 @@
-import json
-import os
+import copy
 import random
 from typing import Dict, List, Tuple, Union
+import rule_graph
 
 class HierarchicalStateMachine:
-    def __init__(self, current_group, current_state, config_folder: str):
+    def __init__(self, current_group, current_state, config_folder: str, rng=None):
 
         self.current_group = current_group
         self.current_state = current_state
         self.current_subgroup = None
-        self.group_rules: Dict[str, Dict] = {}
-        self.cross_rules: Dict[Tuple[str, str], Tuple] = {}
-        self.subgroup_handlers: Dict[str, callable] = {} 
+        self.graph = rule_graph.load_rule_graph(config_folder)   # compiled once per process, shared by all machines
         self.current_time = "time0"  
-        self._load_rules(config_folder)
+        self.rng = rng if rng is not None else random
         self._reset_state()
 
     def _reset_state(self):
@@ -25,78 +23,11 @@ class HierarchicalStateMachine:
             "timestamp": 0
         }]
 
-    def _load_rules(self, folder: str):
-        ingroup_rule_path = os.path.join(folder, "ingroup_rules.json")
-        if os.path.exists(ingroup_rule_path):
-            with open(ingroup_rule_path, 'r', encoding='utf-8') as f:
-                self.group_rules = json.load(f)
-        else:
-            raise FileNotFoundError(f"组规则文件 {ingroup_rule_path} 不存在")
-      
-    
-        cross_rule_path = os.path.join(folder, "crossgroup_rules.json")
-        if os.path.exists(cross_rule_path):
-            with open(cross_rule_path, 'r') as f:
-                cross_rules_raw = json.load(f)
-                self.cross_rules = {
-                    tuple(k.split(':')): tuple(v) 
-                    for k, v in cross_rules_raw.items()
-                }
-        else:
-            raise FileNotFoundError(f"跨组规则文件 {cross_rule_path} 不存在")
-        
-        self._register_subgroup_handlers()
-
-    def _register_subgroup_handlers(self):
-        self.subgroup_handlers = {
-            "A00": self._handle_A00,
-            "A01": self._handle_A01,
-            "A02": self._handle_A02,
-            "A03": self._handle_A03,
-            "A04": self._handle_A04,
-            "F00": self._handle_F00,
-            "F01": self._handle_F01,
-            "K00": self._handle_K00,
-            "K01": self._handle_K01
-        }
-
- 
- 
-    def _handle_A00(self) -> Tuple[List[str], int]:
-        required = ["A3", "A6", "A9", "A12", "A13", "A16", "A17"]
-        return (required, 5)
-
-    def _handle_A01(self) -> Tuple[List[str], int]:
-        required = ["A98", "A111", "A114", "A117", "A118", "A121", "A122"]
-        return (required, 5)
-
-    def _handle_A02(self) -> Tuple[List[str], int]:
-        required = ["A138", "A139", "A140", "A141", "A142", "A143", "A144", "A145", "A146", "A147"]
-        return (required, 3)
-
-    def _handle_A03(self) -> Tuple[List[str], int]:
-        required = ["A255", "A256", "A257", "A258", "A259", "A260", "A261", "A262", "A263", "A264"]
-        return (required, 3)
-
-    def _handle_A04(self) -> Tuple[List[str], int]:
-        required = ["A286", "A287", "A289", "A290", "A291", "A292", "A293", "A294", "A295", "A288"]
-        return (required, 3)
-
-    def _handle_F00(self) -> Tuple[List[str], int]:
-        required = ["F144", "F145", "F146", "F147", "F148", "F149"]
-        return (required, 3)
-
-    def _handle_F01(self) -> Tuple[List[str], int]:
-        required = ["F169", "F170", "F171", "F172", "F173", "F174"]
-        return (required, 3)
-
-    def _handle_K00(self) -> Tuple[List[str], int]:
-        return (["K6", "K7", "K8", "K9", "K10", "K11", "K12", "K13","K14"], 5)
-
-    def _handle_K01(self) -> Tuple[List[str], int]:
-        return (["K16", "K17", "K18", "K19", "K20", "K21", "K22", "K23","K24"], 5)
-
+    def _current_node(self) -> int:
+        return self.graph.node(self.current_group, self.current_state)
 
+    def _subgroup_rule(self, subgroup: str) -> rule_graph.Subgroup:
+        return self.graph.subgroups[self.graph.subgroup_index[subgroup]]
 
     def get_next_state(self, response: Union[bool, str]) -> Dict:
         is_yes = bool(response)
@@ -107,16 +38,45 @@ class HierarchicalStateMachine:
             return cross_info
         return self._process_normal_state(is_yes)
 
+    def snapshot(self) -> Dict:
+        """Copy of the position in the rules: current group / subgroup / state / time, substate_queue, state_values and state_history"""
+        return copy.deepcopy({
+            "current_group": self.current_group,
+            "current_subgroup": self.current_subgroup,
+            "current_state": self.current_state,
+            "current_time": self.current_time,
+            "substate_queue": self.substate_queue,
+            "state_values": self.state_values,
+            "state_history": self.state_history,
+        })
+
+    def restore(self, snapshot: Dict) -> None:
+        for key, value in copy.deepcopy(snapshot).items():
+            setattr(self, key, value)
+
+    def fork(self, rng=None) -> "HierarchicalStateMachine":
+        """Independent machine continuing from this one's state; rng defaults to a copy of this machine's random source (the module itself is shared)"""
+        clone = copy.copy(self)
+        clone.restore(self.snapshot())
+        if rng is None:
+            rng = self.rng if self.rng is random else copy.deepcopy(self.rng)
+        clone.rng = rng
+        return clone
+
+    def peek_next_state(self, response: Union[bool, str]) -> Dict:
+        """State info get_next_state(response) would return, leaving this machine and its random source untouched"""
+        clone = self.fork()
+        if self.rng is random:   # the shared module-level generator cannot be copied; rewind it instead
+            rng_state = random.getstate()
+            try:
+                return clone.get_next_state(response)
+            finally:
+                random.setstate(rng_state)
+        return clone.get_next_state(response)
+
     def _process_substate(self, is_yes: bool) -> Dict:
         """Handling sub-state group logic"""
         self._record_response(self.current_state, is_yes)
-        current_state = self.current_state
-        if current_state in self.group_rules[self.current_group][self.current_subgroup]:
-            state_rule = self.group_rules[self.current_group][self.current_subgroup][current_state]
-            next_key = "Y" if is_yes else "N"
-            if state_rule[next_key] is not None:
-                self.substate_queue.insert(1, (state_rule[next_key], 'time0')) 
-        
         self.substate_queue.pop(0)        
         if not self.substate_queue:
             self._finalize_subgroup()
@@ -128,46 +88,35 @@ class HierarchicalStateMachine:
 
     def _process_normal_state(self, is_yes: bool) -> Dict:
         """Handling common state transitions"""
-        state_rule = self.group_rules[self.current_group][self.current_state]
-        subgroup_list = ["A00", "A01", "A02", "A03", "A04", "F00", "F01", "K00", "K01"]
-        next_key = "Y" if is_yes else "N"
-        if next_key in state_rule:
-            next_state, next_time = state_rule[next_key] 
-            if next_state in subgroup_list:
-                self.current_subgroup = next_state
-                self._init_substate_group(self.current_subgroup)                   
-                return self._build_state_info()
-            else:
-                self.current_state = next_state                
-                self.current_time = next_time                  
-                self._record_history()
-                return self._build_state_info()
-            
-        raise ValueError(f"Invalid state transition: {self.current_group}.{self.current_state} -> {next_key}")
+        edge = self.graph.edges[self._current_node()][is_yes]
+        if edge is None:
+            raise ValueError(f"Invalid state transition: {self.current_group}.{self.current_state} -> {'Y' if is_yes else 'N'}")
+        next_group, next_state = self.graph.name(edge.target)
+        subgroup = self.graph.subgroup[edge.target]
+        if subgroup is not None:
+            self.current_group = next_group
+            self.current_subgroup = next_state
+            self._init_substate_group(self.current_subgroup)                   
+            return self._build_state_info()
+        else:
+            self.current_group = next_group
+            self.current_state = next_state                
+            self.current_time = edge.time                  
+            self._record_history()
+            return self._build_state_info()
 
     def _init_substate_group(self, group: str):
         """Initialize sub-state group"""
-        time_options = {
-            "A00": ["time1", ["time3", "time0","time0","time0","time3", "time0","time2"]],
-            "A01": ["time1", ["time3", "time0","time0","time0","time3", "time0","time2"]],
-            "A02": ["time4", ["time3","time5", "time0","time0","time3","time0", "time0"]],
-            "A03": ["time4", ["time3","time5", "time0","time0","time3","time0", "time0"]],
-            "A04": ["time12", ["time13","time0","time0","time3","time0", "time0","time3"]],
-            "F00": ["time6", ["time0", "time7", "time8","time0","time0","time8","time0"]],
-            "F01": ["time10", ["time0", "time9", "time3","time0","time0", "time3","time0"]],
-            "K00": ["time11", ["time0", "time9", "time3","time0","time0", "time3","time0"]],
-            "K01": ["time11", ["time0", "time9", "time3","time0","time0", "time3","time0"]]
-        }
         print(f"subgroup{group}")
-        first_time, other_times = time_options[group]
-        handler = self.subgroup_handlers[self.current_subgroup]
-        required_states, threshold = handler()
-        random.shuffle(required_states)
+        subgroup = self._subgroup_rule(group)
+        first_time, other_times = subgroup.first_time, subgroup.other_times
+        required_states = list(subgroup.states)
+        self.rng.shuffle(required_states)
         for i in range(len(required_states)):
             if i == 0:
                 self.substate_queue.append((required_states[i], first_time))
             else:
-                self.substate_queue.append((required_states[i], random.choice(other_times)))
+                self.substate_queue.append((required_states[i], self.rng.choice(other_times)))
         print(f"required_states {required_states} ")
         print(f"Sub-state queue {self.substate_queue} ")
         self.current_state = required_states[0] 
@@ -191,26 +140,15 @@ class HierarchicalStateMachine:
 
     def _get_threshold(self) -> int:
         """Get the current sub-state group threshold"""
-        handler = self.subgroup_handlers[self.current_subgroup]
-        return handler()[1]
+        return self._subgroup_rule(self.current_subgroup).threshold
 
     
     def _check_cross_rule(self) -> Union[Dict, None]:
-        """Perform cross-group jumps and verify target validity"""
-  
-        cross_key = (self.current_group, self.current_state)  
-        if cross_key in self.cross_rules:
-           
-            target_group, target_state, target_time = self.cross_rules[cross_key]
-            if target_group not in self.group_rules:
-                raise ValueError(f"目标组 {target_group} 未在规则中定义")
-
-            if target_state not in self.group_rules[target_group]:
-                raise ValueError(f"目标状态 {target_state} 未在组 {target_group} 中定义")
-  
-            self.current_group = target_group
-            self.current_state = target_state
-            self.current_time = target_time
+        """Perform cross-group jumps; targets were validated when the rules were compiled"""
+        edge = self.graph.cross[self._current_node()]
+        if edge is not None:
+            self.current_group, self.current_state = self.graph.name(edge.target)
+            self.current_time = edge.time
             return self._build_state_info()
         return None
 
@@ -0,0 +1,143 @@
+import asyncio
+import queue
+import threading
+import time
+from concurrent.futures import Future, InvalidStateError
+from typing import Dict, List
+
+MAX_BATCH_SIZE = 8   # sequences per batched generate() call
+MAX_WAIT = 0.05   # seconds the first request of a batch waits for more to join (less once the previous batch's size is reached)
+
+
+class _Request:
+    __slots__ = ("messages", "max_new_tokens", "future")
+
+    def __init__(self, messages, max_new_tokens) -> None:
+        self.messages = messages
+        self.max_new_tokens = max_new_tokens
+        self.future = Future()
+
+
+class BatchEngine:
+    """Runs the local generations of every dialogue in flight as left-padded batches through one shared model.
+
+    Dialogues submit chat messages from any thread or asyncio task and wait on a future. A single worker
+    thread steps in lockstep: it takes every request pending when the previous batch finished (up to
+    max_batch_size, waiting at most max_wait for the first ones to accumulate, and no longer once as many
+    requests as in the previous batch have come back), runs them as one generate()
+    call and hands each decoded reply back to its dialogue. Requests arriving during a batch form the next
+    one, so throughput grows with the number of dialogues waiting instead of staying at one sequence.
+    """
+
+    def __init__(self, model, tokenizer, max_batch_size: int = MAX_BATCH_SIZE, max_wait: float = MAX_WAIT) -> None:
+        self.model = model
+        self.tokenizer = tokenizer
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.pad_token_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else tokenizer.eos_token_id
+        self._queue = queue.Queue()
+        self._last_batch_size = 1
+        self._stats = {"batches": 0, "sequences": 0, "prompt_tokens": 0, "generated_tokens": 0, "busy_seconds": 0.0}
+        self._stats_lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, name="batch-engine", daemon=True)
+        self._thread.start()
+
+    def submit(self, messages: List[Dict], max_new_tokens: int) -> Future:
+        request = _Request(messages, max_new_tokens)
+        self._queue.put(request)
+        return request.future
+
+    def generate(self, messages: List[Dict], max_new_tokens: int) -> str:
+        return self.submit(messages, max_new_tokens).result()
+
+    async def agenerate(self, messages: List[Dict], max_new_tokens: int) -> str:
+        return await asyncio.wrap_future(self.submit(messages, max_new_tokens))
+
+    def close(self) -> None:
+        self._queue.put(None)
+        self._thread.join()
+
+    def _next_batch(self):
+        first = self._queue.get()
+        if first is None:
+            return None
+        batch = [first]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            if len(batch) >= self._last_batch_size and self._queue.empty():   # lockstep: everyone from the last step is back
+                break
+            try:
+                request = self._queue.get(timeout=max(deadline - time.monotonic(), 0))
+            except queue.Empty:
+                break
+            if request is None:
+                self._queue.put(None)   # finish this batch, stop at the next one
+                break
+            batch.append(request)
+        self._last_batch_size = len(batch)
+        return batch
+
+    def _run(self) -> None:
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            batch = [request for request in batch if request.future.set_running_or_notify_cancel()]   # drop dialogues cancelled while queued
+            if not batch:
+                continue
+            try:
+                replies = self._generate_batch(batch)
+            except Exception as e:   # fail this batch's dialogues, keep serving the others
+                for request in batch:
+                    self._settle(request.future, error=e)
+                continue
+            for request, reply in zip(batch, replies):
+                self._settle(request.future, reply)
+
+    @staticmethod
+    def _settle(future: Future, reply=None, error=None) -> None:
+        try:
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(reply)
+        except InvalidStateError:   # already settled; never let one dialogue stop the worker thread
+            pass
+
+    def _generate_batch(self, batch: List[_Request]) -> List[str]:
+        import torch
+        start = time.perf_counter()
+        prompts = [self.tokenizer(self.tokenizer.apply_chat_template(request.messages, tokenize=False, add_generation_prompt=True)).input_ids
+                   for request in batch]
+        width = max(len(ids) for ids in prompts)
+        input_ids = torch.full((len(batch), width), self.pad_token_id, dtype=torch.long)
+        attention_mask = torch.zeros((len(batch), width), dtype=torch.long)
+        for row, ids in enumerate(prompts):   # left padding: every prompt ends where generation starts
+            input_ids[row, width - len(ids):] = torch.tensor(ids, dtype=torch.long)
+            attention_mask[row, width - len(ids):] = 1
+        with torch.inference_mode():
+            output_ids = self.model.generate(
+                input_ids.to(self.model.device),
+                attention_mask=attention_mask.to(self.model.device),
+                max_new_tokens=max(request.max_new_tokens for request in batch),
+                pad_token_id=self.pad_token_id
+            )
+        replies, generated = [], 0
+        for request, ids in zip(batch, output_ids[:, width:]):
+            ids = ids[:request.max_new_tokens]
+            generated += int((ids != self.pad_token_id).sum())
+            replies.append(self.tokenizer.decode(ids, skip_special_tokens=True))
+        with self._stats_lock:
+            self._stats["batches"] += 1
+            self._stats["sequences"] += len(batch)
+            self._stats["prompt_tokens"] += sum(len(ids) for ids in prompts)
+            self._stats["generated_tokens"] += generated
+            self._stats["busy_seconds"] += time.perf_counter() - start
+        return replies
+
+    def stats(self) -> Dict:
+        with self._stats_lock:
+            stats = dict(self._stats)
+        stats["mean_batch_size"] = stats["sequences"] / stats["batches"] if stats["batches"] else 0.0
+        stats["tokens_per_second"] = stats["generated_tokens"] / stats["busy_seconds"] if stats["busy_seconds"] else 0.0
+        return stats
@@ -0,0 +1,234 @@
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import random
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+
+PROFILE_PATH = './PsyCoData/PsyCoProfile.json'
+SAMPLE_SIZE = 6   # first N profiles; keep it fixed when comparing commits
+STAGES = ["doctor", "patient", "if_parse", "classification", "judgement", "topic_choice"]
+COMPARED_METRICS = ["dialogues_per_minute", "llm_calls_per_dialogue", "prompt_tokens_per_dialogue", "peak_rss_mb"]
+
+
+def percentiles(values):
+    if not values:
+        return {"count": 0}
+    values = sorted(values)
+
+    def pick(q):
+        position = (len(values) - 1) * q
+        low = int(position)
+        high = min(low + 1, len(values) - 1)
+        return values[low] + (values[high] - values[low]) * (position - low)
+
+    return {"count": len(values), "mean": sum(values) / len(values), "p50": pick(0.5), "p95": pick(0.95), "p99": pick(0.99)}
+
+
+def sample_patients(profile_path, size, story_dir, story_text):
+    """Patient templates (same fields as patient_template_gen) and a fixed background story for the first `size` profiles"""
+    with open(profile_path, 'r', encoding='utf-8') as f:
+        profiles = json.load(f)[:size]
+    patient_info = []
+    for case in profiles:
+        patient_info.append({
+            '患者': f"{case['id']}com1_1", '年龄': case['年龄'], '性别': case['性别'], '职业': case['职业'],
+            '婚姻状况': case['婚姻状况'], '教育背景': case['教育背景'], '诊断结果': case['初步诊断'],
+            '主诉': case['主诉'], '病情状况': case['病情状况'], '既往史': case['既往史'], '家族史': case['家族史'],
+            '个人史': case['个人史']['1'],
+        })
+        story_path = os.path.join(story_dir, f"patient_{case['id']}", "story_com1_1.txt")
+        os.makedirs(os.path.dirname(story_path), exist_ok=True)
+        with open(story_path, 'w', encoding='utf-8') as f:
+            f.write(story_text)
+    return patient_info
+
+
+@contextlib.contextmanager
+def mock_backend(latency, seed):
+    """mock_server in a subprocess, so its threads do not count towards our CPU time and RSS"""
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    process = subprocess.Popen([sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "mock_server.py"),
+                                "--port", str(port), "--latency", str(latency), "--seed", str(seed)],
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    base_url = f"http://127.0.0.1:{port}/v1"
+    try:
+        for _ in range(100):
+            try:
+                urllib.request.urlopen(base_url + "/models", timeout=1).close()
+                break
+            except OSError:
+                time.sleep(0.05)
+        else:
+            raise RuntimeError("mock server did not start")
+        yield base_url
+    finally:
+        process.terminate()
+        process.wait()
+
+
+class Probe:
+    """Collects per-call latencies and token counts from llm_tools_api and timings of the dialogue loop"""
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.latencies = {}
+        self.calls = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.dialogue_seconds = []
+        self.machine_init_seconds = 0.0
+        self.transition_seconds = []
+
+    def on_call(self, role, request, response, seconds, source):
+        with self.lock:
+            self.latencies.setdefault(role, []).append(seconds)
+            self.calls += 1
+            if response.usage is not None:
+                self.prompt_tokens += response.usage.prompt_tokens
+                self.completion_tokens += response.usage.completion_tokens
+
+    def instrument(self, main):
+        probe = self
+        machine_cls = main.HierarchicalStateMachine
+
+        class TimedMachine(machine_cls):
+            def __init__(self, *args, **kwargs):
+                start = time.perf_counter()
+                super().__init__(*args, **kwargs)
+                probe.machine_init_seconds += time.perf_counter() - start
+
+            def get_next_state(self, response):
+                start = time.perf_counter()
+                try:
+                    return super().get_next_state(response)
+                finally:
+                    probe.transition_seconds.append(time.perf_counter() - start)
+
+        run_conversation = main.run_conversation
+
+        async def timed_run_conversation(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await run_conversation(*args, **kwargs)
+            finally:
+                probe.dialogue_seconds.append(time.perf_counter() - start)
+
+        main.HierarchicalStateMachine = TimedMachine
+        main.run_conversation = timed_run_conversation
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def run(args):
+    with tempfile.TemporaryDirectory(prefix="diag_bench_") as work_dir, mock_backend(args.latency, args.seed) as base_url:
+        for provider in ("OPENAI", "QWEN", "DEEPSEEK"):
+            os.environ[f"{provider}_API_KEY"] = "mock"
+            os.environ[f"{provider}_API_BASE"] = base_url
+        import mock_server
+        import llm_tools_api
+        import main
+        main.OUTPUT_PASTEXP_PATH = os.path.join(work_dir, "stories")
+        main.OUTPUT_DATA_PATH = os.path.join(work_dir, "dialogues")
+        main.SPECULATIVE = args.speculative
+        fast_path = llm_tools_api.enable_fast_classifier() if args.fast_classifier else None
+        if args.constrained_yes_no:
+            llm_tools_api.enable_constrained_yes_no()
+        patient_info = sample_patients(args.profile_path, args.patients, main.OUTPUT_PASTEXP_PATH, mock_server.STORY)
+        order_list = [random.Random(args.seed).sample(main.original_order, len(main.original_order))]
+
+        probe = Probe()
+        probe.instrument(main)
+        llm_tools_api.CALL_OBSERVERS.append(probe.on_call)
+        cpu_start = time.process_time()
+        start = time.perf_counter()
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull), contextlib.redirect_stderr(devnull):
+            asyncio.run(main.generate_all(patient_info, order_list, args.use_async, args.concurrency, args.seed))
+        wall = time.perf_counter() - start
+        cpu = time.process_time() - cpu_start
+        llm_tools_api.CALL_OBSERVERS.remove(probe.on_call)
+
+    dialogues = len(probe.dialogue_seconds)
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    peak_rss_mb = peak_rss / (1024 * 1024) if sys.platform == "darwin" else peak_rss / 1024
+    to_ms = lambda stats: {k: (v * 1000 if k != "count" else v) for k, v in stats.items()}
+    return {
+        "commit": git_commit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "config": {"patients": args.patients, "conversations_per_patient": main.NUM, "use_async": args.use_async,
+                   "concurrency": args.concurrency, "seed": args.seed, "backend_latency": args.latency, "speculative": args.speculative,
+                   "fast_classifier": args.fast_classifier, "constrained_yes_no": args.constrained_yes_no},
+        "wall_seconds": wall,
+        "cpu_seconds": cpu,
+        "dialogues": dialogues,
+        "dialogues_per_minute": dialogues / wall * 60 if wall else 0.0,
+        "llm_calls_per_dialogue": probe.calls / dialogues if dialogues else 0.0,
+        "prompt_tokens_per_dialogue": probe.prompt_tokens / dialogues if dialogues else 0.0,
+        "completion_tokens_per_dialogue": probe.completion_tokens / dialogues if dialogues else 0.0,
+        "stage_latency_ms": {stage: to_ms(percentiles(probe.latencies.get(stage, []))) for stage in STAGES},
+        "dialogue_seconds": percentiles(probe.dialogue_seconds),
+        "state_machine": {
+            "init_ms": probe.machine_init_seconds * 1000,
+            "transition_us": {k: (v * 1e6 if k != "count" else v) for k, v in percentiles(probe.transition_seconds).items()},
+            "share_of_cpu": (probe.machine_init_seconds + sum(probe.transition_seconds)) / cpu if cpu else 0.0,
+        },
+        "peak_rss_mb": peak_rss_mb,
+        "speculation": dict(main.SPECULATION_STATS) if args.speculative else None,
+        "fast_classifier": fast_path.summary() if fast_path is not None else None,
+        "yes_no": llm_tools_api.yes_no_stats() if args.constrained_yes_no else None,
+    }
+
+
+def compare(result, baseline):
+    print(f"{'metric':<32}{'baseline':>14}{'current':>14}{'change':>10}", file=sys.stderr)
+    rows = [(name, baseline.get(name), result.get(name)) for name in COMPARED_METRICS]
+    for stage in STAGES:
+        rows.append((f"{stage} p95 ms", baseline["stage_latency_ms"].get(stage, {}).get("p95"), result["stage_latency_ms"][stage].get("p95")))
+    for name, old, new in rows:
+        if old is None or new is None:
+            continue
+        change = f"{(new - old) / old * 100:+.1f}%" if old else "-"
+        print(f"{name:<32}{old:>14.2f}{new:>14.2f}{change:>10}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="End-to-end dialogue generation benchmark against the local mock backend")
+    parser.add_argument('--patients', type=int, default=SAMPLE_SIZE, help="number of PsyCoProfile patients to simulate")
+    parser.add_argument('--profile-path', default=PROFILE_PATH)
+    parser.add_argument('--use-async', action='store_true')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--speculative', action='store_true', help="with --use-async, prefetch the doctor question of both HDSM branches (main.py --speculative)")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--fast-classifier', action='store_true', help="answer confident yes/no classifications with fast_classifier (main.py --fast-classifier)")
+    parser.add_argument('--constrained-yes-no', action='store_true', help="single-token yes/no classifiers with logprob confidence (main.py --constrained-yes-no)")
+    parser.add_argument('--latency', type=float, default=0.0, help="median mock latency in seconds (0 measures pipeline overhead only)")
+    parser.add_argument('--output', default=None, help="write the JSON result here instead of stdout")
+    parser.add_argument('--compare', default=None, help="earlier result JSON to print relative changes against")
+    args = parser.parse_args()
+
+    result = run(args)
+    text = json.dumps(result, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            compare(result, json.load(f))
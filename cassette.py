@@ -0,0 +1,132 @@
+import gzip
+import json
+import os
+import threading
+from typing import Dict, Optional
+
+from openai.types.chat import ChatCompletion
+
+import journal
+import llm_cache
+
+
+class CassetteMismatch(RuntimeError):
+    """A replayed dialogue asked for a call the cassette does not hold"""
+
+
+def _header(line: str) -> Dict:
+    """A cassette line without its calls, which are written last and only parsed when replayed"""
+    cut = line.find(',"calls":')   # quotes inside JSON strings are escaped, so this is the key itself
+    return json.loads(line if cut < 0 else line[:cut] + "}")
+
+
+class Cassette:
+    """Every LLM call of a generation run, per dialogue, in one gzip-compressed JSONL file.
+
+    A "run" line holds the shared topic order list; each finished dialogue is one line with its random
+    seed and its calls in order (role, model, request key as in llm_cache, response without null fields).
+    In record mode the file is rewritten; in replay mode every call of a dialogue must match the recorded
+    one at the same position, and anything else raises CassetteMismatch instead of reaching the network.
+    """
+
+    def __init__(self, path: str, mode: str) -> None:
+        if mode not in ("record", "replay"):
+            raise ValueError(f"录制模式应为 record 或 replay，收到 {mode}")
+        self.path = path
+        self.mode = mode
+        self.order_list = None
+        self.dialogues: Dict[str, str] = {}   # dialogue key -> its raw line, parsed when the dialogue is replayed
+        self.recorded = 0
+        self.replayed = 0
+        self._lock = threading.Lock()
+        self._file = None
+        if mode == "replay":
+            self._load()
+        else:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            self._file = gzip.open(path, 'wt', encoding='utf-8')
+
+    def _load(self) -> None:
+        with gzip.open(self.path, 'rt', encoding='utf-8') as f:
+            try:
+                for line in f:
+                    header = _header(line)
+                    if header["type"] == "run":
+                        self.order_list = header["order_list"]
+                    elif header["type"] == "dialogue":
+                        self.dialogues[header["dialogue"]] = line
+            except (EOFError, json.JSONDecodeError):   # cut off by a crash of the recording run
+                pass
+
+    def _write(self, event_type: str, **data) -> None:
+        line = json.dumps({"type": event_type, **data}, ensure_ascii=False, separators=(",", ":"))
+        with self._lock:
+            self._file.write(line + "\n")
+
+    def start_run(self, order_list):
+        """Topic order list of the run: written when recording, the recorded one when replaying"""
+        if self.mode == "replay":
+            if self.order_list is None:
+                raise CassetteMismatch(f"录制 {self.path} 中没有话题顺序")
+            return self.order_list
+        self._write("run", order_list=order_list)
+        return order_list
+
+    def recorder(self, dialogue: str, seed=None) -> "CassetteRecorder":
+        if self.mode == "record":
+            return CassetteRecorder(dialogue, seed)
+        line = self.dialogues.get(dialogue)
+        if line is None:
+            raise CassetteMismatch(f"对话 {dialogue} 不在录制 {self.path} 中")
+        event = json.loads(line)
+        return CassetteRecorder(dialogue, event["seed"], event["calls"])
+
+    def finish(self, recorder: "CassetteRecorder") -> None:
+        """Store a recorded dialogue, or check that a replayed one used up its calls"""
+        if self.mode == "record":
+            self._write("dialogue", dialogue=recorder.dialogue, seed=recorder.seed, calls=recorder.calls)
+            with self._lock:
+                self.recorded += len(recorder.calls)
+            return
+        if recorder.seq != len(recorder.replay_calls):
+            raise CassetteMismatch(f"对话 {recorder.dialogue} 只用了录制的 {recorder.seq}/{len(recorder.replay_calls)} 次调用")
+        with self._lock:
+            self.replayed += recorder.replayed
+
+    def stats(self) -> Dict:
+        return {"mode": self.mode, "dialogues": len(self.dialogues), "recorded_calls": self.recorded, "replayed_calls": self.replayed}
+
+    def close(self) -> None:
+        if self._file is not None:
+            self._file.close()
+
+
+class CassetteRecorder(journal.DialogueRecorder):
+    """Journal recorder interface over a cassette: collects the calls of one dialogue, or answers them all"""
+
+    def __init__(self, dialogue: str, seed=None, calls=None) -> None:
+        super().__init__(None, dialogue, calls)
+        self.seed = seed
+        self.strict = calls is not None
+        self.calls = []
+
+    def replay(self, role: str, request: Dict) -> Optional[ChatCompletion]:
+        if not self.strict:
+            return None
+        key = llm_cache.CompletionCache.make_key(request)
+        if self.seq >= len(self.replay_calls):
+            raise CassetteMismatch(f"对话 {self.dialogue} 第 {self.seq} 次调用（{role}）超出录制的 {len(self.replay_calls)} 次调用")
+        call = self.replay_calls[self.seq]
+        if call["role"] != role or call["key"] != key:
+            raise CassetteMismatch(f"对话 {self.dialogue} 第 {self.seq} 次调用与录制不一致："
+                                   f"{role} {key[:12]} != 录制的 {call['role']} {call['key'][:12]}")
+        self.seq += 1
+        self.replayed += 1
+        return ChatCompletion.model_validate(call["response"])
+
+    def record(self, role: str, request: Dict, response: ChatCompletion) -> None:
+        if self.strict:   # replay() answered or raised on every call
+            raise CassetteMismatch(f"对话 {self.dialogue} 在回放时发起了录制之外的调用（{role}）")
+        self.calls.append({"role": role, "model": request.get("model"), "key": llm_cache.CompletionCache.make_key(request),
+                           "response": response.model_dump(mode="json", exclude_none=True)})
+        self.seq += 1
@@ -0,0 +1,119 @@
+import functools
+import re
+import threading
+from typing import Dict, List, Optional
+
+BUDGETS = {"doctor": 240, "patient": 120}   # dialogue-history tokens per prompt; the default 6 / 3 turn windows average ~270 / ~120 and peak at 2-3x
+DEFAULT_WINDOWS = {"doctor": 6, "patient": 3}   # turns the prompts embed without a budget, the baseline for tokens saved
+MIN_RECENT_TURNS = 2   # the latest question and answer are always kept, whatever the budget
+RECENCY_DECAY = 0.85   # relevance of a turn falls by this factor per turn of age
+SUMMARY_SHARE = 0.3   # with summarize, share of the budget reserved for the rolling summary of the turns left out
+SUMMARY_CLAUSE_CHARS = 24   # a folded turn keeps its first clause, cut to this many characters
+TIKTOKEN_ENCODING = "o200k_base"   # gpt-4o family; close enough to budget the other providers too
+STATS = {}   # role -> calls / default_tokens / context_tokens / summarized
+_stats_lock = threading.Lock()
+_encoding = None
+
+
+def _tiktoken():
+    global _encoding
+    if _encoding is None:
+        try:
+            import tiktoken
+            _encoding = tiktoken.get_encoding(TIKTOKEN_ENCODING)
+        except Exception:   # not installed, or the encoding cannot be downloaded
+            _encoding = False
+    return _encoding
+
+
+@functools.lru_cache(maxsize=65536)
+def count_tokens(text: str) -> int:
+    """tiktoken if installed, otherwise one token per CJK character and one per four other characters"""
+    encoding = _tiktoken()
+    if encoding:
+        return len(encoding.encode(text))
+    cjk = sum(1 for c in text if ord(c) >= 0x2e80)
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def _bigrams(text: str):
+    return {text[i:i + 2] for i in range(len(text) - 1)}
+
+
+def _first_clause(turn: str) -> str:
+    speaker, _, text = turn.partition("：")
+    clause = re.split(r"[，,。.!！？?；;]", text, 1)[0][:SUMMARY_CLAUSE_CHARS]
+    return f"{speaker}：{clause}" if text else turn[:SUMMARY_CLAUSE_CHARS]
+
+
+class ContextBuilder:
+    """Picks the dialogue-history turns a doctor or patient prompt embeds, within a token budget.
+
+    The latest MIN_RECENT_TURNS turns are always kept; the rest of the budget goes to the turns with the
+    highest relevance, i.e. recency times (1 + share of the topic's character bigrams they contain), and
+    the picked turns stay in dialogue order. With summarize=True the turns left out are folded into one
+    leading "此前对话摘要" entry (first clause of each, newest first until SUMMARY_BUDGET) instead of being
+    dropped; it gets SUMMARY_SHARE of the budget plus whatever the turns left over. The result is a list
+    like dialogue_history[-n:], so the prompt templates are unchanged.
+    """
+
+    def __init__(self, role: str, budget: Optional[int] = None, summarize: bool = False) -> None:
+        self.role = role
+        self.budget = budget if budget is not None else BUDGETS[role]
+        self.summarize = summarize
+        self.default_window = DEFAULT_WINDOWS[role]
+
+    def _relevance(self, turn: str, age: int, topic_bigrams) -> float:
+        overlap = len(_bigrams(turn) & topic_bigrams) / len(topic_bigrams) if topic_bigrams else 0.0
+        return RECENCY_DECAY ** age * (1 + overlap)
+
+    def _summary(self, turns: List[str], budget: int) -> Optional[str]:
+        pieces, used = [], count_tokens("此前对话摘要：") + 2
+        for turn in reversed(turns):
+            piece = _first_clause(turn)
+            cost = count_tokens(piece) + 1
+            if used + cost > budget:
+                break
+            pieces.append(piece)
+            used += cost
+        return "此前对话摘要：" + "；".join(reversed(pieces)) if pieces else None
+
+    def history(self, dialogue_history, topic, record: bool = True) -> List[str]:
+        turns = list(dialogue_history)
+        keep = set(range(max(0, len(turns) - MIN_RECENT_TURNS), len(turns)))
+        used = sum(count_tokens(turns[i]) + 2 for i in keep)   # +2: quotes and separator of the list repr
+        turn_budget = self.budget - int(self.budget * SUMMARY_SHARE) if self.summarize else self.budget
+        topic_bigrams = _bigrams(str(topic))
+        candidates = sorted((i for i in range(len(turns)) if i not in keep),
+                            key=lambda i: self._relevance(turns[i], len(turns) - 1 - i, topic_bigrams), reverse=True)
+        for i in candidates:
+            cost = count_tokens(turns[i]) + 2
+            if used + cost <= turn_budget:
+                keep.add(i)
+                used += cost
+        selected = [turns[i] for i in sorted(keep)]
+        summary = None
+        if self.summarize and len(keep) < len(turns):
+            summary = self._summary([turn for i, turn in enumerate(turns) if i not in keep], self.budget - used)
+            if summary is not None:
+                selected.insert(0, summary)
+        if record:
+            self._record(turns, selected, summary is not None)
+        return selected
+
+    def _record(self, turns, selected, summarized) -> None:
+        default_tokens = count_tokens(str(turns[-self.default_window:]))
+        context_tokens = count_tokens(str(selected))
+        with _stats_lock:
+            stats = STATS.setdefault(self.role, {"calls": 0, "default_tokens": 0, "context_tokens": 0, "summarized": 0})
+            stats["calls"] += 1
+            stats["default_tokens"] += default_tokens
+            stats["context_tokens"] += context_tokens
+            stats["summarized"] += summarized
+
+
+def stats() -> Dict[str, Dict]:
+    """Per role: history tokens per call against the default fixed window, and tokens saved per call (negative: the budget embeds more)"""
+    with _stats_lock:
+        return {role: dict(stats, saved_per_call=(stats["default_tokens"] - stats["context_tokens"]) / stats["calls"])
+                for role, stats in STATS.items() if stats["calls"]}
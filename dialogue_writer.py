@@ -0,0 +1,202 @@
+import glob
+import gzip
+import json
+import os
+import re
+import socket
+import sys
+import threading
+import time
+import zlib
+from typing import Dict, Iterator, Optional
+
+SHARD_MAX_RECORDS = 1000   # dialogues per shard before rotating
+SHARD_MAX_BYTES = 256 * 1024 * 1024   # uncompressed bytes per shard before rotating
+PARTIAL_SUFFIX = ".partial"   # shard still being written; renamed when it is rotated or the writer closes
+EXTENSIONS = {None: ".jsonl", "gzip": ".jsonl.gz", "zstd": ".jsonl.zst"}
+READ_CHUNK = 1 << 20
+PARTIAL_STALE_SECONDS = 30 * 60   # follow mode: a .partial shard unmodified this long is taken as abandoned
+_SHARD_NAME = re.compile(r"-\d{8}-\d{6}-(?P<host>.+)-(?P<pid>\d+)-\d{5}\.jsonl")
+
+
+def _zstd():
+    try:
+        import zstandard
+    except ImportError:
+        raise ImportError("zstd 压缩需要安装 zstandard: pip install zstandard") from None
+    return zstandard
+
+
+class _Shard:
+    """One open shard; every record is flushed through the compressor and fsynced, so a crash loses at most the record being written"""
+
+    def __init__(self, path: str, compression: Optional[str]) -> None:
+        self.path = path
+        self.compression = compression
+        self.raw = open(path + PARTIAL_SUFFIX, 'xb')
+        if compression == "gzip":
+            self.stream = gzip.GzipFile(fileobj=self.raw, mode='wb')
+        elif compression == "zstd":
+            self.stream = _zstd().ZstdCompressor().stream_writer(self.raw, closefd=False)
+        else:
+            self.stream = self.raw
+        self.records = 0
+        self.bytes = 0
+
+    def write(self, data: bytes) -> None:
+        self.stream.write(data)
+        if self.compression == "zstd":
+            self.stream.flush(_zstd().FLUSH_BLOCK)
+        elif self.compression == "gzip":
+            self.stream.flush()   # Z_SYNC_FLUSH: everything written so far can be decompressed
+        self.raw.flush()
+        os.fsync(self.raw.fileno())
+        self.records += 1
+        self.bytes += len(data)
+
+    def close(self) -> None:
+        if self.stream is not self.raw:
+            self.stream.close()   # gzip trailer / end of the zstd frame; leaves self.raw open
+        self.raw.flush()
+        os.fsync(self.raw.fileno())
+        self.raw.close()
+        os.replace(self.path + PARTIAL_SUFFIX, self.path)
+
+
+class DialogueWriter:
+    """Streams finished dialogues as compact JSON lines into rotating, optionally compressed shards.
+
+    Shards are named <prefix>-<start time>-<host>-<pid>-<seq>.jsonl[.gz|.zst], so several worker processes
+    can share one directory. The open shard carries a .partial suffix until it is complete; readers skip it
+    by default. Shards of a crashed run stay .partial, but every record fsynced before the crash is readable.
+    """
+
+    def __init__(self, directory: str, compression: Optional[str] = None, max_records: int = SHARD_MAX_RECORDS,
+                 max_bytes: int = SHARD_MAX_BYTES, prefix: str = "dialogues") -> None:
+        if compression not in EXTENSIONS:
+            raise ValueError(f"不支持的压缩格式 {compression}，可选: gzip, zstd")
+        if compression == "zstd":
+            _zstd()
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.compression = compression
+        self.max_records = max_records
+        self.max_bytes = max_bytes
+        self.name = f"{prefix}-{time.strftime('%Y%m%d-%H%M%S')}-{socket.gethostname()}-{os.getpid()}"
+        self.seq = 0
+        self.shard: Optional[_Shard] = None
+        self._lock = threading.Lock()
+
+    def _open_shard(self) -> _Shard:
+        path = os.path.join(self.directory, f"{self.name}-{self.seq:05d}{EXTENSIONS[self.compression]}")
+        self.seq += 1
+        return _Shard(path, self.compression)
+
+    def write(self, record: Dict) -> None:
+        data = (json.dumps(record, ensure_ascii=False, separators=(",", ":")) + "\n").encode("utf-8")
+        with self._lock:
+            if self.shard is None:
+                self.shard = self._open_shard()
+            elif self.shard.records >= self.max_records or self.shard.bytes + len(data) > self.max_bytes:
+                finished = self.shard
+                self.shard = self._open_shard()   # open the next shard first, so a .partial exists while we run
+                finished.close()
+            self.shard.write(data)
+
+    def close(self) -> None:
+        with self._lock:
+            if self.shard is not None:
+                self.shard.close()
+                self.shard = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def _open_for_reading(path: str):
+    name = path[:-len(PARTIAL_SUFFIX)] if path.endswith(PARTIAL_SUFFIX) else path
+    if name.endswith(".gz"):
+        return gzip.open(path, 'rb')
+    if name.endswith(".zst"):
+        return _zstd().ZstdDecompressor().stream_reader(open(path, 'rb'), read_across_frames=True, closefd=True)
+    return open(path, 'rb')
+
+
+def read_shard(path: str) -> Iterator[Dict]:
+    """Records of one shard, decompressed chunk by chunk; a torn last record (crashed writer) is dropped"""
+    truncated = (EOFError, zlib.error) + ((_zstd().ZstdError,) if ".zst" in os.path.basename(path) else ())
+    pending = b""
+    with _open_for_reading(path) as f:
+        read = getattr(f, "read1", f.read)   # read1 returns what is decoded so far instead of failing the whole chunk at a torn end
+        while True:
+            try:
+                chunk = read(READ_CHUNK)
+            except truncated:
+                break
+            if not chunk:
+                break
+            lines = (pending + chunk).split(b"\n")
+            pending = lines.pop()
+            for line in lines:
+                if line:
+                    yield json.loads(line)
+
+
+def shard_paths(directory: str, include_partial: bool = False):
+    patterns = [f"*{extension}" for extension in EXTENSIONS.values()]
+    if include_partial:
+        patterns += [pattern + PARTIAL_SUFFIX for pattern in patterns]
+    return sorted({path for pattern in patterns for path in glob.glob(os.path.join(directory, pattern))})
+
+
+def _writer_alive(path: str, stale_after: float) -> bool:
+    """Whether a .partial shard may still be written: its writer process on this host runs and the file is recent"""
+    match = _SHARD_NAME.search(os.path.basename(path))
+    if match and match["host"] == socket.gethostname() and os.name == "posix":
+        try:
+            os.kill(int(match["pid"]), 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:   # alive, owned by another user
+            pass
+    try:
+        return time.time() - os.path.getmtime(path) < stale_after
+    except FileNotFoundError:   # renamed meanwhile; the scan below reads it
+        return False
+
+
+def iter_records(directory: str, follow: bool = False, poll_interval: float = 5.0, include_partial: bool = False,
+                 stale_after: float = PARTIAL_STALE_SECONDS) -> Iterator[Dict]:
+    """Lazily yield every dialogue record under `directory`, one shard at a time.
+
+    With follow=True, keep polling for shards completed later and stop once no writer has a .partial shard
+    open any more, so a training job can consume the corpus while it is still being generated. A .partial
+    shard whose writer is gone (its pid no longer runs on this host) or that has not been modified for
+    `stale_after` seconds is left by a crashed run and does not keep the reader waiting; a live writer
+    idle for longer than that also ends the follow.
+    include_partial also reads .partial shards, e.g. those a crashed run left behind.
+    """
+    if follow and include_partial:
+        raise ValueError("follow 模式只读取已完成的分片")
+    seen = set()
+    while True:
+        writing = any(_writer_alive(path, stale_after)   # checked first: a shard finished meanwhile is in the scan below
+                      for path in glob.glob(os.path.join(directory, "*" + PARTIAL_SUFFIX)))
+        new = [path for path in shard_paths(directory, include_partial) if path not in seen]
+        for path in new:
+            seen.add(path)
+            yield from read_shard(path)
+        if not follow or (not new and not writing):
+            return
+        if not new:
+            time.sleep(poll_interval)
+
+
+if __name__ == "__main__":
+    count = 0
+    for count, record in enumerate(iter_records(sys.argv[1] if len(sys.argv) > 1 else "./Dial_data", include_partial=True), 1):
+        pass
+    print(f"{count} 段对话")
@@ -1,8 +1,10 @@
+import copy
 import json
 import random
-from transformers import AutoModelForCausalLM, AutoTokenizer
-import torch
 import llm_tools_api
+import local_models
+import prompt_layout
+import telemetry
 import os
 
 
@@ -47,7 +49,7 @@ class Doctor(llm_tools_api.DoctorCost):
     10.根据历史对话，禁止“那你...”“那这种情况...”等模式连续多次使用，建议把“这种情况”/“那”替换成患者提到的症状
     """
 
-    def __init__(self, patient_template, doctor_prompt_path,  model_path, machine_path, use_api) -> None:
+    def __init__(self, patient_template, doctor_prompt_path,  model_path, machine_path, use_api, rng=None, cache_friendly_prompts=False, context_builder=None) -> None:
         super().__init__(model_path.split('/')[-1])
         self.patient_template = patient_template
         self.doctor_prompt_path = doctor_prompt_path
@@ -55,8 +57,10 @@ class Doctor(llm_tools_api.DoctorCost):
         self.model_name = model_path.split('/')[-1]
         self.doctor_model = None
         self.doctor_tokenizer = None
+        self.kv_session = None
         self.doctor_prompt = None
         self.client = None
+        self.async_client = None
         self.messages = []
         self.dialbegin = True
         self.use_api = use_api
@@ -68,6 +72,34 @@ class Doctor(llm_tools_api.DoctorCost):
         self.diagnosis_lists = None
         self.diagnosis = ['' for i in range(4)]
         self.machine_path = machine_path
+        self.rng = rng if rng is not None else random   # per-dialogue random.Random for reproducible runs
+        self.cache_friendly_prompts = cache_friendly_prompts   # static prompt head first, see prompt_layout
+        self.static_prompt = None
+        self.context_builder = context_builder   # context_builder.ContextBuilder choosing the embedded history; None: last 6 turns
+
+    SNAPSHOT_FIELDS = ("messages", "dialbegin", "current_idx", "doctor_prompt", "doctor_persona", "patient_persona",
+                       "diagnosis", "static_prompt", "total_cost")
+
+    def snapshot(self) -> dict:
+        """Copy of the dialogue state: messages, persona choice, turn counter, diagnoses so far and cost"""
+        return copy.deepcopy({field: getattr(self, field) for field in self.SNAPSHOT_FIELDS})
+
+    def restore(self, snapshot: dict) -> None:
+        for field in self.SNAPSHOT_FIELDS:
+            setattr(self, field, copy.deepcopy(snapshot[field]))
+
+    def fork(self, rng=None) -> "Doctor":
+        """Independent doctor continuing this dialogue; API clients and local models are shared, a KV cache starts empty.
+        rng defaults to a copy of this doctor's random source (the module itself is shared)"""
+        clone = copy.copy(self)
+        clone.restore(self.snapshot())
+        clone.state_contents = dict(self.state_contents)
+        if rng is None:
+            rng = self.rng if self.rng is random else copy.deepcopy(self.rng)
+        clone.rng = rng
+        if self.kv_session is not None:
+            clone.kv_session = local_models.KVSession(self.doctor_model, self.doctor_tokenizer)
+        return clone
 
     def _load_rules(self, folder: str):
         state_files = [
@@ -113,7 +145,7 @@ class Doctor(llm_tools_api.DoctorCost):
         with open(self.doctor_prompt_path, 'r', encoding='utf-8') as f:
             prompt = json.load(f)
         self._load_rules(self.machine_path)
-        doctor_num = random.randint(0, len(prompt)-1)
+        doctor_num = self.rng.randint(0, len(prompt)-1)
         self.doctor_prompt = prompt[doctor_num]
         self.doctor_persona = "你是一名{}的{}专业的精神卫生中心临床心理科主任医师，对一名患者进行问诊。注意，你有如下的问诊习惯，你在所有的对话过程中都要记住和保持这些问诊习惯：\
             你尤其擅长诊断{}，你的问诊速度是{}的，你的交流风格是{}的，你{}在适当到时候与患者进行共情对话，你{}向患者解释一些专业名词术语。使用口语化的表达。注意每轮不能有超过两个问题。" \
@@ -125,93 +157,97 @@ class Doctor(llm_tools_api.DoctorCost):
         if self.use_api:
             self.client = llm_tools_api.doctor_client_init(self.model_name)
         else:
-            self.doctor_model = AutoModelForCausalLM.from_pretrained(
-                self.model_path,
-                torch_dtype=torch.bfloat16,
-                device_map="auto"
-            )
-            self.doctor_tokenizer = AutoTokenizer.from_pretrained(self.model_path)
+            self.doctor_model, self.doctor_tokenizer = local_models.load(self.model_path)
+            if local_models.KV_CACHE_REUSE and not local_models.batching_enabled():
+                self.kv_session = local_models.KVSession(self.doctor_model, self.doctor_tokenizer)
         self.messages.extend([{"role": "system", "content": self.doctor_persona},
                             {"role": "user", "content": final_prompt}])
 
         
 
-    def doctor_response_gen(self, dialogue_history, topic_seq=None, is_dialogue_end=False):
-        if self.use_api:
-            if self.dialbegin == True:
-                self.doctorbot_init()
-                print("问诊开始---\n")
-                self.current_idx += 1
-                chat_response = self.client.chat.completions.create(
-                    model=self.model_name,
-                    messages=self.messages,
-                    top_p = 0.93
-                )
-                super().money_cost(chat_response.usage.prompt_tokens, chat_response.usage.completion_tokens)
-                doctor_response = chat_response.choices[0].message.content
-                self.messages.pop()
-                self.dialbegin = False
-                return doctor_response, None, super().get_cost()
-            else:   
-                if is_dialogue_end:
-                    diag_result = "诊断结束，你的诊断结果为：{}。".format(dialogue_history)
-                    return diag_result, None, super().get_cost()
-                else:
-                    self.current_idx += 1
-                    print("**********current_topic ", topic_seq)
-                    if self.doctor_prompt['empathy'] == '有':
-                        doctor_prompt = self.doctor_persona + self.patient_persona + "\n你与患者的所有对话历史如下{}，".format(dialogue_history[-6:]) + self.DOCTOR_PROMPT_EMPATHY + "\n你回复患者的内容必须完全依据：\n1.对话历史\n2.当前话题{}。注意输出的问题要符合当前话题并结合上一轮患者的回答，换成口语化的表述方式加上共情策略，不能与对话历史的语言结构重复！！如果当前话题有关自杀或者自残，禁止输出冒犯性的提问。".format(topic_seq)
-                            
-                    else:
-                        doctor_prompt = self.doctor_persona + self.patient_persona + "\n你与患者的所有对话历史如下{}，".format(dialogue_history[-6:]) + self.DOCTOR_PROMPT + "\n你回复患者的内容必须完全依据：\n1.对话历史\n2.当前话题{}。注意输出的问题要符合当前话题并结合上一轮患者的回答，换成口语化的表述方式，不能与对话历史的语言结构重复！！如果当前话题有关自杀或者自残，禁止输出冒犯性的提问。".format(topic_seq)                             
-                    self.messages.append({"role": "user", "content": doctor_prompt})
-                    chat_response = self.client.chat.completions.create(
-                        model=self.model_name,
-                        messages=self.messages,
-                        top_p=0.95,
-                        temperature = 1,
-                        frequency_penalty=0.9
-                    )
-                    super().money_cost(chat_response.usage.prompt_tokens, chat_response.usage.completion_tokens)
-                    doctor_response = chat_response.choices[0].message.content
-                    self.messages.pop()
-                    return doctor_response, None, super().get_cost()
+    def _api_request(self, dialogue_history, topic_seq):   # create() arguments for the next turn; local models generate from its messages
+        if self.dialbegin == True:
+            self.doctorbot_init()
+            print("问诊开始---\n")
+            self.current_idx += 1
+            messages = list(self.messages)
+            self.messages.pop()
+            self.dialbegin = False
+            return dict(model=self.model_name, messages=messages, top_p=0.93)
+
+        self.current_idx += 1
+        print("**********current_topic ", topic_seq)
+        return self._turn_request(dialogue_history, topic_seq)
+
+    def _turn_request(self, dialogue_history, topic_seq, record=True):   # request of a regular turn, without touching the turn counter
+        if self.context_builder is not None:
+            history = self.context_builder.history(dialogue_history, topic_seq, record)
+        else:
+            history = dialogue_history[-6:]
+        if self.cache_friendly_prompts:
+            empathy = self.doctor_prompt['empathy'] == '有'
+            if self.static_prompt is None:
+                self.static_prompt = prompt_layout.doctor_static_prompt(self.doctor_persona, self.patient_persona,
+                    self.DOCTOR_PROMPT_EMPATHY if empathy else self.DOCTOR_PROMPT, empathy)
+            doctor_prompt = self.static_prompt + prompt_layout.doctor_turn_prompt(history, topic_seq)
+        elif self.doctor_prompt['empathy'] == '有':
+            doctor_prompt = self.doctor_persona + self.patient_persona + "\n你与患者的所有对话历史如下{}，".format(history) + self.DOCTOR_PROMPT_EMPATHY + "\n你回复患者的内容必须完全依据：\n1.对话历史\n2.当前话题{}。注意输出的问题要符合当前话题并结合上一轮患者的回答，换成口语化的表述方式加上共情策略，不能与对话历史的语言结构重复！！如果当前话题有关自杀或者自残，禁止输出冒犯性的提问。".format(topic_seq)
                 
         else:
-            #Todo
-            if self.dialbegin == True:
-                self.doctorbot_init()
-                text = self.doctor_tokenizer.apply_chat_template(
-                    self.messages,
-                    tokenize=False,
-                    add_generation_prompt=True
-                )
-                doctor_model_inputs = self.doctor_tokenizer([text], return_tensors="pt").to(self.doctor_model.device)
-                generated_ids = self.doctor_model.generate(
-                    doctor_model_inputs.input_ids,
-                    max_new_tokens=512
-                )
-                generated_ids = [
-                    output_ids[len(input_ids):] for input_ids, output_ids in zip(doctor_model_inputs.input_ids, generated_ids)
-                ]
-                doctor_response = self.doctor_tokenizer.batch_decode(generated_ids, skip_special_tokens=True)[0]
-                self.messages.append({"role": "assistant", "content": doctor_response})
-                self.dialbegin = False
-            else:
-                text = self.doctor_tokenizer.apply_chat_template(
-                    self.messages,
-                    tokenize=False,
-                    add_generation_prompt=True
-                )
-                doctor_model_inputs = self.doctor_tokenizer([text], return_tensors="pt").to(self.doctor_model.device)
-                generated_ids = self.doctor_model.generate(
-                    doctor_model_inputs.input_ids,
-                    max_new_tokens=512
-                )
-                generated_ids = [
-                    output_ids[len(input_ids):] for input_ids, output_ids in zip(doctor_model_inputs.input_ids, generated_ids)
-                ]
-                doctor_response = self.doctor_tokenizer.batch_decode(generated_ids, skip_special_tokens=True)[0]
-                self.messages.append({"role": "assistant", "content": doctor_response})
-            return doctor_response
-        
+            doctor_prompt = self.doctor_persona + self.patient_persona + "\n你与患者的所有对话历史如下{}，".format(history) + self.DOCTOR_PROMPT + "\n你回复患者的内容必须完全依据：\n1.对话历史\n2.当前话题{}。注意输出的问题要符合当前话题并结合上一轮患者的回答，换成口语化的表述方式，不能与对话历史的语言结构重复！！如果当前话题有关自杀或者自残，禁止输出冒犯性的提问。".format(topic_seq)                             
+        return dict(
+            model=self.model_name,
+            messages=self.messages + [{"role": "user", "content": doctor_prompt}],
+            top_p=0.95,
+            temperature = 1,
+            frequency_penalty=0.9
+        )
+
+    def _api_response(self, chat_response):
+        usage = chat_response.usage
+        super().money_cost(usage.prompt_tokens, usage.completion_tokens, telemetry.cached_tokens(usage))
+        doctor_response = chat_response.choices[0].message.content
+        return doctor_response, None, super().get_cost()
+
+    def _local_response(self, request):
+        if local_models.batching_enabled():
+            doctor_response = local_models.engine(self.model_path).generate(request["messages"], max_new_tokens=512)
+        elif self.kv_session is not None:
+            doctor_response = self.kv_session.generate(request["messages"], max_new_tokens=512)
+        else:
+            doctor_response = local_models.generate(self.doctor_model, self.doctor_tokenizer, request["messages"], max_new_tokens=512)
+        return doctor_response, None, super().get_cost()
+
+    def doctor_response_gen(self, dialogue_history, topic_seq=None, is_dialogue_end=False):
+        if is_dialogue_end and not self.dialbegin:
+            diag_result = "诊断结束，你的诊断结果为：{}。".format(dialogue_history)
+            return diag_result, None, super().get_cost()
+        request = self._api_request(dialogue_history, topic_seq)
+        if not self.use_api:
+            return self._local_response(request)
+        chat_response = llm_tools_api.chat_completion(self.client, 'doctor', **request)
+        return self._api_response(chat_response)
+
+    async def async_doctor_response_gen(self, dialogue_history, topic_seq=None, is_dialogue_end=False, prefetched=None):
+        if not self.use_api and not local_models.batching_enabled():
+            raise ValueError("异步生成仅支持API模式或开启批处理的本地模型")
+        if is_dialogue_end and not self.dialbegin:
+            diag_result = "诊断结束，你的诊断结果为：{}。".format(dialogue_history)
+            return diag_result, None, super().get_cost()
+        request = self._api_request(dialogue_history, topic_seq)
+        if not self.use_api:   # the batch engine steps every waiting dialogue together
+            doctor_response = await local_models.engine(self.model_path).agenerate(request["messages"], max_new_tokens=512)
+            return doctor_response, None, super().get_cost()
+        if prefetched is not None and prefetched.request == request:
+            chat_response = await prefetched.take()
+            return self._api_response(chat_response)
+        if self.async_client is None:
+            self.async_client = llm_tools_api.async_client_init(self.model_name)
+        chat_response = await llm_tools_api.async_chat_completion(self.async_client, 'doctor', **request)
+        return self._api_response(chat_response)
+
+    def prefetch_response(self, dialogue_history, topic_seq):
+        """Start the API turn for topic_seq in the background; hand it to async_doctor_response_gen(prefetched=...) to use it"""
+        if self.async_client is None:
+            self.async_client = llm_tools_api.async_client_init(self.model_name)
+        return llm_tools_api.Prefetch(self.async_client, 'doctor', self._turn_request(dialogue_history, topic_seq, record=False))
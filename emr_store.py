@@ -0,0 +1,196 @@
+import argparse
+import json
+import os
+import re
+import sqlite3
+import threading
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+EMR_DB_PATH = './PsyCoData/emr.db'
+PROFILE_PATH = './PsyCoData/PsyCoProfile.json'
+CASES_PATH = './raw_data/cases_ready.json'
+DISEASES = ['抑郁症', '焦虑症', '双相情感障碍', '多动症']   # bit i of disease_mask
+ALIASES = {'抑郁': '抑郁症', '焦虑': '焦虑症', '双相': '双相情感障碍', '多动': '多动症'}   # topic names used by main.py
+
+
+def disease_mask(diseases: Iterable[str]) -> int:
+    mask = 0
+    for disease in diseases:
+        disease = ALIASES.get(disease.strip(), disease.strip())
+        if disease not in DISEASES:
+            raise ValueError(f"未知诊断 {disease}，可选: {DISEASES}")
+        mask |= 1 << DISEASES.index(disease)
+    return mask
+
+
+def parse_diagnosis(diagnosis: str) -> List[str]:
+    """'抑郁症，焦虑症' -> ['抑郁症', '焦虑症']"""
+    return [part for part in re.split(r"[，,、\s]+", diagnosis) if part]
+
+
+def parse_age_band(band: str) -> Tuple[Optional[int], Optional[int]]:
+    """'[25-29]' -> (25, 29)"""
+    match = re.match(r"\[?\s*(\d+)\s*-\s*(\d+)\s*\]?", band or "")
+    return (int(match.group(1)), int(match.group(2))) if match else (None, None)
+
+
+def _index_columns(record: Dict, diagnosis_key: str):
+    age_low, age_high = parse_age_band(record.get('年龄'))
+    return record.get('性别'), record.get('年龄'), age_low, age_high, disease_mask(parse_diagnosis(record[diagnosis_key]))
+
+
+def build_store(db_path: str, profile_path: Optional[str] = None, cases_path: Optional[str] = None) -> Dict[str, int]:
+    """One-time import of PsyCoProfile-style EMRs and/or cases_ready.json into an indexed SQLite file; re-importing replaces the table"""
+    os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+    conn = sqlite3.connect(db_path)
+    counts = {}
+    try:
+        with conn:
+            conn.executescript("""
+                CREATE TABLE IF NOT EXISTS profiles (
+                    id INTEGER PRIMARY KEY, gender TEXT, age_band TEXT, age_low INTEGER, age_high INTEGER,
+                    disease_mask INTEGER NOT NULL, record TEXT NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS cases (
+                    seq INTEGER PRIMARY KEY, patient TEXT UNIQUE NOT NULL, profile_id INTEGER, gender TEXT, age_band TEXT,
+                    age_low INTEGER, age_high INTEGER, disease_mask INTEGER NOT NULL, record TEXT NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS profiles_filter ON profiles (disease_mask, gender, age_low);
+                CREATE INDEX IF NOT EXISTS cases_filter ON cases (disease_mask, gender, age_low);
+                CREATE INDEX IF NOT EXISTS cases_profile ON cases (profile_id);
+                CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+            """)
+            if profile_path:
+                with open(profile_path, 'r', encoding='utf-8') as f:
+                    profiles = json.load(f)
+                conn.execute("DELETE FROM profiles")
+                conn.executemany("INSERT INTO profiles VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                 ((case['id'], *_index_columns(case, '初步诊断'), json.dumps(case, ensure_ascii=False)) for case in profiles))
+                conn.execute("INSERT OR REPLACE INTO meta VALUES ('profile_source', ?)", (os.path.abspath(profile_path),))
+                counts['profiles'] = len(profiles)
+            if cases_path:
+                with open(cases_path, 'r', encoding='utf-8') as f:
+                    cases = json.load(f)
+                conn.execute("DELETE FROM cases")
+                conn.executemany("INSERT INTO cases VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                                 ((seq, case['患者'], int(case['患者'].split("com")[0]), *_index_columns(case, '诊断结果'),
+                                   json.dumps(case, ensure_ascii=False)) for seq, case in enumerate(cases)))
+                conn.execute("INSERT OR REPLACE INTO meta VALUES ('cases_source', ?)", (os.path.abspath(cases_path),))
+                counts['cases'] = len(cases)
+    finally:
+        conn.close()
+    return counts
+
+
+class EMRStore:
+    """Read-only view of an emr_store database.
+
+    Filters only touch the indexed columns; a record's JSON is decoded when it is yielded, so selecting
+    100 of 3,000 cases never parses the other 2,900. The file is opened read-only (one connection per
+    thread), so any number of worker processes can share it.
+    """
+
+    def __init__(self, path: str = EMR_DB_PATH) -> None:
+        if not os.path.exists(path):
+            raise FileNotFoundError(f"EMR 数据库 {path} 不存在，请先运行 python emr_store.py 导入")
+        self.path = path
+        self._local = threading.local()
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(f"file:{os.path.abspath(self.path)}?mode=ro", uri=True, check_same_thread=False)
+            self._local.conn = conn
+        return conn
+
+    @staticmethod
+    def _where(ids=None, diagnoses=None, exact=False, gender=None, age=None, id_column="id"):
+        clauses, params = [], []
+        if ids is not None:
+            ids = list(ids)
+            clauses.append(f"{id_column} IN ({','.join('?' * len(ids))})")
+            params += ids
+        if diagnoses:
+            mask = disease_mask(diagnoses)
+            clauses.append("disease_mask = ?" if exact else "disease_mask & ? = ?")
+            params += [mask] if exact else [mask, mask]
+        if gender is not None:
+            clauses.append("gender = ?")
+            params.append(gender)
+        if age is not None:   # (low, high): bands overlapping the range
+            clauses.append("age_low <= ? AND age_high >= ?")
+            params += [age[1], age[0]]
+        return (" WHERE " + " AND ".join(clauses)) if clauses else "", params
+
+    def _select(self, table, columns, order, filters, limit):
+        where, params = self._where(**filters)
+        sql = f"SELECT {columns} FROM {table}{where} ORDER BY {order}"
+        if limit is not None:
+            sql += " LIMIT ?"
+            params.append(limit)
+        return self._conn().execute(sql, params)
+
+    def profile_ids(self, ids: Optional[Sequence[int]] = None, diagnoses: Optional[Sequence[str]] = None, exact: bool = False,
+                    gender: Optional[str] = None, age: Optional[Tuple[int, int]] = None, limit: Optional[int] = None) -> List[int]:
+        """Ids of the EMRs matching every given filter; diagnoses must all be present (exactly these with exact=True)"""
+        filters = dict(ids=ids, diagnoses=diagnoses, exact=exact, gender=gender, age=age)
+        return [row[0] for row in self._select("profiles", "id", "id", filters, limit)]
+
+    def profile(self, profile_id: int) -> Optional[Dict]:
+        row = self._conn().execute("SELECT record FROM profiles WHERE id = ?", (profile_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def iter_profiles(self, ids=None, diagnoses=None, exact=False, gender=None, age=None, limit=None) -> Iterator[Dict]:
+        """Matching EMRs in id order, decoded one at a time"""
+        filters = dict(ids=ids, diagnoses=diagnoses, exact=exact, gender=gender, age=age)
+        for (record,) in self._select("profiles", "record", "id", filters, limit):
+            yield json.loads(record)
+
+    def case(self, patient: str) -> Optional[Dict]:
+        row = self._conn().execute("SELECT record FROM cases WHERE patient = ?", (patient,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def iter_cases(self, ids=None, diagnoses=None, exact=False, gender=None, age=None, limit=None) -> Iterator[Dict]:
+        """Matching dialogue-ready cases in cases_ready.json order; ids are EMR ids, so one id selects all its experience combinations"""
+        filters = dict(ids=ids, diagnoses=diagnoses, exact=exact, gender=gender, age=age, id_column="profile_id")
+        for (record,) in self._select("cases", "record", "seq", filters, limit):
+            yield json.loads(record)
+
+    def diagnosis_combinations(self, table: str = "profiles") -> Dict[str, int]:
+        rows = self._conn().execute(f"SELECT disease_mask, COUNT(*) FROM {table} GROUP BY disease_mask ORDER BY COUNT(*) DESC").fetchall()
+        return {"，".join(d for i, d in enumerate(DISEASES) if mask & (1 << i)): count for mask, count in rows}
+
+
+def add_filter_arguments(parser):
+    """--patient-ids / --diagnosis / --exact-diagnosis / --gender / --age, shared by main.py and this CLI"""
+    parser.add_argument('--patient-ids', default=None, help="comma-separated EMR ids")
+    parser.add_argument('--diagnosis', default=None, help="comma-separated diagnoses that must all be present, e.g. 抑郁症,焦虑症")
+    parser.add_argument('--exact-diagnosis', action='store_true', help="with --diagnosis: exactly these diagnoses, no others")
+    parser.add_argument('--gender', default=None)
+    parser.add_argument('--age', default=None, help="age range LOW-HIGH; age bands overlapping it match")
+
+
+def filters_from_args(args) -> Dict:
+    return dict(
+        ids=[int(i) for i in args.patient_ids.split(",")] if args.patient_ids else None,
+        diagnoses=parse_diagnosis(args.diagnosis) if args.diagnosis else None,
+        exact=args.exact_diagnosis,
+        gender=args.gender,
+        age=parse_age_band(args.age) if args.age else None,
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Import EMRs into an indexed SQLite store, or count the EMRs matching a filter")
+    parser.add_argument('--db', default=EMR_DB_PATH)
+    parser.add_argument('--profiles', default=None, help=f"import a PsyCoProfile-style JSON (e.g. {PROFILE_PATH})")
+    parser.add_argument('--cases', default=None, help=f"import dialogue-ready cases (e.g. {CASES_PATH})")
+    add_filter_arguments(parser)
+    args = parser.parse_args()
+
+    if args.profiles or args.cases:
+        print("导入完成:", build_store(args.db, args.profiles, args.cases))
+    store = EMRStore(args.db)
+    filters = filters_from_args(args)
+    print("诊断组合:", store.diagnosis_combinations())
+    print(f"符合条件的病例 {len(store.profile_ids(**filters))} 个")
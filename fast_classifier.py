@@ -0,0 +1,259 @@
+import argparse
+import importlib
+import json
+import re
+import sys
+import threading
+import zlib
+from collections import namedtuple
+from typing import List, Optional, Tuple, Union
+
+THRESHOLD = 0.8   # local answers at least this confident skip the LLM classifier
+AUDIT_RATE = 0.05   # share of confident local answers still sent to the LLM to measure agreement
+FIRST_CLAUSE_WEIGHT = 2.0   # Chinese answers usually lead with their polarity: "没有，…" / "有的，…"
+CONTRAST_WEIGHT = 1.5   # clauses after 但是 / 不过 often take back the opening
+HEDGE_PENALTY = 1.0   # uncertainty mass added per hedge (偶尔, 好像, 说不清 …)
+PRIOR = 0.5   # uncertainty mass of every answer, so a lone cue cannot reach confidence 1
+
+NEG, SOFT_NEG, POS, NORMAL, HEDGE, CONTRAST, IGNORE = "neg", "soft_neg", "pos", "normal", "hedge", "contrast", "ignore"
+CUES = {}
+for kind, words in [
+    # negators; a negator before a POS cue in the same clause flips it, two cancel out ("没有不开心")
+    (NEG, ["不", "没", "没有", "不会", "不是", "从来没有", "从来没", "从没", "从不", "并没有", "并不", "一点也不", "完全没有",
+           "倒没有", "不怎么", "很少", "几乎没有", "基本没有", "没什么", "谈不上", "算不上", "未曾"]),
+    (SOFT_NEG, ["不太", "不是很", "不算", "不大"]),   # negate like NEG, but also count as a hedge
+    (POS, ["有", "是", "会", "对", "嗯", "确实", "的确", "经常", "总是", "总", "老是", "常常", "一直", "每天", "天天", "频繁",
+           "越来越", "都这样", "不停", "不断", "不少",
+           # symptom phrases that contain a negator but affirm the symptom
+           "睡不着", "睡不好", "睡不踏实", "开心不起来", "高兴不起来", "提不起", "不开心", "不想", "不舒服", "吃不下", "坐不住",
+           "静不下", "停不下", "控制不住", "忍不住", "止不住", "受不了", "不安", "不踏实", "不耐烦", "记不住", "集中不了",
+           "没精神", "没兴趣", "没意思", "没劲", "没胃口", "没动力", "无聊", "无法"]),
+    # "all is well": denies a symptom question, affirms a question about the normal state itself ("睡得好吗")
+    (NORMAL, ["好", "不错", "正常", "还行", "还可以", "没问题", "没什么问题", "没事", "没什么事"]),
+    (HEDGE, ["偶尔", "有时", "有时候", "好像", "可能", "也许", "似乎", "大概", "说不上", "说不清", "不确定", "不一定", "不清楚", "不知道",
+             "记不清", "一点点", "有一点", "有点", "有些", "还好", "一般"]),
+    (CONTRAST, ["但是", "但", "不过", "可是", "只是", "然而"]),
+    # echoed questions and words that only look like cues
+    (IGNORE, ["有没有", "是不是", "会不会", "对不对", "对于", "对方", "对象", "开会", "会议", "机会", "社会", "有人", "没关系",
+              "不管", "不论", "差不多", "倒是", "要不然", "不得不", "不然",
+              "好几", "好多", "好久", "好些", "只好", "最好", "正好", "刚好", "好处", "爱好", "好奇"]),
+]:
+    CUES.update((word, kind) for word in words)
+CUE_PATTERN = re.compile("|".join(map(re.escape, sorted(CUES, key=len, reverse=True))))   # longest cue wins at each position
+CLAUSE_SPLIT = re.compile(r"[，,。.!！？?；;…~\s]+")
+# question words that say nothing about the symptom asked, so a reply repeating them is no echo
+ECHO_IGNORE = re.compile("|".join(map(re.escape, sorted([
+    "最近", "平时", "现在", "以前", "之前", "这段时间", "时间", "时候", "感觉", "觉得", "认为", "自己", "情况", "这种", "那种",
+    "这些", "那些", "这样", "那样", "什么", "怎么样", "怎么", "一下", "事情", "比如", "例子", "大概", "多久"], key=len, reverse=True)))
+    + r"|[你我他她它的了吗呢吧么嘛过得着地在也都还就和跟]")
+
+# (doctor question, patient reply, expected local answer); None: below THRESHOLD, left to the LLM. Checked by --check.
+EXAMPLES = [
+    ("你最近心情怎么样，会不会经常觉得低落？", "我觉得我挺正常的。", False),
+    ("你晚上睡眠怎么样？", "睡得挺好的。", False),
+    ("你晚上能睡好吗？", "睡得挺好的，一觉到天亮。", True),
+    ("你最近情绪低落吗？", "心情不好，每天都提不起劲。", True),
+    ("你最近会心慌吗？", "心慌，特别是晚上。", True),
+    ("你最近会心慌吗？", "心慌倒是没有。", False),
+    ("你有没有过伤害自己的想法？", "没有，从来没有过。", False),
+    ("这种情况大概持续多久了，有两周以上吗？", "差不多有一个多月了吧，越来越明显。", True),
+    ("你做事情的时候容易分心吗？", "还好吧，偶尔会。", None),
+]
+
+Verdict = namedtuple("Verdict", ["answer", "confidence", "use_llm", "audit"])
+
+
+def split_dialogue(input_sentence: Union[str, List[str]]) -> Tuple[str, str]:
+    """(doctor question, patient reply) of the dialogue_history[-2:] window the classifier is given"""
+    if isinstance(input_sentence, str):
+        return "", input_sentence
+    question, reply = "", ""
+    for line in input_sentence:
+        if line.startswith("患者："):
+            reply = line[len("患者："):]
+        elif line.startswith("医生："):
+            question = line[len("医生："):]
+    return question, reply
+
+
+class LexiconClassifier:
+    """Yes/no from cue words with clause-level negation scope; no model, microseconds per answer"""
+
+    def clause_polarity(self, clause: str, normal: int = -1, echoes=()) -> Tuple[int, int, bool]:
+        """(+1 / -1 / 0, hedges, contrast) of one clause; `normal` is the polarity of a NORMAL cue, `echoes` the words of the asked symptom"""
+        negations, polarity, hedges, contrast = 0, 0, 0, False
+        for match in CUE_PATTERN.finditer(clause):
+            kind = CUES[match.group()]
+            if kind in (NEG, SOFT_NEG):
+                negations += 1
+                hedges += kind == SOFT_NEG
+            elif kind in (POS, NORMAL) and not polarity:
+                polarity = 1 if kind == POS else normal
+                polarity = -polarity if negations % 2 else polarity
+            elif kind == HEDGE:
+                hedges += 1
+            elif kind == CONTRAST:
+                contrast = True
+        if not polarity and negations:
+            polarity = -1 if negations % 2 else 1
+        elif not polarity and any(echo in clause for echo in echoes):   # "心慌，…" repeats the symptom asked about
+            polarity = 1
+        return polarity, hedges, contrast
+
+    def question_normal(self, question: str) -> int:
+        """+1 if the question asks about the normal state itself ("睡得好吗", "好不好"), else -1"""
+        for clause in CLAUSE_SPLIT.split(question):
+            negations = 0
+            for match in CUE_PATTERN.finditer(clause):
+                kind = CUES[match.group()]
+                if kind == NORMAL:
+                    return -1 if negations % 2 else 1
+                negations += kind in (NEG, SOFT_NEG)
+        return -1
+
+    def echoes(self, question: str, reply: str) -> List[str]:
+        """Two-character words of the question, cue and filler words aside, that the reply repeats"""
+        words = ECHO_IGNORE.sub(" ", CUE_PATTERN.sub(" ", question))
+        return [fragment[i:i + 2] for fragment in CLAUSE_SPLIT.split(words) for i in range(len(fragment) - 1)
+                if fragment[i:i + 2] in reply]
+
+    def predict(self, question: str, reply: str) -> Tuple[Optional[bool], float]:
+        support = {1: 0.0, -1: 0.0}
+        uncertainty = PRIOR
+        later_weight = 1.0
+        normal, echoes = self.question_normal(question), self.echoes(question, reply)
+        for index, clause in enumerate(clause for clause in CLAUSE_SPLIT.split(reply) if clause):
+            polarity, hedges, contrast = self.clause_polarity(clause, normal, echoes)
+            if contrast:
+                later_weight = CONTRAST_WEIGHT
+            if polarity:
+                support[polarity] += FIRST_CLAUSE_WEIGHT if index == 0 else later_weight
+            uncertainty += hedges * HEDGE_PENALTY
+        if support[1] == support[-1]:
+            return None, 0.0
+        sign = 1 if support[1] > support[-1] else -1
+        return sign > 0, support[sign] / (support[1] + support[-1] + uncertainty)
+
+
+def load_predictor(spec: str = "lexicon"):
+    """'lexicon', or 'module:factory' returning an object with predict(question, reply) -> (answer or None, confidence)"""
+    if spec == "lexicon":
+        return LexiconClassifier()
+    module_name, _, factory = spec.partition(":")
+    if not factory:
+        raise ValueError(f"本地分类器应为 lexicon 或 module:factory，收到 {spec}")
+    return getattr(importlib.import_module(module_name), factory)()
+
+
+class FastPath:
+    """Answers the HDSM yes/no classification locally when the predictor is confident enough.
+
+    Below `threshold` the LLM classifier decides. A deterministic `audit_rate` share of the confident
+    answers (picked by a hash of the dialogue window, so reruns audit the same turns) is sent to the LLM
+    as well; the local answer is still used, the LLM answer only feeds the agreement statistics.
+    """
+
+    def __init__(self, predictor=None, threshold: float = THRESHOLD, audit_rate: float = AUDIT_RATE) -> None:
+        self.predictor = predictor or LexiconClassifier()
+        self.threshold = threshold
+        self.audit_rate = audit_rate
+        self.stats = {"calls": 0, "local": 0, "escalated": 0, "audited": 0, "audit_agree": 0, "escalated_agree": 0}
+        self._lock = threading.Lock()
+
+    def _count(self, key: str) -> None:
+        with self._lock:
+            self.stats[key] += 1
+
+    def confident(self, input_sentence) -> bool:
+        """Whether classify() would answer locally (audits aside), without counting it"""
+        answer, confidence = self.predictor.predict(*split_dialogue(input_sentence))
+        return answer is not None and confidence >= self.threshold
+
+    def classify(self, input_sentence) -> Verdict:
+        answer, confidence = self.predictor.predict(*split_dialogue(input_sentence))
+        self._count("calls")
+        if answer is None or confidence < self.threshold:
+            self._count("escalated")
+            return Verdict(answer, confidence, True, False)
+        text = json.dumps(input_sentence, ensure_ascii=False)
+        audit = zlib.crc32(text.encode("utf-8")) % 10000 < self.audit_rate * 10000
+        self._count("audited" if audit else "local")
+        return Verdict(answer, confidence, audit, audit)
+
+    def settle(self, verdict: Verdict, llm_answer: bool) -> bool:
+        """Answer to use once the LLM has answered a verdict with use_llm set"""
+        if verdict.audit:
+            if verdict.answer == llm_answer:
+                self._count("audit_agree")
+            return verdict.answer
+        if verdict.answer == llm_answer:
+            self._count("escalated_agree")
+        return llm_answer
+
+    def summary(self) -> dict:
+        with self._lock:
+            stats = dict(self.stats)
+        calls = stats["calls"]
+        return dict(stats,
+                    llm_calls_saved=stats["local"] / calls if calls else 0.0,
+                    audit_agreement=stats["audit_agree"] / stats["audited"] if stats["audited"] else None,
+                    escalated_agreement=stats["escalated_agree"] / stats["escalated"] if stats["escalated"] else None)
+
+
+def journal_examples(path: str):
+    """(dialogue window, LLM answer) pairs from the turn and transition events of a journal.py journal"""
+    windows = {}
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                event = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if event.get("type") == "turn":
+                prefix = "医生：" if event["speaker"] == "doctor" else "患者："
+                windows[event["dialogue"]] = (windows.get(event["dialogue"], []) + [prefix + event["text"]])[-2:]
+            elif event.get("type") == "transition" and event["dialogue"] in windows:
+                yield windows[event["dialogue"]], bool(event["answer"])
+
+
+def evaluate(predictor, examples, thresholds=(0.6, 0.7, 0.8, 0.9)):
+    """Coverage (answered locally) and agreement with the LLM labels at each threshold"""
+    scored = [(predictor.predict(*split_dialogue(window)), label) for window, label in examples]
+    report = {}
+    for threshold in thresholds:
+        confident = [(answer, label) for (answer, confidence), label in scored if answer is not None and confidence >= threshold]
+        report[threshold] = {"coverage": len(confident) / len(scored) if scored else 0.0,
+                             "agreement": sum(answer == label for answer, label in confident) / len(confident) if confident else None}
+    return len(scored), report
+
+
+def check_examples(predictor, threshold=THRESHOLD):
+    """EXAMPLES the predictor answers differently: (question, reply, expected, answer, confidence)"""
+    failures = []
+    for question, reply, expected in EXAMPLES:
+        answer, confidence = predictor.predict(question, reply)
+        if (answer if answer is not None and confidence >= threshold else None) != expected:
+            failures.append((question, reply, expected, answer, confidence))
+    return failures
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check the local yes/no classifier against the LLM answers of a journaled run")
+    parser.add_argument('journal', nargs='?', help="journal.py journal of a run without --fast-classifier (its transitions carry the LLM answers)")
+    parser.add_argument('--predictor', default="lexicon", help="lexicon or module:factory")
+    parser.add_argument('--check', action='store_true', help="check the predictor against the pinned EXAMPLES instead")
+    args = parser.parse_args()
+
+    if args.check:
+        failures = check_examples(load_predictor(args.predictor))
+        for question, reply, expected, answer, confidence in failures:
+            print(f"{question} / {reply}: 应为 {expected}，得到 {answer} ({confidence:.2f})")
+        print(f"{len(EXAMPLES) - len(failures)}/{len(EXAMPLES)} 个样例通过")
+        sys.exit(1 if failures else 0)
+    if args.journal is None:
+        parser.error("需要 journal 文件或 --check")
+    count, report = evaluate(load_predictor(args.predictor), list(journal_examples(args.journal)))
+    print(f"{count} 个带标签的状态转移")
+    for threshold, row in report.items():
+        agreement = "-" if row['agreement'] is None else f"{row['agreement']:.1%}"
+        print(f"阈值 {threshold}: 本地回答 {row['coverage']:.1%}，与 LLM 一致 {agreement}")
@@ -0,0 +1,308 @@
+import argparse
+import json
+from collections import namedtuple
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+import rule_graph
+
+MACHINE_PATH = "prompts/diagstatemachine"
+TOPIC_ORDER_PATH = "prompts/diagstatemachine/topic_order_dict.json"
+P_YES = 0.5   # chance a virtual patient answers a question "yes", unless --answers overrides it
+PROBE_RATE = 0.0   # share of api_if_parse calls that ask a follow-up; 0 counts the HDSM questions only
+MAX_PROBES = 4   # follow-ups per topic, the parse_number cap of main.run_conversation
+MAX_STEPS = 200   # transitions after which a virtual patient counts as stuck in a cycle
+CHUNK_SIZE = 65536   # virtual patients per answer matrix (chunk x questions bytes)
+NO_EDGE, STUCK = -1, -2   # terminal codes of patients that hit a missing transition / MAX_STEPS
+
+Path = namedtuple("Path", ["terminal", "steps", "classifications", "probability"])   # steps: ((group, state), answer or None for a cross jump)
+
+
+class CompiledMachine:
+    """The rule graph as NumPy arrays, plus one answer column per screening question.
+
+    Column i < len(graph.nodes) is node i; subgroup questions without a rule of their own get extra
+    columns, so every question a patient can be asked has exactly one column of the answer matrix.
+    """
+
+    def __init__(self, graph: rule_graph.RuleGraph) -> None:
+        self.graph = graph
+        size = len(graph.nodes)
+        self.columns: List[Tuple[str, str]] = list(graph.nodes)
+        column_index = dict(graph.index)
+        self.next = np.full((size, 2), NO_EDGE, dtype=np.int32)   # next[node, is_yes]
+        self.cross = np.full(size, NO_EDGE, dtype=np.int32)
+        self.owner = np.zeros(size, dtype=bool)   # entering the node starts a screening subgroup
+        self.terminal = np.zeros(size, dtype=bool)
+        self.terminal[list(graph.terminals)] = True
+        self.members: Dict[int, np.ndarray] = {}   # owner node -> answer columns of its questions
+        self.threshold: Dict[int, int] = {}
+        for node in range(size):
+            for is_yes, edge in enumerate(graph.edges[node]):
+                if edge is not None:
+                    self.next[node, is_yes] = edge.target
+            if graph.cross[node] is not None:
+                self.cross[node] = graph.cross[node].target
+            if graph.subgroup[node] is not None:
+                subgroup = graph.subgroups[graph.subgroup[node]]
+                group = graph.nodes[node][0]
+                columns = []
+                for state in subgroup.states:
+                    if (group, state) not in column_index:
+                        column_index[(group, state)] = len(self.columns)
+                        self.columns.append((group, state))
+                    columns.append(column_index[(group, state)])
+                self.owner[node] = True
+                self.members[node] = np.array(columns, dtype=np.int32)
+                self.threshold[node] = subgroup.threshold
+        self.column_index = column_index
+
+    def p_yes(self, default: float = P_YES, overrides: Optional[Dict[str, float]] = None) -> np.ndarray:
+        """Per-column yes probability; overrides are keyed "group:state" like crossgroup_rules.json"""
+        p = np.full(len(self.columns), default, dtype=np.float32)
+        for key, value in (overrides or {}).items():
+            group, state = key.split(':')
+            if (group, state) not in self.column_index:
+                raise ValueError(f"回答概率 {key} 不是规则中的问题")
+            p[self.column_index[(group, state)]] = value
+        return p
+
+
+def _draw_probes(rng, remaining: np.ndarray, probe_rate: float) -> np.ndarray:
+    """Follow-ups asked before one classification: consecutive "ask more" parses, capped per topic"""
+    if probe_rate <= 0:
+        return np.zeros_like(remaining)
+    if probe_rate >= 1:
+        return remaining.copy()
+    return np.minimum(rng.geometric(1 - probe_rate, remaining.size) - 1, remaining).astype(remaining.dtype)
+
+
+def simulate_chunk(machine: CompiledMachine, entry: int, answers: np.ndarray, rng, probe_rate: float = PROBE_RATE):
+    """Runs one HDSM topic for every row of `answers` (patients x columns, bool) at once.
+
+    Mirrors HierarchicalStateMachine.get_next_state: a cross rule of the current state fires before its
+    normal transition (the answer is still classified, then ignored); entering a subgroup owner asks all of
+    its questions, one classification each, and takes its Y edge when at least `threshold` were answered
+    "yes". Every classification is followed by a doctor/patient turn unless it reached a diagnosis, and
+    the entry question is a turn too, so turns = classifications + follow-ups.
+    Returns (terminal node or NO_EDGE / STUCK, classifications, follow-ups) per patient.
+    """
+    n = answers.shape[0]
+    node = np.full(n, entry, dtype=np.int32)
+    in_subgroup = np.zeros(n, dtype=bool)   # the entry state itself is asked like a normal state
+    classifications = np.zeros(n, dtype=np.int32)
+    probes = np.zeros(n, dtype=np.int32)
+    terminal = np.full(n, STUCK, dtype=np.int32)
+    active = np.arange(n)
+    for _ in range(MAX_STEPS):
+        if not active.size:
+            break
+        current = node[active]
+        target = np.empty(active.size, dtype=np.int32)
+        screening = in_subgroup[active]
+
+        normal = np.flatnonzero(~screening)
+        rows, states = active[normal], current[normal]
+        classifications[rows] += 1
+        probes[rows] += _draw_probes(rng, MAX_PROBES - probes[rows], probe_rate)
+        cross = machine.cross[states]
+        target[normal] = np.where(cross != NO_EDGE, cross, machine.next[states, answers[rows, states].astype(np.intp)])
+        jumped = np.zeros(active.size, dtype=bool)
+        jumped[normal] = cross != NO_EDGE
+
+        for owner in np.unique(current[screening]):
+            group = np.flatnonzero(screening & (current == owner))
+            rows, columns = active[group], machine.members[owner]
+            classifications[rows] += columns.size
+            for _ in range(columns.size):
+                probes[rows] += _draw_probes(rng, MAX_PROBES - probes[rows], probe_rate)
+            is_yes = answers[np.ix_(rows, columns)].sum(axis=1) >= machine.threshold[owner]
+            target[group] = machine.next[owner, is_yes.astype(np.intp)]
+
+        dead = target == NO_EDGE
+        terminal[active[dead]] = NO_EDGE
+        live = ~dead
+        done = live.copy()
+        done[live] = machine.terminal[target[live]]
+        terminal[active[done]] = target[done]
+        moving = live & ~done
+        node[active[moving]] = target[moving]
+        in_subgroup[active[moving]] = machine.owner[target[moving]] & ~jumped[moving]   # a cross jump lands on the state itself
+        active = active[moving]
+    return terminal, classifications, probes
+
+
+class Simulation:
+    """Per-topic outcomes of a batch of virtual patients; every patient runs all topics, like one dialogue"""
+
+    def __init__(self, machine: CompiledMachine, entries: Dict[str, int]) -> None:
+        self.machine = machine
+        self.entries = entries
+        self.results: Dict[str, List[Tuple[np.ndarray, np.ndarray, np.ndarray]]] = {topic: [] for topic in entries}
+
+    def run(self, patients: int, p_yes: np.ndarray, probe_rate: float = PROBE_RATE, seed: Optional[int] = None,
+            chunk_size: int = CHUNK_SIZE) -> "Simulation":
+        rng = np.random.default_rng(seed)
+        for start in range(0, patients, chunk_size):
+            n = min(chunk_size, patients - start)
+            answers = rng.random((n, p_yes.size), dtype=np.float32) < p_yes
+            for topic, entry in self.entries.items():
+                self.results[topic].append(simulate_chunk(self.machine, entry, answers, rng, probe_rate))
+        return self
+
+    def _arrays(self, topic):
+        return tuple(np.concatenate(parts) for parts in zip(*self.results[topic]))
+
+    def summary(self, fused: bool = False) -> Dict:
+        """Turn, classifier-call and LLM-call distributions per topic, per diagnosis reached and per dialogue.
+
+        Classifier calls are api_if_parse + api_response_classification (one api_turn_judgement per
+        question and follow-up with fused=True); LLM calls add the doctor and patient call of every turn.
+        Only the HDSM phase is counted, not the opening, context and closing turns.
+        """
+        report = {"topics": {}, "dialogue": None}
+        totals = None
+        for topic in self.entries:
+            terminal, classifications, probes = self._arrays(topic)
+            turns = classifications + probes
+            classifier_calls = turns if fused else turns + classifications
+            llm_calls = 2 * turns + classifier_calls
+            if totals is None:
+                totals = [np.zeros_like(turns) for _ in range(3)]
+            for total, values in zip(totals, (turns, classifier_calls, llm_calls)):
+                total += values
+            diagnoses = {}
+            for code in np.unique(terminal):
+                mask = terminal == code
+                name = {NO_EDGE: "<no transition>", STUCK: "<stuck>"}.get(int(code)) or self.machine.graph.nodes[code][1]
+                diagnoses[name] = dict(share=float(mask.mean()), **_distributions(turns[mask], classifier_calls[mask], llm_calls[mask]))
+            report["topics"][topic] = dict(_distributions(turns, classifier_calls, llm_calls), diagnoses=diagnoses)
+        if totals is not None:
+            report["dialogue"] = _distributions(*totals)
+        return report
+
+
+def _describe(values: np.ndarray) -> Dict:
+    p50, p90, p99 = np.percentile(values, [50, 90, 99])
+    return {"mean": float(values.mean()), "p50": float(p50), "p90": float(p90), "p99": float(p99),
+            "min": int(values.min()), "max": int(values.max())}
+
+
+def _distributions(turns, classifier_calls, llm_calls) -> Dict:
+    return {"patients": int(turns.size), "turns": _describe(turns), "classifier_calls": _describe(classifier_calls),
+            "llm_calls": _describe(llm_calls)}
+
+
+def _at_least(probabilities: np.ndarray, threshold: int) -> float:
+    """P(at least `threshold` yes answers) for independent questions (Poisson binomial)"""
+    counts = np.zeros(probabilities.size + 1)
+    counts[0] = 1.0
+    for p in probabilities:
+        counts[1:] = counts[1:] * (1 - p) + counts[:-1] * p
+        counts[0] *= 1 - p
+    return float(counts[threshold:].sum())
+
+
+def enumerate_paths(machine: CompiledMachine, entry: int, p_yes: np.ndarray) -> Tuple[List[Path], int, int]:
+    """Every reachable path from `entry` to a diagnosis, with its probability under p_yes.
+
+    A subgroup is one step whose answer is whether the threshold was reached. Probabilities treat every
+    question as answered independently; branches that would revisit a state on the current path (an
+    endless loop for a patient who answers consistently) and missing transitions are counted, not followed.
+    Returns (paths, cycles, dead ends).
+    """
+    paths, cycles, dead_ends = [], 0, 0
+    stack = [(entry, False, (), frozenset([(entry, False)]), 0, 1.0)]
+    while stack:
+        node, screening, steps, visited, classifications, probability = stack.pop()
+        name = machine.graph.nodes[node]
+        if screening:
+            columns = machine.members[node]
+            branches = [(int(machine.next[node, is_yes]), is_yes, False, classifications + columns.size) for is_yes in (0, 1)]
+            p = _at_least(p_yes[columns], machine.threshold[node])
+        elif machine.cross[node] != NO_EDGE:
+            branches = [(int(machine.cross[node]), None, True, classifications + 1)]
+            p = None
+        else:
+            branches = [(int(machine.next[node, is_yes]), is_yes, False, classifications + 1) for is_yes in (0, 1)]
+            p = float(p_yes[node])
+        for target, is_yes, jumped, count in reversed(branches):
+            branch_probability = probability if is_yes is None else probability * (p if is_yes else 1 - p)
+            step = (name, None if is_yes is None else bool(is_yes))
+            if target == NO_EDGE:
+                dead_ends += 1
+                continue
+            if machine.terminal[target]:
+                paths.append(Path(machine.graph.nodes[target][1], steps + (step,), count, branch_probability))
+                continue
+            entering = bool(machine.owner[target]) and not jumped
+            if (target, entering) in visited:
+                cycles += 1
+                continue
+            stack.append((target, entering, steps + (step,), visited | {(target, entering)}, count, branch_probability))
+    return paths, cycles, dead_ends
+
+
+def load_machine(folder: str = MACHINE_PATH, topic_order_path: str = TOPIC_ORDER_PATH) -> Tuple[CompiledMachine, Dict[str, int]]:
+    machine = CompiledMachine(rule_graph.load_rule_graph(folder))
+    with open(topic_order_path, 'r', encoding='utf-8') as f:
+        entries = {topic: machine.graph.node(*entry) for topic, entry in json.load(f).items()}
+    return machine, entries
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Forecast HDSM turns and classifier calls with virtual patients, and list every path to a diagnosis")
+    parser.add_argument('--patients', type=int, default=100000, help="virtual patients; each runs every topic")
+    parser.add_argument('--p-yes', type=float, default=P_YES, help="chance of a yes answer to any question")
+    parser.add_argument('--answers', default=None, help='JSON {"group:state": p_yes} overriding --p-yes per question')
+    parser.add_argument('--probe-rate', type=float, default=PROBE_RATE, help="share of api_if_parse calls that ask a follow-up question")
+    parser.add_argument('--fused', action='store_true', help="count one api_turn_judgement per question instead of two classifier calls (main.FUSED_JUDGEMENT)")
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--machine-path', default=MACHINE_PATH)
+    parser.add_argument('--paths', action='store_true', help="also print every path to a diagnosis")
+    parser.add_argument('--output', default=None, help="write the JSON report here")
+    args = parser.parse_args()
+
+    machine, entries = load_machine(args.machine_path)
+    overrides = None
+    if args.answers:
+        with open(args.answers, 'r', encoding='utf-8') as f:
+            overrides = json.load(f)
+    p_yes = machine.p_yes(args.p_yes, overrides)
+
+    report = Simulation(machine, entries).run(args.patients, p_yes, args.probe_rate, args.seed).summary(args.fused)
+    report["paths"] = {}
+    for topic, entry in entries.items():
+        paths, cycles, dead_ends = enumerate_paths(machine, entry, p_yes)
+        by_diagnosis = {}
+        for path in paths:
+            row = by_diagnosis.setdefault(path.terminal, {"paths": 0, "probability": 0.0, "min_classifications": None, "max_classifications": 0})
+            row["paths"] += 1
+            row["probability"] += path.probability
+            row["min_classifications"] = min(row["min_classifications"] or path.classifications, path.classifications)
+            row["max_classifications"] = max(row["max_classifications"], path.classifications)
+        report["paths"][topic] = {"diagnoses": by_diagnosis, "cycles": cycles, "dead_ends": dead_ends}
+
+        stats = report["topics"][topic]
+        print(f"{topic}（{'.'.join(machine.graph.nodes[entry])}）: 轮次 均值 {stats['turns']['mean']:.1f} / p90 {stats['turns']['p90']:.0f} / 最多 {stats['turns']['max']}，"
+              f"分类调用 均值 {stats['classifier_calls']['mean']:.1f}，路径 {len(paths)} 条，环 {cycles}，缺失转移 {dead_ends}")
+        for name, row in sorted(stats["diagnoses"].items(), key=lambda item: -item[1]["share"]):
+            expected = by_diagnosis.get(name, {}).get("probability")
+            expected = "-" if expected is None else f"{expected:.1%}"
+            print(f"  {name:<16} 模拟 {row['share']:>6.1%}  路径概率 {expected:>6}  轮次 均值 {row['turns']['mean']:.1f} p90 {row['turns']['p90']:.0f}")
+        if args.paths:
+            for path in paths:
+                route = " -> ".join(f"{group}.{state}" + ("" if answer is None else "YN"[not answer]) for (group, state), answer in path.steps)
+                print(f"    {path.terminal}  p={path.probability:.4f}  分类 {path.classifications}: {route}")
+    dialogue = report["dialogue"]
+    print(f"每次对话（HDSM 部分）: 轮次 均值 {dialogue['turns']['mean']:.1f} / p99 {dialogue['turns']['p99']:.0f}，"
+          f"LLM 调用 均值 {dialogue['llm_calls']['mean']:.1f} / p99 {dialogue['llm_calls']['p99']:.0f}")
+    unreached = sorted(set(machine.graph.nodes[t][1] for t in machine.graph.terminals)
+                       - {name for row in report["paths"].values() for name in row["diagnoses"]})
+    if unreached:
+        print("无路径可达的诊断:", "、".join(unreached))
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
@@ -0,0 +1,202 @@
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, List, Optional
+
+LEASE_SECONDS = 1800   # a dialogue that has not renewed its lease for this long is handed to another worker
+MAX_ATTEMPTS = 3
+
+
+class Job:
+    def __init__(self, row) -> None:
+        self.job_id = row["job_id"]
+        self.patient = row["patient"]
+        self.combination = row["combination"]
+        self.conv_index = row["conv_index"]
+        self.attempts = row["attempts"]
+        self.worker = row["worker"]
+
+    def __repr__(self) -> str:
+        return f"Job({self.job_id}, attempt={self.attempts})"
+
+
+class JobQueue:
+    """Persistent (patient, experience combination, conversation index) work queue with time-limited leases.
+
+    Backed by one SQLite file, so any number of worker processes can share it. Across machines the file has
+    to live on a filesystem with working POSIX locks (NFSv4 / Lustre with flock), otherwise use one queue per node.
+    """
+
+    def __init__(self, path: str, lease_seconds: float = LEASE_SECONDS, max_attempts: int = MAX_ATTEMPTS) -> None:
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        conn = self._connect()
+        try:
+            conn.executescript("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    job_id TEXT PRIMARY KEY,
+                    patient TEXT NOT NULL,
+                    combination TEXT NOT NULL,
+                    conv_index INTEGER NOT NULL,
+                    status TEXT NOT NULL DEFAULT 'pending',
+                    worker TEXT,
+                    lease_expires REAL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    cost REAL,
+                    result TEXT,
+                    error TEXT,
+                    updated REAL
+                );
+                CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, lease_expires);
+                CREATE INDEX IF NOT EXISTS jobs_patient ON jobs (patient, conv_index);
+                CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+            """)
+        finally:
+            conn.close()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        return conn
+
+    @contextmanager
+    def _transaction(self):
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            yield conn
+            conn.execute("COMMIT")
+        except BaseException:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
+
+    def set_meta(self, key: str, value) -> None:
+        with self._transaction() as conn:
+            conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, json.dumps(value, ensure_ascii=False)))
+
+    def get_meta(self, key: str, default=None):
+        with self._transaction() as conn:
+            row = conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return json.loads(row["value"]) if row else default
+
+    def enqueue(self, patient_info: List[Dict], num: int) -> int:
+        """Add one job per patient template and conversation index; jobs already in the queue are kept"""
+        now = time.time()
+        rows = []
+        for patient_template in patient_info:
+            patient = patient_template['患者']
+            combination = "com" + patient.split("com", 1)[1]
+            for i in range(num):
+                rows.append((f"{patient}#{i}", patient, combination, i, now))
+        with self._transaction() as conn:
+            before = conn.total_changes
+            conn.executemany("INSERT OR IGNORE INTO jobs (job_id, patient, combination, conv_index, updated) VALUES (?, ?, ?, ?, ?)", rows)
+            return conn.total_changes - before
+
+    def _requeue_expired(self, conn, now: float) -> None:
+        conn.execute("UPDATE jobs SET status = 'pending', worker = NULL, lease_expires = NULL, updated = ? "
+                     "WHERE status = 'leased' AND lease_expires < ? AND attempts < ?", (now, now, self.max_attempts))
+        conn.execute("UPDATE jobs SET status = 'failed', error = 'lease expired', updated = ? "
+                     "WHERE status = 'leased' AND lease_expires < ? AND attempts >= ?", (now, now, self.max_attempts))
+
+    def lease(self, worker_id: str) -> Optional[Job]:
+        now = time.time()
+        with self._transaction() as conn:
+            self._requeue_expired(conn, now)
+            row = conn.execute("SELECT job_id FROM jobs WHERE status = 'pending' ORDER BY patient, conv_index LIMIT 1").fetchone()
+            if row is None:
+                return None
+            conn.execute("UPDATE jobs SET status = 'leased', worker = ?, lease_expires = ?, attempts = attempts + 1, updated = ? WHERE job_id = ?",
+                         (worker_id, now + self.lease_seconds, now, row["job_id"]))
+            return Job(conn.execute("SELECT * FROM jobs WHERE job_id = ?", (row["job_id"],)).fetchone())
+
+    def renew(self, job: Job) -> bool:
+        """Extend the lease; False means it expired and the job now belongs to someone else"""
+        now = time.time()
+        with self._transaction() as conn:
+            cur = conn.execute("UPDATE jobs SET lease_expires = ?, updated = ? WHERE job_id = ? AND status = 'leased' AND worker = ?",
+                               (now + self.lease_seconds, now, job.job_id, job.worker))
+            return cur.rowcount == 1
+
+    @contextmanager
+    def keep_alive(self, job: Job):
+        """Renew the lease from a background thread while the job runs (works for blocking and asyncio workers)"""
+        stop = threading.Event()
+
+        def heartbeat():
+            while not stop.wait(self.lease_seconds / 3):
+                if not self.renew(job):
+                    return
+
+        thread = threading.Thread(target=heartbeat, daemon=True)
+        thread.start()
+        try:
+            yield
+        finally:
+            stop.set()
+            thread.join()
+
+    def complete(self, job: Job, result, cost: float = 0) -> Optional[List]:
+        """Record a finished job; returns the patient's ordered results once all of its jobs are finished.
+
+        A result of None means the dialogue ended with an undiagnosed disorder; later conversations of the
+        same patient are skipped, mirroring the `break` of the sequential loop.
+        """
+        now = time.time()
+        with self._transaction() as conn:
+            cur = conn.execute("UPDATE jobs SET status = 'done', result = ?, cost = ?, lease_expires = NULL, updated = ? "
+                               "WHERE job_id = ? AND status = 'leased' AND worker = ?",
+                               (json.dumps(result, ensure_ascii=False), cost, now, job.job_id, job.worker))
+            if cur.rowcount != 1:
+                print(f"任务 {job.job_id} 的租约已失效，结果被丢弃")
+                return None
+            if result is None:
+                conn.execute("UPDATE jobs SET status = 'skipped', updated = ? WHERE patient = ? AND conv_index > ? AND status = 'pending'",
+                             (now, job.patient, job.conv_index))
+            rows = conn.execute("SELECT status, result FROM jobs WHERE patient = ? ORDER BY conv_index", (job.patient,)).fetchall()
+            if any(row["status"] not in ("done", "skipped") for row in rows):
+                return None
+        results = []
+        for row in rows:
+            record = json.loads(row["result"]) if row["status"] == "done" else None
+            if record is None:
+                break
+            results.append(record)
+        return results
+
+    def fail(self, job: Job, error: str) -> None:
+        """Give the job back after an exception; it is retried until max_attempts, then kept as 'failed' (see requeue_failed)"""
+        now = time.time()
+        with self._transaction() as conn:
+            conn.execute("UPDATE jobs SET status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, "
+                         "worker = NULL, lease_expires = NULL, error = ?, updated = ? WHERE job_id = ? AND status = 'leased' AND worker = ?",
+                         (self.max_attempts, error, now, job.job_id, job.worker))
+
+    def requeue_failed(self) -> int:
+        with self._transaction() as conn:
+            cur = conn.execute("UPDATE jobs SET status = 'pending', attempts = 0, error = NULL, updated = ? WHERE status = 'failed'", (time.time(),))
+            return cur.rowcount
+
+    def stats(self) -> Dict[str, int]:
+        with self._transaction() as conn:
+            rows = conn.execute("SELECT status, COUNT(*) AS n FROM jobs GROUP BY status").fetchall()
+        return {row["status"]: row["n"] for row in rows}
+
+    def total_cost(self) -> float:
+        with self._transaction() as conn:
+            row = conn.execute("SELECT COALESCE(SUM(cost), 0) AS cost FROM jobs WHERE status = 'done'").fetchone()
+        return row["cost"]
+
+
+def default_worker_id() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}"
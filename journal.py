@@ -0,0 +1,139 @@
+import contextvars
+import json
+import os
+import threading
+import time
+from typing import Dict, Optional
+
+from openai.types.chat import ChatCompletion
+
+_current_recorder = contextvars.ContextVar("current_recorder", default=None)
+
+
+def current_recorder():
+    """Recorder of the dialogue running in this thread / asyncio task, if any"""
+    return _current_recorder.get()
+
+
+def set_recorder(recorder):
+    return _current_recorder.set(recorder)
+
+
+def reset_recorder(token):
+    _current_recorder.reset(token)
+
+
+class Journal:
+    """Append-only JSONL journal of a generation run, fsynced after every event.
+
+    Event types: run_start (shared topic order list), dialogue_start (seed), llm (one provider call with
+    its response), turn, transition (yes/no answer, its confidence if known, new state), cost (dialogue cost delta, classifier calls included), dialogue_done (the finished
+    record), dialogue_streamed (record appended to the JSONL shards) and patient_done.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._lock = threading.Lock()
+        self._file = open(path, 'a', encoding='utf-8')
+
+    def write(self, event_type: str, **data) -> None:
+        line = json.dumps({"type": event_type, "time": time.time(), **data}, ensure_ascii=False)
+        with self._lock:
+            self._file.write(line + "\n")
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+    def close(self) -> None:
+        self._file.close()
+
+
+class JournalState:
+    """What a previous (possibly crashed) run left in the journal"""
+
+    def __init__(self) -> None:
+        self.order_list = None
+        self.finished_patients = set()
+        self.finished_dialogues: Dict[str, Dict] = {}   # dialogue key -> {"record", "cost"}
+        self.streamed_dialogues = set()
+        self.seeds: Dict[str, object] = {}   # dialogue key -> random.Random seed
+        self.calls: Dict[str, Dict[int, Dict]] = {}   # dialogue key -> seq -> llm event
+
+    def pending_calls(self, dialogue):
+        calls = self.calls.get(dialogue, {})
+        replay = []
+        for seq in range(len(calls)):
+            if seq not in calls:
+                break
+            replay.append(calls[seq])
+        return replay
+
+
+def load_journal(path: str) -> JournalState:
+    state = JournalState()
+    if not os.path.exists(path):
+        return state
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                event = json.loads(line)
+            except json.JSONDecodeError:   # torn last line of a crashed run
+                continue
+            event_type = event.get("type")
+            if event_type == "run_start":
+                state.order_list = state.order_list or event["order_list"]
+            elif event_type == "dialogue_start":
+                state.seeds.setdefault(event["dialogue"], event["seed"])
+            elif event_type == "llm":
+                state.calls.setdefault(event["dialogue"], {})[event["seq"]] = event
+            elif event_type == "dialogue_done":
+                state.finished_dialogues[event["dialogue"]] = {"record": event["record"], "cost": event["cost"]}
+            elif event_type == "dialogue_streamed":
+                state.streamed_dialogues.add(event["dialogue"])
+            elif event_type == "patient_done":
+                state.finished_patients.add(event["patient"])
+    return state
+
+
+class DialogueRecorder:
+    """Journals every LLM call of one dialogue and, on resume, answers the already-paid calls from the journal"""
+
+    def __init__(self, journal: Optional[Journal], dialogue: str, replay=None) -> None:
+        self.journal = journal
+        self.dialogue = dialogue
+        self.replay_calls = list(replay or [])
+        self.seq = 0
+        self.replayed = 0
+        self.last_cost = 0
+
+    @property
+    def replaying(self) -> bool:
+        return self.seq < len(self.replay_calls)
+
+    def replay(self, role: str, request: Dict) -> Optional[ChatCompletion]:
+        if self.seq >= len(self.replay_calls):
+            return None
+        event = self.replay_calls[self.seq]
+        if event["role"] != role or event["model"] != request.get("model"):
+            print(f"对话 {self.dialogue} 第 {self.seq} 次调用与日志不一致（{event['role']} != {role}），从此处重新生成")
+            self.replay_calls = self.replay_calls[:self.seq]
+            return None
+        self.seq += 1
+        self.replayed += 1
+        return ChatCompletion.model_validate(event["response"])
+
+    def record(self, role: str, request: Dict, response: ChatCompletion) -> None:
+        if self.journal is not None:
+            self.journal.write("llm", dialogue=self.dialogue, seq=self.seq, role=role, model=request.get("model"),
+                               response=response.model_dump(mode="json"))
+        self.seq += 1
+
+    def log(self, event_type: str, **data) -> None:
+        if self.journal is not None and not self.replaying:
+            self.journal.write(event_type, dialogue=self.dialogue, **data)
+
+    def log_cost(self, cost: float) -> None:
+        delta = cost - self.last_cost
+        self.last_cost = cost
+        if delta:
+            self.log("cost", delta=delta, total=cost)
@@ -0,0 +1,90 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, Optional
+
+from openai.types.chat import ChatCompletion
+
+UNCACHED_PARAMS = ("timeout", "extra_headers")   # transport options that do not change the completion
+EVICT_EVERY = 100   # LRU eviction runs every this many inserts, so the table may briefly exceed max_entries
+
+
+class CompletionCache:
+    """On-disk, content-addressed cache of chat completions.
+
+    The key is a SHA-256 over the model, messages and sampling parameters, so a rerun (or the same
+    dialogue_history window seen again) is answered from disk. Entries older than `ttl` seconds are
+    ignored, and once the cache holds more than `max_entries` rows the least recently used ones are evicted.
+    """
+
+    def __init__(self, path: str, ttl: Optional[float] = None, max_entries: Optional[int] = None) -> None:
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._puts = 0
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._conn().execute("""
+            CREATE TABLE IF NOT EXISTS completions (
+                key TEXT PRIMARY KEY,
+                model TEXT,
+                response TEXT NOT NULL,
+                created REAL NOT NULL,
+                last_access REAL NOT NULL
+            )""")
+        self._conn().execute("CREATE INDEX IF NOT EXISTS completions_lru ON completions (last_access)")
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    @staticmethod
+    def make_key(request: Dict) -> str:
+        payload = {k: v for k, v in request.items() if k not in UNCACHED_PARAMS}
+        blob = json.dumps(payload, ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+        return hashlib.sha256(blob.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[ChatCompletion]:
+        now = time.time()
+        row = self._conn().execute("SELECT response, created FROM completions WHERE key = ?", (key,)).fetchone()
+        if row is None or (self.ttl is not None and now - row[1] > self.ttl):
+            with self._lock:
+                self.misses += 1
+            return None
+        self._conn().execute("UPDATE completions SET last_access = ? WHERE key = ?", (now, key))
+        with self._lock:
+            self.hits += 1
+        return ChatCompletion.model_validate_json(row[0])
+
+    def put(self, key: str, response: ChatCompletion) -> None:
+        now = time.time()
+        conn = self._conn()
+        conn.execute("INSERT OR REPLACE INTO completions (key, model, response, created, last_access) VALUES (?, ?, ?, ?, ?)",
+                     (key, response.model, response.model_dump_json(), now, now))
+        with self._lock:
+            self._puts += 1
+            evict = self.max_entries is not None and self._puts % EVICT_EVERY == 0
+        if evict:
+            conn.execute("DELETE FROM completions WHERE key IN (SELECT key FROM completions ORDER BY last_access DESC LIMIT -1 OFFSET ?)",
+                         (self.max_entries,))
+
+    def purge_expired(self) -> int:
+        if self.ttl is None:
+            return 0
+        cur = self._conn().execute("DELETE FROM completions WHERE created < ?", (time.time() - self.ttl,))
+        return cur.rowcount
+
+    def stats(self) -> Dict[str, float]:
+        entries = self._conn().execute("SELECT COUNT(*) FROM completions").fetchone()[0]
+        total = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hits / total if total else 0.0, "entries": entries}
@@ -1,10 +1,41 @@
 import re
 import os
-import pandas as pd
 import json
-from openai import OpenAI
+import math
+import asyncio
+import threading
+import time
+import weakref
+from collections import namedtuple
+from functools import lru_cache
+import httpx
+from openai import OpenAI, AsyncOpenAI, DefaultHttpxClient, DefaultAsyncHttpxClient
+import llm_cache
+import fast_classifier
+import journal
+import rate_limit
+import telemetry
 
 TIMEOUT = 100
+MAX_CONNECTIONS = 64   # keep-alive HTTP pool shared by every client of one provider/base url
+MAX_KEEPALIVE_CONNECTIONS = 64
+
+_client_lock = threading.Lock()
+_client_registry = {}
+_async_client_registry = weakref.WeakKeyDictionary()
+
+COMPLETION_CACHE = None   # llm_cache.CompletionCache for the near-deterministic classifier calls, see enable_completion_cache
+FAST_CLASSIFIER = None   # fast_classifier.FastPath answering confident yes/no classifications locally, see enable_fast_classifier
+CONSTRAINED_YES_NO = False   # yes/no classifiers answer in at most YES_NO_MAX_TOKENS tokens, see enable_constrained_yes_no
+YES_NO_MAX_TOKENS = 2   # 是 / 否, plus room for a leading quote or space
+YES_NO_TOP_LOGPROBS = 5   # alternatives per output token, enough to see both 是 and 否
+YES_NO_LOGIT_BIAS = 100   # pushes 是 / 否 above every other token where the provider takes logit_bias
+LOGIT_BIAS_PROVIDERS = ('gpt',)   # providers taking logit_bias for tiktoken ids (the others get no bias)
+LOGPROBS_PROVIDERS = ('gpt', 'deepseek', 'qwen')   # providers asked for logprobs / top_logprobs; drop one whose endpoint rejects them
+YES_NO_STATS = {}   # role -> calls / logprobs / text / unparseable / confidence_sum of the constrained yes/no classifiers
+PROMPT_CACHE_STATS = {}   # role -> calls / prompt_tokens / cached_tokens of live provider calls (provider-side prefix cache)
+_usage_lock = threading.Lock()
+CALL_OBSERVERS = [telemetry.TELEMETRY.on_call]   # callables (role, request, response, seconds, source) run after every chat_completion; source is live, cache or replay
 
 def validate_message_structure(messages):
     """Verify that the message list structure meets the requirements"""
@@ -23,13 +54,10 @@ def validate_message_structure(messages):
 class DoctorCost:
     def __init__(self, model_name) -> None:
         self.model_name = model_name
-        self.input_cost = 0.3 / 1000000
-        self.output_cost = 0.15 / 1000000
         self.total_cost = 0
 
-    def money_cost(self, prompt_token_num, generate_token_num):
-        if self.model_name == 'gpt-4o-mini':
-            self.total_cost += prompt_token_num * self.input_cost + generate_token_num * self.output_cost
+    def money_cost(self, prompt_token_num, generate_token_num, cached_token_num=0):   #priced from telemetry.PRICES
+        self.total_cost += telemetry.call_cost(self.model_name, prompt_token_num, generate_token_num, cached_token_num)
 
     def get_cost(self):
         return self.total_cost
@@ -37,84 +65,284 @@ class DoctorCost:
 class PatientCost:
     def __init__(self, model_name) -> None:
         self.model_name = model_name
-        self.input_cost = 0.3 / 1000000
-        self.output_cost = 0.15 / 1000000
         self.total_cost = 0
 
-    def money_cost(self, prompt_token_num, generate_token_num):
-        if self.model_name == 'gpt-4o-mini':
-            self.total_cost += prompt_token_num * self.input_cost + generate_token_num * self.output_cost
+    def money_cost(self, prompt_token_num, generate_token_num, cached_token_num=0):
+        self.total_cost += telemetry.call_cost(self.model_name, prompt_token_num, generate_token_num, cached_token_num)
     
     def get_cost(self):
         return self.total_cost
 
 
-def gpt4_client_init():
-    openai_api_key = "" #Fill in your gpt API key
-    api_base = "" #Fill in your gpt API base url
-
-    client = OpenAI(api_key=openai_api_key, base_url=api_base)
+def _pooled_client(provider, api_key, base_url, client_cls=OpenAI):
+    """One client per (provider, base url) and process, so every caller reuses its keep-alive connections"""
+    limits = httpx.Limits(max_connections=MAX_CONNECTIONS, max_keepalive_connections=MAX_KEEPALIVE_CONNECTIONS)
+    with _client_lock:
+        if client_cls is AsyncOpenAI:   # async connection pools are bound to the event loop that opened them
+            registry = _async_client_registry.setdefault(asyncio.get_running_loop(), {})
+        else:
+            registry = _client_registry
+        client = registry.get((provider, base_url))
+        if client is None:
+            http_client = DefaultAsyncHttpxClient(limits=limits) if client_cls is AsyncOpenAI else DefaultHttpxClient(limits=limits)
+            # retries are done by rate_limit, which also honours Retry-After and the shared RPM/TPM budget
+            client = client_cls(api_key=api_key, base_url=base_url, http_client=http_client, timeout=TIMEOUT, max_retries=0)
+            registry[(provider, base_url)] = client
     return client
 
-def qwen_client_init():
-    openai_api_key = "" #Fill in your qwen API key
-    openai_api_base = "" #Fill in your qwen API base url
+def configure_client_pool(max_connections, max_keepalive_connections=None):
+    """Resize the per-provider connection pool; clients created afterwards use the new limits"""
+    global MAX_CONNECTIONS, MAX_KEEPALIVE_CONNECTIONS
+    MAX_CONNECTIONS = max_connections
+    MAX_KEEPALIVE_CONNECTIONS = max_keepalive_connections if max_keepalive_connections is not None else max_connections
+    with _client_lock:
+        _client_registry.clear()
+        _async_client_registry.clear()
 
-    client = OpenAI(
-        api_key=openai_api_key,
-        base_url=openai_api_base,
-    )
-    return client
+def gpt4_client_init(client_cls=OpenAI):
+    openai_api_key = os.environ.get("OPENAI_API_KEY", "") #Fill in your gpt API key
+    api_base = os.environ.get("OPENAI_API_BASE", "") #Fill in your gpt API base url
 
-def ds_client_init():
-    client = OpenAI(
-        api_key = os.environ.get("", ""),#Fill in your deepseek API key
-        base_url = "", #Fill in your deepseek API base url
+    return _pooled_client('gpt', openai_api_key, api_base, client_cls)
+
+def qwen_client_init(client_cls=OpenAI):
+    openai_api_key = os.environ.get("QWEN_API_KEY", "") #Fill in your qwen API key
+    openai_api_base = os.environ.get("QWEN_API_BASE", "") #Fill in your qwen API base url
+
+    return _pooled_client('qwen', openai_api_key, openai_api_base, client_cls)
+
+def ds_client_init(client_cls=OpenAI):
+    return _pooled_client('deepseek',
+        os.environ.get("DEEPSEEK_API_KEY", ""),#Fill in your deepseek API key
+        os.environ.get("DEEPSEEK_API_BASE", ""), #Fill in your deepseek API base url
+        client_cls
     )
-    return client
 
-def tool_client_init(model_name):
+def provider_of(model_name):
     if 'gpt' in model_name:
-        client = gpt4_client_init()
+        return 'gpt'
     elif 'deepseek' in model_name:
-        client = ds_client_init()
+        return 'deepseek'
+    return 'qwen'
+
+def _client_init(model_name, client_cls=OpenAI):
+    provider = provider_of(model_name)
+    if provider == 'gpt':
+        client = gpt4_client_init(client_cls)
+    elif provider == 'deepseek':
+        client = ds_client_init(client_cls)
     else:
-        client = qwen_client_init()
+        client = qwen_client_init(client_cls)
     return client
 
+def tool_client_init(model_name):
+    return _client_init(model_name)
+
 def doctor_client_init(model_name):
-    if 'gpt' in model_name:
-        client = gpt4_client_init()
-    elif 'deepseek' in model_name:
-        client = ds_client_init()
-    else:
-        client = qwen_client_init()
-    return client
+    return _client_init(model_name)
 
 def patient_client_init(model_name):
-    if 'gpt' in model_name:
-        client = gpt4_client_init()
-    elif 'deepseek' in model_name:
-        client = ds_client_init()
-    else:
-        client = qwen_client_init()
-    return client
+    return _client_init(model_name)
 
-def api_response_classification(model_name, input_sentence):   #Used to dichotomize patient responses
-    messages = []
-    messages = []
-    client = tool_client_init(model_name)
+def async_client_init(model_name):   #AsyncOpenAI client for the asyncio generation mode
+    return _client_init(model_name, AsyncOpenAI)
+
+def enable_completion_cache(path, ttl=None, max_entries=None):
+    global COMPLETION_CACHE
+    COMPLETION_CACHE = llm_cache.CompletionCache(path, ttl=ttl, max_entries=max_entries)
+    return COMPLETION_CACHE
+
+def enable_fast_classifier(predictor="lexicon", threshold=fast_classifier.THRESHOLD, audit_rate=fast_classifier.AUDIT_RATE):
+    global FAST_CLASSIFIER
+    FAST_CLASSIFIER = fast_classifier.FastPath(fast_classifier.load_predictor(predictor), threshold, audit_rate)
+    return FAST_CLASSIFIER
+
+def enable_constrained_yes_no():
+    """Ask the yes/no classifiers for a single 是/否 token and take its probability from the logprobs"""
+    global CONSTRAINED_YES_NO
+    CONSTRAINED_YES_NO = True
+
+def configure_rate_limit(model_name, rpm=None, tpm=None):
+    """Share an RPM/TPM budget between every call to the provider serving model_name"""
+    rate_limit.configure_rate_limit(provider_of(model_name), rpm, tpm)
+
+def _record_usage(role, response):
+    usage = response.usage
+    if usage is None:
+        return
+    with _usage_lock:
+        stats = PROMPT_CACHE_STATS.setdefault(role, {"calls": 0, "prompt_tokens": 0, "cached_tokens": 0})
+        stats["calls"] += 1
+        stats["prompt_tokens"] += usage.prompt_tokens
+        stats["cached_tokens"] += telemetry.cached_tokens(usage)
+
+def prompt_cache_stats():
+    """Per-role share of prompt tokens the provider served from its prefix cache"""
+    with _usage_lock:
+        return {role: dict(stats, hit_rate=stats["cached_tokens"] / stats["prompt_tokens"] if stats["prompt_tokens"] else 0.0)
+                for role, stats in PROMPT_CACHE_STATS.items()}
+
+def _send(client, role, request):
+    response = rate_limit.call_with_retry(provider_of(request['model']), request,
+                                          lambda: client.chat.completions.create(**request))
+    _record_usage(role, response)
+    return response
+
+async def _async_send(client, role, request):
+    response = await rate_limit.async_call_with_retry(provider_of(request['model']), request,
+                                                      lambda: client.chat.completions.create(**request))
+    _record_usage(role, response)
+    return response
+
+def _cache_ok(cacheable, response):
+    """cacheable is True or a check(response) -> bool; replies failing the check are neither stored nor served"""
+    return cacheable is True or cacheable(response)
+
+def _create(client, role, cacheable, request):
+    if not (cacheable and COMPLETION_CACHE is not None):
+        return _send(client, role, request), "live"
+    key = COMPLETION_CACHE.make_key(request)
+    response = COMPLETION_CACHE.get(key)
+    if response is not None and _cache_ok(cacheable, response):
+        return response, "cache"
+    response = _send(client, role, request)
+    if _cache_ok(cacheable, response):
+        COMPLETION_CACHE.put(key, response)
+    return response, "live"
+
+async def _async_create(client, role, cacheable, request):
+    if not (cacheable and COMPLETION_CACHE is not None):
+        return await _async_send(client, role, request), "live"
+    key = COMPLETION_CACHE.make_key(request)
+    response = COMPLETION_CACHE.get(key)
+    if response is not None and _cache_ok(cacheable, response):
+        return response, "cache"
+    response = await _async_send(client, role, request)
+    if _cache_ok(cacheable, response):
+        COMPLETION_CACHE.put(key, response)
+    return response, "live"
+
+def _notify(role, request, response, start, source):
+    if CALL_OBSERVERS:
+        seconds = time.perf_counter() - start
+        for observer in CALL_OBSERVERS:
+            observer(role, request, response, seconds, source)
+
+def chat_completion(client, role, cacheable=False, **request):
+    """Every chat.completions.create call goes through here.
+
+    role names the caller (doctor, patient, if_parse, classification, topic_choice, judgement, background).
+    Calls already paid for in a resumed dialogue are answered by its journal recorder; cacheable requests
+    are served from COMPLETION_CACHE (cacheable may be a check(response) -> bool, so a reply the caller cannot
+    parse is not cached and a rerun asks again). CALL_OBSERVERS see every call with its latency.
+    """
+    start = time.perf_counter()
+    recorder = journal.current_recorder()
+    if recorder is not None:
+        response = recorder.replay(role, request)
+        if response is not None:
+            _notify(role, request, response, start, "replay")
+            return response
+    response, source = _create(client, role, cacheable, request)
+    if recorder is not None:
+        recorder.record(role, request, response)
+    _notify(role, request, response, start, source)
+    return response
+
+async def async_chat_completion(client, role, cacheable=False, **request):
+    start = time.perf_counter()
+    recorder = journal.current_recorder()
+    if recorder is not None:
+        response = recorder.replay(role, request)
+        if response is not None:
+            _notify(role, request, response, start, "replay")
+            return response
+    response, source = await _async_create(client, role, cacheable, request)
+    if recorder is not None:
+        recorder.record(role, request, response)
+    _notify(role, request, response, start, source)
+    return response
+
+class Prefetch:
+    """An async chat completion started ahead of time that may end up unused (speculative doctor turns).
+
+    It runs as its own asyncio task outside the dialogue's journal recorder; take() records it like a
+    regular call, so a resumed dialogue replays exactly the calls that were used, in dialogue order.
+    """
+
+    def __init__(self, client, role, request) -> None:
+        self.role = role
+        self.request = request
+        self.started = time.perf_counter()
+        self.finished = None
+        self.task = asyncio.create_task(self._run(client))
+
+    async def _run(self, client):
+        journal.set_recorder(None)   # the task runs in a copy of the caller's context
+        try:
+            return await async_chat_completion(client, self.role, **self.request)
+        finally:
+            self.finished = time.perf_counter()
+
+    async def take(self):
+        response = await self.task
+        recorder = journal.current_recorder()
+        if recorder is not None:
+            recorder.record(self.role, self.request, response)
+        return response
+
+    def cancel(self):
+        """Drop an unused prefetch; returns its response if it had already completed (and was paid for)"""
+        if not self.task.done():
+            self.task.cancel()
+            return None
+        if self.task.cancelled() or self.task.exception() is not None:
+            return None
+        return self.task.result()
+
+def _classification_messages(input_sentence):
     prompt = "你需要根据医生和患者的对话判断该患者是否有医生询问的情况发生。\n如果有，请返回“是”，如果没有，请返回“否”。只能有这两种回答，不用输出解释或思考过程\n\n医患对话如下：{}".format(input_sentence)
-    messages.extend([{"role": "system", "content": "你是一个功能强大的文本助手，非常善于文本分类"},
-                    {"role": "user", "content":prompt}])
-    chat_response = client.chat.completions.create(
-        model=model_name,
-        messages=messages,
-        top_p=0.05,
-        temperature=0.3
-    )
-    response = chat_response.choices[0].message.content
-    
+    return [{"role": "system", "content": "你是一个功能强大的文本助手，非常善于文本分类"},
+            {"role": "user", "content":prompt}]
+
+def _topic_choice_messages(input_sentence):
+    prompt = "你需要根据医生和患者的对话判断该患者患有“抑郁”，“焦虑”，“双相”，“多动”四种疾病的可能性按从大到小的顺序排序，以列表形式输出。\n输出格式：['xx','xx','xx','xx']\n\n医患对话如下：{}".format(input_sentence)
+    return [{"role": "system", "content": "你是一个功能强大的文本助手，非常善于文本分类"},
+            {"role": "user", "content":prompt}]
+
+def _if_parse_messages(input_sentence):
+    prompt = "你需要根据医生和患者的对话判断该患者的回答中是否很可能隐含ta的一些经历，即医生是否应该根据ta的回答继续追问相关经历，请返回“是”或“否”，只能有这两种回答，不用输出解释或思考过程。医生和患者的对话如下：{}".format(input_sentence)
+    return [{"role": "system", "content": "你是一个功能强大的文本助手，非常善于文本解读"},
+            {"role": "user", "content":prompt}]
+
+def _judgement_messages(input_sentence, with_confidence=False):
+    fields = '{"probe": "是"或"否", "answer": "是"或"否"' + (', "confidence": 0到1之间的小数' if with_confidence else '') + '}'
+    prompt = "你需要根据医生和患者的对话同时完成两个判断：\n1.probe：患者的回答中是否很可能隐含ta的一些经历，即医生是否应该根据ta的回答继续追问相关经历；\n2.answer：该患者是否有医生询问的情况发生。\n" \
+        + ("confidence表示你对answer判断的把握程度。\n" if with_confidence else "") \
+        + "只输出如下格式的JSON，不用输出解释或思考过程：{}\n\n医患对话如下：{}".format(fields, input_sentence)
+    return [{"role": "system", "content": "你是一个功能强大的文本助手，非常善于文本分类和文本解读"},
+            {"role": "user", "content":prompt}]
+
+def _parse_judgement(response, with_confidence=False):
+    match = re.search(r"\{.*\}", response, re.S)
+    try:
+        data = json.loads(match.group(0)) if match else None
+    except json.JSONDecodeError:
+        data = None
+    if not isinstance(data, dict) or "probe" not in data or "answer" not in data:
+        raise ValueError(f"无法判断模型回答：{response}")
+    judgement = {}
+    for key in ("probe", "answer"):
+        value = data[key]
+        judgement[key] = value if isinstance(value, bool) else _parse_yes_no(str(value))
+    if with_confidence:
+        try:
+            judgement["confidence"] = min(max(float(data.get("confidence")), 0.0), 1.0)
+        except (TypeError, ValueError):
+            judgement["confidence"] = None
+    return judgement
+
+def _parse_yes_no(response):
     response_clean = response.replace(" ", "").replace("\n", "").strip()
 
     if "是" in response_clean:
@@ -122,25 +350,80 @@ def api_response_classification(model_name, input_sentence):   #Used to dichotom
     elif "否" in response_clean:
         return False
     else:
-      
         raise ValueError(f"无法判断模型回答：{response}")
-    
-def api_topic_choice(model_name, input_sentence):  #Determines the execution order of the four disorder-specific sub-state machines
-    messages = []
-    messages = []
-    client = tool_client_init(model_name)
-    prompt = "你需要根据医生和患者的对话判断该患者患有“抑郁”，“焦虑”，“双相”，“多动”四种疾病的可能性按从大到小的顺序排序，以列表形式输出。\n输出格式：['xx','xx','xx','xx']\n\n医患对话如下：{}".format(input_sentence)
-    messages.extend([{"role": "system", "content": "你是一个功能强大的文本助手，非常善于文本分类"},
-                    {"role": "user", "content":prompt}])
-    chat_response = client.chat.completions.create(
-        model=model_name,
-        messages=messages,
-        top_p=0.05,
-        temperature=0.3
-    )
-    response = chat_response.choices[0].message.content
-    response_clean = response.replace(" ", "").replace("\n", "").strip()
 
+YesNo = namedtuple("YesNo", ["answer", "confidence"])   # confidence: probability of the answer, None when the backend gave none
+
+@lru_cache(maxsize=None)
+def _yes_no_logit_bias(model_name):
+    """logit_bias favouring the 是 and 否 tokens of model_name's tiktoken encoding; None if either is not a single token"""
+    try:
+        import tiktoken
+        encoding = tiktoken.encoding_for_model(model_name)
+    except Exception:   # not installed, or not an OpenAI model
+        return None
+    ids = [encoding.encode(word) for word in ("是", "否")]
+    if any(len(token_ids) != 1 for token_ids in ids):
+        return None
+    return {str(token_ids[0]): YES_NO_LOGIT_BIAS for token_ids in ids}
+
+def _yes_no_request(model_name, messages, top_p, temperature):
+    request = dict(model=model_name, messages=messages, top_p=top_p, temperature=temperature)
+    if not CONSTRAINED_YES_NO:
+        return request
+    provider = provider_of(model_name)
+    request["max_tokens"] = YES_NO_MAX_TOKENS
+    if provider in LOGPROBS_PROVIDERS:
+        request.update(logprobs=True, top_logprobs=YES_NO_TOP_LOGPROBS)
+    if provider in LOGIT_BIAS_PROVIDERS and _yes_no_logit_bias(model_name) is not None:
+        request["logit_bias"] = _yes_no_logit_bias(model_name)
+    return request
+
+def _logprob_yes_no(logprobs):
+    """YesNo from the first output token offering 是 or 否, with P(是) renormalised over the two; None if none does"""
+    for position in logprobs.content or []:
+        mass = {True: 0.0, False: 0.0}
+        for candidate in position.top_logprobs or [position]:
+            token = candidate.token.strip()
+            if token.startswith("是"):
+                mass[True] += math.exp(candidate.logprob)
+            elif token.startswith("否"):
+                mass[False] += math.exp(candidate.logprob)
+        total = mass[True] + mass[False]
+        if total > 0:
+            p_yes = mass[True] / total
+            return YesNo(p_yes >= 0.5, max(p_yes, 1 - p_yes))
+    return None
+
+def _read_yes_no(role, chat_response):
+    """Answer of a yes/no classifier call: from the logprobs if present, else parsed from the text.
+    Unconstrained calls raise ValueError on a reply with neither 是 nor 否, constrained ones count it and answer 否"""
+    content = chat_response.choices[0].message.content or ""
+    if not CONSTRAINED_YES_NO:
+        return YesNo(_parse_yes_no(content), None)
+    logprobs = chat_response.choices[0].logprobs
+    result, source = (_logprob_yes_no(logprobs), "logprobs") if logprobs is not None else (None, None)
+    if result is None:
+        try:
+            result, source = YesNo(_parse_yes_no(content), None), "text"
+        except ValueError:
+            print(f"无法判断模型回答：{content}，按“否”处理")
+            result, source = YesNo(False, None), "unparseable"
+    with _usage_lock:
+        stats = YES_NO_STATS.setdefault(role, {"calls": 0, "logprobs": 0, "text": 0, "unparseable": 0, "confidence_sum": 0.0})
+        stats["calls"] += 1
+        stats[source] += 1
+        stats["confidence_sum"] += result.confidence or 0.0
+    return result
+
+def yes_no_stats():
+    """Per role: how the constrained yes/no answers were read, and their mean logprob confidence"""
+    with _usage_lock:
+        return {role: dict(stats, mean_confidence=stats["confidence_sum"] / stats["logprobs"] if stats["logprobs"] else None)
+                for role, stats in YES_NO_STATS.items()}
+
+def _match_topic_list(response):
+    response_clean = response.replace(" ", "").replace("\n", "").strip()
 
     match = re.search(r"\[([^\]]+)\]", response_clean)
 
@@ -148,48 +431,140 @@ def api_topic_choice(model_name, input_sentence):  #Determines the execution ord
         items = match.group(1).split("','")  
         items = [item.replace("'", "").replace("‘", "").replace("’", "") for item in items]
         return items
-    else:
+    return None
+
+def _parse_topic_list(response):
+    items = _match_topic_list(response)
+    if items is None:
         print("无法识别模型输出的列表")
-        return None
+    return items
+
+def _parses(parser):
+    """cacheable= check accepting a reply whose text parser reads (no ValueError, not None)"""
+    def check(chat_response):
+        try:
+            return parser(chat_response.choices[0].message.content or "") is not None
+        except ValueError:
+            return False
+    return check
+
+def _yes_no_cacheable(chat_response):   # a reply _read_yes_no answers without falling back to 否
+    logprobs = chat_response.choices[0].logprobs
+    if CONSTRAINED_YES_NO and logprobs is not None and _logprob_yes_no(logprobs) is not None:
+        return True
+    return _parses(_parse_yes_no)(chat_response)
+
+def _settle_classification(verdict, result):
+    if verdict is None:
+        return result
+    answer = FAST_CLASSIFIER.settle(verdict, result.answer)
+    return YesNo(answer, verdict.confidence if verdict.audit else result.confidence)
+
+def api_response_classification(model_name, input_sentence):   #Used to dichotomize patient responses
+    return api_scored_classification(model_name, input_sentence).answer
+
+def api_scored_classification(model_name, input_sentence):   #api_response_classification as YesNo, with the local or logprob confidence
+    verdict = FAST_CLASSIFIER.classify(input_sentence) if FAST_CLASSIFIER is not None else None
+    if verdict is not None and not verdict.use_llm:
+        return YesNo(verdict.answer, verdict.confidence)
+    client = tool_client_init(model_name)
+    chat_response = chat_completion(client, 'classification', cacheable=_yes_no_cacheable,
+        **_yes_no_request(model_name, _classification_messages(input_sentence), top_p=0.05, temperature=0.3))
+    return _settle_classification(verdict, _read_yes_no('classification', chat_response))
+    
+def api_topic_choice(model_name, input_sentence):  #Determines the execution order of the four disorder-specific sub-state machines
+    client = tool_client_init(model_name)
+    chat_response = chat_completion(client, 'topic_choice', cacheable=_parses(_match_topic_list),
+        model=model_name,
+        messages=_topic_choice_messages(input_sentence),
+        top_p=0.05,
+        temperature=0.3
+    )
+    return _parse_topic_list(chat_response.choices[0].message.content)
 
     
 def api_if_parse(model_name, input_sentence): #Determine whether it is necessary to ask the patient about his or her experience in depth
-    messages = []
     client = tool_client_init(model_name)
-    prompt = "你需要根据医生和患者的对话判断该患者的回答中是否很可能隐含ta的一些经历，即医生是否应该根据ta的回答继续追问相关经历，请返回“是”或“否”，只能有这两种回答，不用输出解释或思考过程。医生和患者的对话如下：{}".format(input_sentence)
-    messages.extend([{"role": "system", "content": "你是一个功能强大的文本助手，非常善于文本解读"},
-                    {"role": "user", "content":prompt}])
-    chat_response = client.chat.completions.create(
+    chat_response = chat_completion(client, 'if_parse', cacheable=_yes_no_cacheable,
+        **_yes_no_request(model_name, _if_parse_messages(input_sentence), top_p=0.05, temperature=0.2))
+    return _read_yes_no('if_parse', chat_response).answer
+
+def api_turn_judgement(model_name, input_sentence, with_confidence=False):  #One request answering both api_if_parse ("probe") and api_response_classification ("answer")
+    client = tool_client_init(model_name)
+    chat_response = chat_completion(client, 'judgement', cacheable=_parses(_parse_judgement),
         model=model_name,
-        messages=messages,
+        messages=_judgement_messages(input_sentence, with_confidence),
+        response_format={"type": "json_object"},
         top_p=0.05,
         temperature=0.2
     )
-    response = chat_response.choices[0].message.content
-    response_clean = response.replace(" ", "").replace("\n", "").strip()
+    return _parse_judgement(chat_response.choices[0].message.content, with_confidence)
 
-    if "是" in response_clean:
-        return True
-    elif "否" in response_clean:
-        return False
-    else:
-        raise ValueError(f"无法判断模型回答：{response}")
+async def async_api_response_classification(model_name, input_sentence):
+    return (await async_api_scored_classification(model_name, input_sentence)).answer
+
+async def async_api_scored_classification(model_name, input_sentence):
+    verdict = FAST_CLASSIFIER.classify(input_sentence) if FAST_CLASSIFIER is not None else None
+    if verdict is not None and not verdict.use_llm:
+        return YesNo(verdict.answer, verdict.confidence)
+    client = async_client_init(model_name)
+    chat_response = await async_chat_completion(client, 'classification', cacheable=_yes_no_cacheable,
+        **_yes_no_request(model_name, _classification_messages(input_sentence), top_p=0.05, temperature=0.3))
+    return _settle_classification(verdict, _read_yes_no('classification', chat_response))
+
+async def async_api_topic_choice(model_name, input_sentence):
+    client = async_client_init(model_name)
+    chat_response = await async_chat_completion(client, 'topic_choice', cacheable=_parses(_match_topic_list),
+        model=model_name,
+        messages=_topic_choice_messages(input_sentence),
+        top_p=0.05,
+        temperature=0.3
+    )
+    return _parse_topic_list(chat_response.choices[0].message.content)
+
+async def async_api_if_parse(model_name, input_sentence):
+    client = async_client_init(model_name)
+    chat_response = await async_chat_completion(client, 'if_parse', cacheable=_yes_no_cacheable,
+        **_yes_no_request(model_name, _if_parse_messages(input_sentence), top_p=0.05, temperature=0.2))
+    return _read_yes_no('if_parse', chat_response).answer
+
+async def async_api_turn_judgement(model_name, input_sentence, with_confidence=False):
+    client = async_client_init(model_name)
+    chat_response = await async_chat_completion(client, 'judgement', cacheable=_parses(_parse_judgement),
+        model=model_name,
+        messages=_judgement_messages(input_sentence, with_confidence),
+        response_format={"type": "json_object"},
+        top_p=0.05,
+        temperature=0.2
+    )
+    return _parse_judgement(chat_response.choices[0].message.content, with_confidence)
+
+def _background_messages(input_sentence):
+    prompt = "输入文本是关于精神疾病患者的基本状况和过去经历的关键词，发挥想象力，根据这些信息以第一人称编写一个故事，完整讲述患者过去的经历，这段经历是患者出现精神疾病的主要原因。\n要求1.输出一整段故事，扩充事件的起因、经过、结果，不要使用比喻句，不要使用浮夸的表述。2.不要输出虚拟的患者姓名。3.不允许输出类似“我正在努力走出阴影”，“在医生的指导下”，只需要输出虚构的故事。\n ###输入文本如下：{}".format(input_sentence)
+    return [{"role": "system", "content": "你是一个功能强大，想象力丰富的文本助手，非常善于写故事"},
+            {"role": "user", "content": prompt}]
 
 def api_load_for_background_gen(model_name, input_sentence):  #generate Fictitious experience of the patient
-    messages = []
     client = tool_client_init(model_name)
-    prompt = "输入文本是关于精神疾病患者的基本状况和过去经历的关键词，发挥想象力，根据这些信息以第一人称编写一个故事，完整讲述患者过去的经历，这段经历是患者出现精神疾病的主要原因。\n要求1.输出一整段故事，扩充事件的起因、经过、结果，不要使用比喻句，不要使用浮夸的表述。2.不要输出虚拟的患者姓名。3.不允许输出类似“我正在努力走出阴影”，“在医生的指导下”，只需要输出虚构的故事。\n ###输入文本如下：{}".format(input_sentence)
-    messages.extend([{"role": "system", "content": "你是一个功能强大，想象力丰富的文本助手，非常善于写故事"},
-                {"role": "user", "content": prompt}])
-    chat_response = client.chat.completions.create(
+    chat_response = chat_completion(client, 'background',
         model=model_name,
-        messages=messages,
+        messages=_background_messages(input_sentence),
         top_p=0.9,
         timeout=TIMEOUT
     )
     response = chat_response.choices[0].message.content
     return response
 
+async def async_api_load_for_background_gen(model_name, input_sentence):
+    client = async_client_init(model_name)
+    chat_response = await async_chat_completion(client, 'background',
+        model=model_name,
+        messages=_background_messages(input_sentence),
+        top_p=0.9,
+        timeout=TIMEOUT
+    )
+    return chat_response.choices[0].message.content
+
 
 
 def load_background_story(path):
@@ -0,0 +1,125 @@
+import threading
+import batch_engine
+
+KV_CACHE_REUSE = True   # local dialogues keep their KV cache between turns, see KVSession
+BATCH_SIZE = 1   # >1: the generations of all dialogues in flight share batched generate() calls, see batch_engine.py
+BATCH_WAIT = batch_engine.MAX_WAIT
+
+_lock = threading.Lock()
+_models = {}   # model_path -> (model, tokenizer), shared by every Doctor / Patient of the process
+_engines = {}   # model_path -> batch_engine.BatchEngine
+
+
+def load(model_path):
+    """Model and tokenizer for model_path, loaded on first use; torch/transformers are only imported here"""
+    with _lock:
+        if model_path not in _models:
+            import torch
+            from transformers import AutoModelForCausalLM, AutoTokenizer
+            model = AutoModelForCausalLM.from_pretrained(
+                model_path,
+                torch_dtype=torch.bfloat16,
+                device_map="auto"
+            )
+            tokenizer = AutoTokenizer.from_pretrained(model_path)
+            _models[model_path] = (model, tokenizer)
+        return _models[model_path]
+
+
+def unload(model_path=None):
+    """Drop one (or every) cached model so its memory can be reclaimed"""
+    with _lock:
+        paths = list(_models) if model_path is None else [model_path]
+        engines = [_engines.pop(path) for path in paths if path in _engines]
+        for path in paths:
+            _models.pop(path, None)
+    for engine in engines:
+        engine.close()
+
+
+def configure_batching(batch_size, max_wait=None):
+    global BATCH_SIZE, BATCH_WAIT
+    BATCH_SIZE = batch_size
+    if max_wait is not None:
+        BATCH_WAIT = max_wait
+
+
+def batching_enabled():
+    return BATCH_SIZE > 1
+
+
+def engine(model_path):
+    """The batch_engine.BatchEngine every dialogue of the process shares for model_path"""
+    model, tokenizer = load(model_path)
+    with _lock:
+        if model_path not in _engines:
+            _engines[model_path] = batch_engine.BatchEngine(model, tokenizer, BATCH_SIZE, BATCH_WAIT)
+        return _engines[model_path]
+
+
+def batch_stats():
+    with _lock:
+        return {path: engine.stats() for path, engine in _engines.items()}
+
+
+def _prompt_inputs(model, tokenizer, messages):
+    text = tokenizer.apply_chat_template(
+        messages,
+        tokenize=False,
+        add_generation_prompt=True
+    )
+    return tokenizer([text], return_tensors="pt").to(model.device)
+
+
+def generate(model, tokenizer, messages, max_new_tokens):
+    model_inputs = _prompt_inputs(model, tokenizer, messages)
+    generated_ids = model.generate(
+        model_inputs.input_ids,
+        max_new_tokens=max_new_tokens
+    )
+    generated_ids = [
+        output_ids[len(input_ids):] for input_ids, output_ids in zip(model_inputs.input_ids, generated_ids)
+    ]
+    return tokenizer.batch_decode(generated_ids, skip_special_tokens=True)[0]
+
+
+class KVSession:
+    """KV cache of one dialogue, kept across its turns.
+
+    Each turn re-renders the whole chat template, but only the tokens after the longest prefix already in
+    the cache (the system persona plus the previous turns) are prefilled; the cache is cropped back to that
+    prefix first, so an edited or re-tokenized earlier turn is simply recomputed from where it differs.
+    """
+
+    def __init__(self, model, tokenizer) -> None:
+        self.model = model
+        self.tokenizer = tokenizer
+        self.cache = None
+        self.cached_ids = []
+        self.reused_tokens = 0
+        self.prefilled_tokens = 0
+
+    def generate(self, messages, max_new_tokens):
+        from transformers import DynamicCache
+        model_inputs = _prompt_inputs(self.model, self.tokenizer, messages)
+        prompt_ids = model_inputs.input_ids[0].tolist()
+        common = 0
+        for cached, new in zip(self.cached_ids, prompt_ids):
+            if cached != new:
+                break
+            common += 1
+        common = min(common, len(prompt_ids) - 1)   # generate() needs at least one uncached token
+        if self.cache is None or common == 0:
+            self.cache = DynamicCache()
+            common = 0
+        else:
+            self.cache.crop(common)
+        generated_ids = self.model.generate(
+            model_inputs.input_ids,
+            past_key_values=self.cache,
+            max_new_tokens=max_new_tokens
+        )
+        self.cached_ids = generated_ids[0].tolist()[:self.cache.get_seq_length()]
+        self.reused_tokens += common
+        self.prefilled_tokens += len(prompt_ids) - common
+        return self.tokenizer.batch_decode(generated_ids[:, len(prompt_ids):], skip_special_tokens=True)[0]
@@ -9,13 +9,36 @@ import re
 import glob
 import shutil
 import os
+import argparse
+import asyncio
+import time
+from collections import namedtuple
 import llm_tools_api
+import job_queue
+import journal
+import cassette
+import rate_limit
+import telemetry
+import dialogue_writer
+import emr_store
+import fast_classifier
+import context_builder
+import local_models
 
 
 DOCTOR_PROMPT_PATH = './prompts/doctor/doctor_persona.json'
 PATIENT_INFO_PATH = './raw_data/cases_ready.json'
-MODEL_NAME = 'gpt-4o-mini'    
+MODEL_NAME = 'gpt-4o-mini'
+LOCAL_MODEL_PATH = None #Hugging Face model path for the doctor and patient (local mode); classifiers keep using MODEL_NAME
 NUM = 1 #generate 1 conversation for each patient(1 FicExp corresponds to 1 conversation)
+CONCURRENCY = 8 #dialogues in flight in the asyncio generation mode (--use-async)
+FUSED_JUDGEMENT = False #one api_turn_judgement request per turn instead of api_if_parse + api_response_classification
+JUDGEMENT_CONFIDENCE = False #with FUSED_JUDGEMENT, also ask for the confidence of the yes/no answer
+CACHE_FRIENDLY_PROMPTS = False #dialogue-static prompt content first so provider-side prefix caching hits (see prompt_layout.py)
+CONTEXT_BUDGETS = None #role -> dialogue-history tokens per doctor / patient prompt (see context_builder.py); None embeds the last 6 / 3 turns
+ROLLING_SUMMARY = False #with CONTEXT_BUDGETS, fold the turns left out of a prompt into a short extractive summary
+SPECULATIVE = False #with --use-async, generate the doctor question of both yes/no branches while the answer is being classified
+FORK_PREFIX = False #with NUM > 1, generate the opening turns once per patient and fork every conversation from them
 OUTPUT_DATA_PATH = './Dial_data'
 OUTPUT_PASTEXP_PATH = './prompts/patient/background_story'
 DIAGNOSIS_LIST_PATH = './prompts/diagstatemachine/diagnosis_list.json'
@@ -24,11 +47,6 @@ MACHINE_PATH = "prompts/diagstatemachine"
 DIAGNOSIS_DICT_PATH = './prompts/diagstatemachine/diagnosis_dict.json'
 DISEASE_SYMPTOM_MAP_PATH = './prompts/diagstatemachine/disease_symptom_map.json'
 
-total_cost = 0
-
-with open(PATIENT_INFO_PATH, 'r', encoding='utf-8') as f:
-    patient_info = json.load(f)
-
 with open(DIAGNOSIS_LIST_PATH, 'r', encoding='utf-8') as f:
     diag_list = json.load(f)
 
@@ -39,156 +57,581 @@ with open(DIAGNOSIS_DICT_PATH, 'r', encoding='utf-8') as f:
     diag_dict = json.load(f)
 
 original_order = ['抑郁', '焦虑', '双相', '多动']
-order_list = [random.sample(original_order, len(original_order))]
 
+JOURNAL = None #journal.Journal of this run (--journal)
+JOURNAL_STATE = journal.JournalState() #what an earlier run left in the journal (--resume)
+CASSETTE = None #cassette.Cassette recording or replaying every LLM call of the run (--record-cassette / --replay-cassette)
+DIALOGUE_WRITER = None #dialogue_writer.DialogueWriter streaming finished dialogues as JSONL shards (--jsonl-output)
+DialoguePrefix = namedtuple("DialoguePrefix", ["doctor", "patient", "dialogue_history", "output_list", "rng", "cost"])   # opening turns shared by the conversations of a patient
+SPECULATION_STATS = {"turns": 0, "hits": 0, "wasted_calls": 0, "cancelled": 0, "wasted_tokens": 0, "wasted_cost": 0.0, "saved_seconds": 0.0}
 
-for patient_template in tqdm(patient_info):
-    total_output_list = []
+
+def get_story_paths(patient_template):
     number_before_com = patient_template['患者'].split("com")[0]
-    com_and_after = "com" + patient_template['患者'].split("com", 1)[1]
     patient_dir = os.path.join(OUTPUT_PASTEXP_PATH, f'patient_{number_before_com}')
-    original_diagnosis = patient_template["诊断结果"]
-
 
     if not os.path.isdir(patient_dir):
         raise FileNotFoundError(f"患者目录 {patient_dir} 不存在")
 
-
-    story_paths = sorted(
+    return sorted(
         glob.glob(os.path.join(patient_dir, '*.txt')),
         key=lambda x: (
-            int(re.search(r'com(\d+)', x).group(1)),  
-            int(os.path.basename(x).split('_')[2].split('.')[0])  
+            int(re.search(r'com(\d+)', x).group(1)),
+            int(os.path.basename(x).split('_')[2].split('.')[0])
         )
     )
-    
-    for i in range(NUM):
+
+
+def dialogue_rng(seed, patient_template, i):
+    """Per-dialogue random source; the global `random` module when no seed is given"""
+    if seed is None:
+        return random
+    return random.Random(f"{seed}:{patient_template['患者']}:{i}")
+
+
+async def _call(use_async, func, async_func, *args, **kwargs):
+    if use_async:
+        return await async_func(*args, **kwargs)
+    return func(*args, **kwargs)
+
+
+def speculate(machine, doc, dialogue_history):
+    """Start the doctor turn of both answers to the pending yes/no question; returns (group, subgroup, state, time) -> llm_tools_api.Prefetch"""
+    prefetches = {}
+    for answer in (True, False):
+        info = machine.peek_next_state(answer)
+        key = (info["current_group"], info.get("current_subgroup"), info["current_state"], info["current_time"])
+        if info["current_state"] in diag_list or key in prefetches:
+            continue
+        prefetches[key] = doc.prefetch_response(dialogue_history, doc.get_question_text(info["current_group"], key[2], key[3], key[1]))
+    return prefetches
+
+
+def settle_speculation(prefetches, used, classified_at):
+    """Cancel the losing branch and account for what speculation saved and cost"""
+    SPECULATION_STATS["turns"] += 1
+    if used is not None:
+        SPECULATION_STATS["hits"] += 1
+        # without speculation the doctor call would have started once the answer was classified
+        SPECULATION_STATS["saved_seconds"] += max(0.0, min(used.finished - used.started, classified_at - used.started))
+    for prefetch in prefetches.values():
+        if prefetch is used:
+            continue
+        SPECULATION_STATS["wasted_calls"] += 1
+        response = prefetch.cancel()
+        if response is not None and response.usage is not None:
+            usage = response.usage
+            prompt, completion, cached = usage.prompt_tokens, usage.completion_tokens, telemetry.cached_tokens(usage)
+        else:   # cancelled in flight: the provider may still bill it, count the prompt and a full default completion
+            SPECULATION_STATS["cancelled"] += 1
+            completion = rate_limit.DEFAULT_COMPLETION_TOKENS
+            prompt, cached = rate_limit.estimate_tokens(prefetch.request) - completion, 0
+        SPECULATION_STATS["wasted_tokens"] += prompt + completion
+        SPECULATION_STATS["wasted_cost"] += telemetry.call_cost(prefetch.request["model"], prompt, completion, cached)
+
+
+def speculation_summary():
+    turns = SPECULATION_STATS["turns"]
+    return (f"{turns} 轮，命中 {SPECULATION_STATS['hits']} 轮，每轮节省 {SPECULATION_STATS['saved_seconds'] / turns:.2f} 秒，"
+            f"每轮额外 {SPECULATION_STATS['wasted_tokens'] / turns:.0f} tokens / ${SPECULATION_STATS['wasted_cost'] / turns:.5f} "
+            f"（共 ${SPECULATION_STATS['wasted_cost']:.4f}，其中 {SPECULATION_STATS['cancelled']} 次为中途取消的估算）")
+
+
+async def run_conversation(patient_template, i, story_path, order_list, use_async=False, rng=random, recorder=None, prefix=None):
+    """Run one doctor-patient dialogue; returns (record, cost), record is None if a disorder was left undiagnosed.
+    cost covers every LLM call of the dialogue, classifiers included; with a DialoguePrefix the dialogue forks from
+    its opening turns instead of generating them, and their cost is not included"""
+    token = journal.set_recorder(recorder)
+    usage_token = telemetry.start_dialogue(f"{patient_template['患者']}#{i}")
+    try:
+        return await _run_conversation(patient_template, i, story_path, order_list, use_async, rng, recorder or journal.DialogueRecorder(None, ""), prefix)
+    finally:
+        telemetry.end_dialogue(usage_token)
+        journal.reset_recorder(token)
+
+
+async def open_conversation(patient_template, story_path, use_async=False, rng=random):
+    """Run only the opening turns of a patient's conversations (--fork-prefix); returns the DialoguePrefix to fork them from"""
+    usage_token = telemetry.start_dialogue(f"{patient_template['患者']}#prefix")
+    try:
+        return await _run_conversation(patient_template, None, story_path, None, use_async, rng, journal.DialogueRecorder(None, ""), opening_only=True)
+    finally:
+        telemetry.end_dialogue(usage_token)
+
+
+async def _run_conversation(patient_template, i, story_path, order_list, use_async, rng, recorder, prefix=None, opening_only=False):
+    com_and_after = "com" + patient_template['患者'].split("com", 1)[1]
+    original_diagnosis = patient_template["诊断结果"]
+    output_dict = {}
+    if prefix is None:
         dialogue_history = []
         output_list = []
-        output_dict = {}
-        story_path = story_paths[i]
-        doc = Doctor(patient_template, DOCTOR_PROMPT_PATH,  MODEL_NAME, MACHINE_PATH, True)
-        pat = Patient(patient_template, MODEL_NAME, True, story_path, DISEASE_SYMPTOM_MAP_PATH)
-        doctor_response, current_topic, doctor_cost = doc.doctor_response_gen(None)
+        doctor_context = patient_context = None
+        if CONTEXT_BUDGETS is not None:
+            doctor_context = context_builder.ContextBuilder('doctor', CONTEXT_BUDGETS['doctor'], ROLLING_SUMMARY)
+            patient_context = context_builder.ContextBuilder('patient', CONTEXT_BUDGETS['patient'], ROLLING_SUMMARY)
+        model_path, use_api = (MODEL_NAME, True) if LOCAL_MODEL_PATH is None else (LOCAL_MODEL_PATH, False)
+        doc = Doctor(patient_template, DOCTOR_PROMPT_PATH,  model_path, MACHINE_PATH, use_api, rng=rng, cache_friendly_prompts=CACHE_FRIENDLY_PROMPTS, context_builder=doctor_context)
+        pat = Patient(patient_template, model_path, use_api, story_path, DISEASE_SYMPTOM_MAP_PATH, cache_friendly_prompts=CACHE_FRIENDLY_PROMPTS, context_builder=patient_context)
+    else:   # same persona and opening turns, this conversation's background story and random source from here on
+        dialogue_history = list(prefix.dialogue_history)
+        output_list = [dict(turn) for turn in prefix.output_list]
+        doc = prefix.doctor.fork(rng)
+        pat = prefix.patient.fork(story_path)
+    usage = telemetry.current_dialogue()
+
+    async def doctor_turn(history, **kwargs):
+        result = await _call(use_async, doc.doctor_response_gen, doc.async_doctor_response_gen, history, **kwargs)
+        recorder.log("turn", speaker="doctor", text=result[0], topic=kwargs.get('topic_seq'))
+        recorder.log_cost(usage.cost)
+        return result
+
+    async def patient_turn(topic):
+        result = await _call(use_async, pat.patient_response_gen, pat.async_patient_response_gen, topic, dialogue_history)
+        recorder.log("turn", speaker="patient", text=result[0], topic=topic)
+        recorder.log_cost(usage.cost)
+        return result
+
+    if prefix is None:
+        telemetry.set_state("intro")
+        doctor_response, current_topic, doctor_cost = await doctor_turn(None)
         output_dict['doctor'] = doctor_response
         dialogue_history.append('医生：' + doctor_response)
         print("医生：", doctor_response)
         current_topic = '患者的近况'
-        patient_response, patient_cost = pat.patient_response_gen(current_topic, dialogue_history)
+        patient_response, patient_cost = await patient_turn(current_topic)
         output_dict['patient'] = patient_response
         dialogue_history.append('患者：' + patient_response)
         output_list.append(output_dict)
         output_dict = {}
         print("患者：", patient_response)
-        if i == 0:
-            order = llm_tools_api.api_topic_choice(MODEL_NAME, dialogue_history)
-        else:
-            order = order_list[i-1]
-        state_transition_process = []
-        for m in range(4):
-            current_topic = order[m]
-            states = topic_order_dict[current_topic]
-            group = states[0]
-            state = states[1]
-            machine = HierarchicalStateMachine(states[0], states[1], MACHINE_PATH)
-            current_topic=doc.get_question_text(group, state, "time0",machine.current_subgroup)
-            doctor_response, current_topic, doctor_cost = doc.doctor_response_gen(dialogue_history,topic_seq=current_topic)
-            output_dict['doctor'] = doctor_response
-            dialogue_history.append('医生：' + doctor_response)
-            print("医生：", doctor_response)
-            patient_response, patient_cost = pat.patient_response_gen(current_topic, dialogue_history)
-            output_dict['patient'] = patient_response
-            dialogue_history.append('患者：' + patient_response)
-            output_list.append(output_dict)
-            print("患者：", patient_response)
-            output_dict = {}
-            parse_number = 0
-            while machine.current_state not in diag_list:
-                parse = llm_tools_api.api_if_parse(MODEL_NAME, dialogue_history[-2:])
-                
-                if parse and parse_number<4:
-                    Current_topic_doctor = "请根据患者的回答深入询问经历"
-                    doctor_response, current_topic_doctor, doctor_cost = doc.doctor_response_gen(dialogue_history, topic_seq=Current_topic_doctor)
+        if opening_only:
+            return DialoguePrefix(doc, pat, dialogue_history, output_list, rng, usage.cost)
+    if i == 0:
+        order = await _call(use_async, llm_tools_api.api_topic_choice, llm_tools_api.async_api_topic_choice, MODEL_NAME, dialogue_history)
+    else:
+        order = order_list[(i-1) % len(order_list)]
+    state_transition_process = []
+    for m in range(4):
+        current_topic = order[m]
+        states = topic_order_dict[current_topic]
+        group = states[0]
+        state = states[1]
+        machine = HierarchicalStateMachine(states[0], states[1], MACHINE_PATH, rng=rng)
+        telemetry.set_state(f"{group}.{state}")
+        current_topic=doc.get_question_text(group, state, "time0",machine.current_subgroup)
+        doctor_response, current_topic, doctor_cost = await doctor_turn(dialogue_history,topic_seq=current_topic)
+        output_dict['doctor'] = doctor_response
+        dialogue_history.append('医生：' + doctor_response)
+        print("医生：", doctor_response)
+        patient_response, patient_cost = await patient_turn(current_topic)
+        output_dict['patient'] = patient_response
+        dialogue_history.append('患者：' + patient_response)
+        output_list.append(output_dict)
+        print("患者：", patient_response)
+        output_dict = {}
+        parse_number = 0
+        while machine.current_state not in diag_list:
+            if FUSED_JUDGEMENT:
+                judgement = await _call(use_async, llm_tools_api.api_turn_judgement, llm_tools_api.async_api_turn_judgement, MODEL_NAME, dialogue_history[-2:], JUDGEMENT_CONFIDENCE)
+                parse = judgement["probe"]
+            else:
+                parse = await _call(use_async, llm_tools_api.api_if_parse, llm_tools_api.async_api_if_parse, MODEL_NAME, dialogue_history[-2:])
+
+            if parse and parse_number<4:
+                Current_topic_doctor = "请根据患者的回答深入询问经历"
+                doctor_response, current_topic_doctor, doctor_cost = await doctor_turn(dialogue_history, topic_seq=Current_topic_doctor)
+                output_dict['doctor'] = doctor_response
+                dialogue_history.append('医生：' + doctor_response)
+                print("医生：", doctor_response)
+                Current_topic_patient = "请根据医生的提问回答,多给相应的经历描述"
+                patient_response, patient_cost = await patient_turn(Current_topic_patient)
+                output_dict['patient'] = patient_response
+                dialogue_history.append('患者：' + patient_response)
+                output_list.append(output_dict)
+                print("患者：", patient_response)
+                output_dict = {}
+                parse_number+=1
+            else:
+                prefetches = {}
+                if FUSED_JUDGEMENT:
+                    transfer, confidence = judgement["answer"], judgement.get("confidence")
+                    if JUDGEMENT_CONFIDENCE:
+                        print("判断置信度：", judgement["confidence"])
+                else:
+                    fast = llm_tools_api.FAST_CLASSIFIER
+                    if SPECULATIVE and use_async and not recorder.replaying and not (fast is not None and fast.confident(dialogue_history[-2:])):
+                        prefetches = speculate(machine, doc, dialogue_history)
+                    try:
+                        transfer, confidence = await _call(use_async, llm_tools_api.api_scored_classification, llm_tools_api.async_api_scored_classification, MODEL_NAME, dialogue_history[-2:])
+                    except BaseException:
+                        for prefetch in prefetches.values():
+                            prefetch.cancel()
+                        raise
+                classified_at = time.perf_counter()
+                machine.get_next_state(transfer)
+                telemetry.set_state(f"{machine.current_group}.{machine.current_state}")
+                recorder.log("transition", answer=transfer, confidence=confidence, group=machine.current_group, subgroup=machine.current_subgroup, state=machine.current_state, time=machine.current_time)
+                prefetch = None
+                if machine.current_state not in diag_list:
+                    Current_topic = doc.get_question_text(machine.current_group, machine.current_state, machine.current_time, machine.current_subgroup)
+                    prefetch = prefetches.get((machine.current_group, machine.current_subgroup, machine.current_state, machine.current_time))
+                    if prefetch is not None:
+                        doctor_response, current_topic, doctor_cost = await doctor_turn(dialogue_history, topic_seq=Current_topic, prefetched=prefetch)
+                    else:
+                        doctor_response, current_topic, doctor_cost = await doctor_turn(dialogue_history, topic_seq=Current_topic)
+                    if prefetches:
+                        settle_speculation(prefetches, prefetch, classified_at)
                     output_dict['doctor'] = doctor_response
                     dialogue_history.append('医生：' + doctor_response)
                     print("医生：", doctor_response)
-                    Current_topic_patient = "请根据医生的提问回答,多给相应的经历描述"
-                    patient_response, patient_cost = pat.patient_response_gen(Current_topic_patient, dialogue_history)
+                    current_topic_pat="根据医生的问题回答"
+                    patient_response, patient_cost = await patient_turn(current_topic_pat)
                     output_dict['patient'] = patient_response
                     dialogue_history.append('患者：' + patient_response)
                     output_list.append(output_dict)
                     print("患者：", patient_response)
                     output_dict = {}
-                    parse_number+=1
-                else:
-                    transfer = llm_tools_api.api_response_classification(MODEL_NAME, dialogue_history[-2:])
-                    machine.get_next_state(transfer)
-                    if machine.current_state not in diag_list:
-                        Current_topic = doc.get_question_text(machine.current_group, machine.current_state, machine.current_time, machine.current_subgroup)
-                        doctor_response, current_topic, doctor_cost = doc.doctor_response_gen(dialogue_history, topic_seq=Current_topic)
-                        output_dict['doctor'] = doctor_response
-                        dialogue_history.append('医生：' + doctor_response)
-                        print("医生：", doctor_response)
-                        current_topic_pat="根据医生的问题回答"
-                        patient_response, patient_cost = pat.patient_response_gen(current_topic_pat, dialogue_history)
-                        output_dict['patient'] = patient_response
-                        dialogue_history.append('患者：' + patient_response)
-                        output_list.append(output_dict)
-                        print("患者：", patient_response)
-                        output_dict = {}
-                    elif machine.current_state in diag_list:
-                        disease = machine.current_state
-                        if "depression" in disease:
-                            doc.diagnosis[0]=disease
-                        elif "bipolar" in disease:
-                            doc.diagnosis[1]=disease
-                        elif "anxiety" in disease:
-                            doc.diagnosis[2]=disease
-                        elif "adhd" in disease:
-                            doc.diagnosis[3]=disease
-            state_transition_process.append(machine.state_history)
-        if all(doc.diagnosis):
-            diagnosis_result_list = doc.diagnosis
-        else:
-            print("还有疾病未诊断")
-            print(doc.diagnosis)
-            break
+                elif machine.current_state in diag_list:
+                    if prefetches:
+                        settle_speculation(prefetches, None, classified_at)
+                    disease = machine.current_state
+                    if "depression" in disease:
+                        doc.diagnosis[0]=disease
+                    elif "bipolar" in disease:
+                        doc.diagnosis[1]=disease
+                    elif "anxiety" in disease:
+                        doc.diagnosis[2]=disease
+                    elif "adhd" in disease:
+                        doc.diagnosis[3]=disease
+        state_transition_process.append(machine.state_history)
+    if all(doc.diagnosis):
+        diagnosis_result_list = doc.diagnosis
+    else:
+        print("还有疾病未诊断")
+        print(doc.diagnosis)
+        return None, usage.cost
 
-        if diagnosis_result_list[1] not in ["bipolar2", "bipolar6", "bipolar8"]:
-            diagnosis_result_list[1] = "bipolar9"
-        elif diagnosis_result_list[1] != "bipolar6" and diagnosis_result_list[0] != "depression4":
-            diagnosis_result_list[1] = "bipolar10"
-        else:
-            diagnosis_result_list[1] = "bipolar6"
-        final_diagnosis = "、".join([diag_dict[disease] for disease in diagnosis_result_list if diag_dict[disease] != ""])
-        #Diagnostic Context Tree
-        if patient_template['性别'] == "女":
-            topiclist = ["有无家人患精神疾病或遗传病", "是否抽烟喝酒",  "是否有喝咖啡习惯", "有无不良嗜好", "月经情况（是否规律/痛经）", "是否有运动习惯"]
-        else:
-            topiclist = ["有无家人患精神疾病或遗传病", "是否抽烟喝酒",  "是否有喝咖啡习惯", "有无不良嗜好", "是否有运动习惯"]
-        random.shuffle(topiclist)
-        for topic in topiclist:
-            print("当前话题：", topic)
-            doctor_response, current_topic, doctor_cost = doc.doctor_response_gen(dialogue_history[-2:], topic_seq=topic)
-            output_dict['doctor'] = doctor_response
-            dialogue_history.append('医生：' + doctor_response)
-            print("医生：", doctor_response)
-            topic_patient = "请根据医生的提问回答,多给相应的经历描述"
-            patient_response, patient_cost = pat.patient_response_gen(topic_patient, dialogue_history)
-            output_dict['patient'] = patient_response
-            dialogue_history.append('患者：' + patient_response)
-            output_list.append(output_dict)
-            print("患者：", patient_response)
-            output_dict = {}
-        doctor_response, current_topic, doctor_cost = doc.doctor_response_gen(final_diagnosis, is_dialogue_end=True)
+    if diagnosis_result_list[1] not in ["bipolar2", "bipolar6", "bipolar8"]:
+        diagnosis_result_list[1] = "bipolar9"
+    elif diagnosis_result_list[1] != "bipolar6" and diagnosis_result_list[0] != "depression4":
+        diagnosis_result_list[1] = "bipolar10"
+    else:
+        diagnosis_result_list[1] = "bipolar6"
+    final_diagnosis = "、".join([diag_dict[disease] for disease in diagnosis_result_list if diag_dict[disease] != ""])
+    #Diagnostic Context Tree
+    if patient_template['性别'] == "女":
+        topiclist = ["有无家人患精神疾病或遗传病", "是否抽烟喝酒",  "是否有喝咖啡习惯", "有无不良嗜好", "月经情况（是否规律/痛经）", "是否有运动习惯"]
+    else:
+        topiclist = ["有无家人患精神疾病或遗传病", "是否抽烟喝酒",  "是否有喝咖啡习惯", "有无不良嗜好", "是否有运动习惯"]
+    rng.shuffle(topiclist)
+    telemetry.set_state("context")
+    for topic in topiclist:
+        print("当前话题：", topic)
+        doctor_response, current_topic, doctor_cost = await doctor_turn(dialogue_history[-2:], topic_seq=topic)
         output_dict['doctor'] = doctor_response
         dialogue_history.append('医生：' + doctor_response)
-        output_list.append(output_dict)
         print("医生：", doctor_response)
-        total_output_list.append({"doctor":i, "topic_order":order, "original_diagnosis":original_diagnosis, "diagnosis_result":final_diagnosis,"experience_combination":com_and_after , "conversation":output_list, "state transition process":state_transition_process })
-        total_cost += doctor_cost+patient_cost    
-    os.makedirs(OUTPUT_DATA_PATH, exist_ok=True)        
-    with open(os.path.join(OUTPUT_DATA_PATH, 'patient_{}.json'.format(patient_template['患者'])), 'w', encoding='utf-8') as f:
-        json_data = json.dump(total_output_list, f, indent=2, ensure_ascii=False)
+        topic_patient = "请根据医生的提问回答,多给相应的经历描述"
+        patient_response, patient_cost = await patient_turn(topic_patient)
+        output_dict['patient'] = patient_response
+        dialogue_history.append('患者：' + patient_response)
+        output_list.append(output_dict)
+        print("患者：", patient_response)
+        output_dict = {}
+    telemetry.set_state("closing")
+    doctor_response, current_topic, doctor_cost = await doctor_turn(final_diagnosis, is_dialogue_end=True)
+    output_dict['doctor'] = doctor_response
+    dialogue_history.append('医生：' + doctor_response)
+    output_list.append(output_dict)
+    print("医生：", doctor_response)
+    record = {"doctor":i, "topic_order":order, "original_diagnosis":original_diagnosis, "diagnosis_result":final_diagnosis,"experience_combination":com_and_after , "conversation":output_list, "state transition process":state_transition_process }
+    return record, usage.cost
+
+
+async def run_journaled_conversation(patient_template, i, story_path, order_list, use_async=False, seed=None, prefix=None):
+    """run_conversation with per-turn journaling; a dialogue finished or partly paid for in an earlier run is resumed from the journal"""
+    if CASSETTE is not None:
+        return await run_cassette_conversation(patient_template, i, story_path, order_list, use_async, seed)
+    if JOURNAL is None:
+        rng = prefix.rng if prefix is not None and i == 0 else dialogue_rng(seed, patient_template, i)   # the first conversation continues the prefix's
+        return await run_conversation(patient_template, i, story_path, order_list, use_async, rng, prefix=prefix)
+
+    dialogue = f"{patient_template['患者']}#{i}"
+    if dialogue in JOURNAL_STATE.finished_dialogues:
+        finished = JOURNAL_STATE.finished_dialogues[dialogue]
+        return finished["record"], finished["cost"]
+    dialogue_seed = JOURNAL_STATE.seeds.get(dialogue)
+    if dialogue_seed is None:
+        dialogue_seed = f"{seed}:{patient_template['患者']}:{i}" if seed is not None else random.randrange(2**63)
+        JOURNAL.write("dialogue_start", dialogue=dialogue, seed=dialogue_seed)
+    recorder = journal.DialogueRecorder(JOURNAL, dialogue, JOURNAL_STATE.pending_calls(dialogue))
+    record, cost = await run_conversation(patient_template, i, story_path, order_list, use_async, random.Random(dialogue_seed), recorder)
+    if recorder.replayed:
+        print(f"对话 {dialogue} 从日志恢复了 {recorder.replayed} 次模型调用")
+    JOURNAL.write("dialogue_done", dialogue=dialogue, record=record, cost=cost)
+    return record, cost
+
+
+async def run_cassette_conversation(patient_template, i, story_path, order_list, use_async=False, seed=None):
+    """run_conversation with every LLM call recorded into CASSETTE, or answered from it with no network call"""
+    dialogue = f"{patient_template['患者']}#{i}"
+    dialogue_seed = f"{seed}:{patient_template['患者']}:{i}" if seed is not None else random.randrange(2**63)
+    recorder = CASSETTE.recorder(dialogue, dialogue_seed)
+    record, cost = await run_conversation(patient_template, i, story_path, order_list, use_async, random.Random(recorder.seed), recorder)
+    CASSETTE.finish(recorder)
+    return record, cost
+
+
+def stream_dialogue(patient_template, i, record):
+    """Append a finished dialogue to the JSONL shards right away, once per dialogue even across --resume"""
+    dialogue = f"{patient_template['患者']}#{i}"
+    if DIALOGUE_WRITER is None or dialogue in JOURNAL_STATE.streamed_dialogues:
+        return
+    DIALOGUE_WRITER.write({"patient": patient_template['患者'], **record})
+    if JOURNAL is not None:
+        JOURNAL.write("dialogue_streamed", dialogue=dialogue)
+
+
+def write_patient_output(patient_template, total_output_list):
+    if DIALOGUE_WRITER is None:   # with --jsonl-output the records were streamed as they finished
+        os.makedirs(OUTPUT_DATA_PATH, exist_ok=True)
+        with open(os.path.join(OUTPUT_DATA_PATH, 'patient_{}.json'.format(patient_template['患者'])), 'w', encoding='utf-8') as f:
+            json_data = json.dump(total_output_list, f, indent=2, ensure_ascii=False)
+    if JOURNAL is not None:
+        JOURNAL.write("patient_done", patient=patient_template['患者'])
+
+
+async def generate_patient(patient_template, order_list, semaphore, use_async=False, seed=None):
+    """Run the NUM conversations of one patient in order and write its output file; returns the cost"""
+    if patient_template['患者'] in JOURNAL_STATE.finished_patients:
+        return 0
+    total_output_list = []
+    cost = 0
+    story_paths = get_story_paths(patient_template)
+    prefix = None
+    for i in range(NUM):
+        async with semaphore:
+            if FORK_PREFIX and prefix is None:   # paid for once, shared by all NUM conversations
+                prefix = await open_conversation(patient_template, story_paths[0], use_async, dialogue_rng(seed, patient_template, 0))
+                cost += prefix.cost
+            record, dialogue_cost = await run_journaled_conversation(patient_template, i, story_paths[i], order_list, use_async, seed, prefix)
+        cost += dialogue_cost   # paid for even when a disorder was left undiagnosed
+        if record is None:
+            break
+        stream_dialogue(patient_template, i, record)
+        total_output_list.append(record)
+    write_patient_output(patient_template, total_output_list)
+    return cost
+
+
+async def generate_all(patient_info, order_list, use_async=False, concurrency=CONCURRENCY, seed=None):
+    if not use_async:
+        concurrency = 1
+    semaphore = asyncio.Semaphore(concurrency)
+    total_cost = 0
+    if not use_async:
+        for patient_template in tqdm(patient_info):
+            total_cost += await generate_patient(patient_template, order_list, semaphore, use_async, seed)
+        return total_cost
+
+    tasks = [asyncio.create_task(generate_patient(patient_template, order_list, semaphore, use_async, seed)) for patient_template in patient_info]
+    try:
+        for task in tqdm(asyncio.as_completed(tasks), total=len(tasks)):
+            total_cost += await task
+    finally:
+        for task in tasks:
+            task.cancel()
+    return total_cost
+
+
+async def run_worker(queue, patient_info, use_async=False, concurrency=CONCURRENCY, seed=None, worker_id=None):
+    """Lease (patient, combination, conversation) jobs from a shared JobQueue until it is drained"""
+    worker_id = worker_id or job_queue.default_worker_id()
+    patients = {patient_template['患者']: patient_template for patient_template in patient_info}
+    order_list = queue.get_meta('order_list')
+    if not use_async:
+        concurrency = 1
+
+    async def worker_loop(slot):
+        while True:
+            job = queue.lease(f"{worker_id}/{slot}")
+            if job is None:
+                return
+            patient_template = patients[job.patient]
+            try:
+                with queue.keep_alive(job):
+                    story_path = get_story_paths(patient_template)[job.conv_index]
+                    record, dialogue_cost = await run_journaled_conversation(patient_template, job.conv_index, story_path, order_list, use_async, seed)
+            except Exception as e:
+                print(f"任务 {job.job_id} 失败: {e!r}")
+                queue.fail(job, repr(e))
+                continue
+            results = queue.complete(job, record, dialogue_cost)
+            if results is not None:   # streamed once the patient is finished: a lost lease or a skipped later conversation drops its record
+                for i, result in enumerate(results):
+                    stream_dialogue(patient_template, i, result)
+                write_patient_output(patient_template, results)
+
+    await asyncio.gather(*(worker_loop(slot) for slot in range(concurrency)))
+
+
+def main():
+    global LOCAL_MODEL_PATH, FORK_PREFIX, FUSED_JUDGEMENT, JUDGEMENT_CONFIDENCE, CACHE_FRIENDLY_PROMPTS, CONTEXT_BUDGETS, ROLLING_SUMMARY, SPECULATIVE, JOURNAL, JOURNAL_STATE, CASSETTE, DIALOGUE_WRITER
+    parser = argparse.ArgumentParser(description="Generate multi-turn diagnostic dialogues")
+    parser.add_argument('--use-async', action='store_true', help="run dialogues concurrently with the asyncio API clients")
+    parser.add_argument('--concurrency', type=int, default=CONCURRENCY, help="max dialogues in flight with --use-async")
+    parser.add_argument('--seed', type=int, default=None, help="seed per-dialogue random sources so runs are reproducible")
+    parser.add_argument('--local-model', default=LOCAL_MODEL_PATH, help="run the doctor and patient on this local Hugging Face model (classifiers stay on MODEL_NAME)")
+    parser.add_argument('--batch-size', type=int, default=1, help="with --local-model and --use-async: batch the local generations of up to this many dialogues in flight")
+    parser.add_argument('--pool-size', type=int, default=None, help="HTTP keep-alive connections per provider (default llm_tools_api.MAX_CONNECTIONS)")
+    parser.add_argument('--rpm', type=float, default=None, help="requests per minute allowed for MODEL_NAME's provider (shared by all dialogues of this process)")
+    parser.add_argument('--tpm', type=float, default=None, help="tokens per minute allowed for MODEL_NAME's provider")
+    parser.add_argument('--cache', default=None, help="SQLite cache for the classifier calls (if-parse, yes/no, topic order)")
+    parser.add_argument('--cache-ttl', type=float, default=None, help="seconds before a cached classifier reply is ignored")
+    parser.add_argument('--cache-max-entries', type=int, default=None, help="LRU-evict the cache beyond this many entries")
+    parser.add_argument('--fused-judgement', action='store_true', default=FUSED_JUDGEMENT, help="decide 'probe deeper?' and the yes/no answer with one request per turn")
+    parser.add_argument('--judgement-confidence', action='store_true', default=JUDGEMENT_CONFIDENCE, help="with --fused-judgement, also request a confidence for the answer")
+    parser.add_argument('--context-budget', nargs='?', const=f"{context_builder.BUDGETS['doctor']},{context_builder.BUDGETS['patient']}", default=None,
+                        metavar='DOCTOR,PATIENT', help="embed the most relevant dialogue-history turns within this many tokens per doctor / patient prompt instead of the last 6 / 3 turns")
+    parser.add_argument('--rolling-summary', action='store_true', default=ROLLING_SUMMARY, help="with --context-budget, fold the turns left out into a short summary line")
+    parser.add_argument('--fork-prefix', action='store_true', default=FORK_PREFIX, help="generate the opening turns once per patient and fork its NUM conversations (topic orders, background stories) from them")
+    parser.add_argument('--speculative', action='store_true', default=SPECULATIVE, help="with --use-async, generate the doctor question of both yes/no branches while the answer is classified and keep the winner")
+    parser.add_argument('--fast-classifier', nargs='?', const='lexicon', default=None, help="answer confident yes/no classifications locally (lexicon, or module:factory) and ask the LLM only below --fast-threshold")
+    parser.add_argument('--fast-threshold', type=float, default=fast_classifier.THRESHOLD, help="with --fast-classifier: minimum local confidence")
+    parser.add_argument('--fast-audit-rate', type=float, default=fast_classifier.AUDIT_RATE, help="with --fast-classifier: share of confident local answers also sent to the LLM to measure agreement")
+    parser.add_argument('--constrained-yes-no', action='store_true', help="yes/no classifiers answer with one 是/否 token (logit_bias where supported) and report its logprob confidence; unparseable replies count as 否 instead of failing")
+    parser.add_argument('--cache-friendly-prompts', action='store_true', default=CACHE_FRIENDLY_PROMPTS, help="put dialogue-static prompt content first so provider prefix caching hits")
+    parser.add_argument('--telemetry', default=None, help="append one JSON line per LLM call (role, model, tokens, latency, retries, HDSM state, cost)")
+    parser.add_argument('--prices', default=None, help="JSON price table merged into telemetry.PRICES (USD per 1M tokens)")
+    parser.add_argument('--jsonl-output', default=None, help="stream finished dialogues into rotating JSONL shards in this directory instead of one JSON file per patient")
+    parser.add_argument('--compression', choices=['gzip', 'zstd'], default=None, help="with --jsonl-output: compress the shards (zstd needs the zstandard package)")
+    parser.add_argument('--shard-records', type=int, default=dialogue_writer.SHARD_MAX_RECORDS, help="with --jsonl-output: dialogues per shard")
+    parser.add_argument('--emr-db', default=None, help="read the cases from an emr_store database instead of PATIENT_INFO_PATH; enables the filters below")
+    emr_store.add_filter_arguments(parser)
+    parser.add_argument('--journal', default=None, help="append-only per-turn journal of the run (one file per process)")
+    parser.add_argument('--resume', action='store_true', help="with --journal: skip finished patients and replay in-flight dialogues from the journal")
+    parser.add_argument('--record-cassette', default=None, help="record every LLM call of the run, per dialogue, into this cassette file (.jsonl.gz)")
+    parser.add_argument('--replay-cassette', default=None, help="re-run from a recorded cassette with no network calls; fails on the first call that differs")
+    parser.add_argument('--queue', default=None, help="SQLite job queue shared by worker processes; run as a queue worker")
+    parser.add_argument('--enqueue', action='store_true', help="with --queue: add every (patient, conversation) job, then exit")
+    parser.add_argument('--requeue-failed', action='store_true', help="with --queue: put failed jobs back to pending, then exit")
+    parser.add_argument('--worker-id', default=None, help="with --queue: worker name recorded on leases (default host:pid)")
+    args = parser.parse_args()
+
+    if args.speculative and not args.use_async:
+        parser.error("--speculative 需要配合 --use-async 使用")
+    if args.local_model:
+        if args.use_async and args.batch_size < 2:
+            parser.error("本地模型的 --use-async 模式需要 --batch-size 大于 1")
+        if args.speculative:
+            parser.error("--speculative 仅支持API模式")
+        LOCAL_MODEL_PATH = args.local_model
+        local_models.configure_batching(args.batch_size)
+    FUSED_JUDGEMENT = args.fused_judgement
+    if args.fork_prefix and (args.journal or args.queue or args.record_cassette or args.replay_cassette):
+        parser.error("--fork-prefix 不能与 --journal / --queue / 录制回放同时使用")
+    FORK_PREFIX = args.fork_prefix
+    SPECULATIVE = args.speculative
+    if args.context_budget:
+        try:
+            doctor_budget, patient_budget = (int(value) for value in args.context_budget.split(","))
+        except ValueError:
+            parser.error("--context-budget 格式应为 DOCTOR,PATIENT，例如 400,250")
+        CONTEXT_BUDGETS = {'doctor': doctor_budget, 'patient': patient_budget}
+    elif args.rolling_summary and CONTEXT_BUDGETS is None:
+        parser.error("--rolling-summary 需要配合 --context-budget 使用")
+    ROLLING_SUMMARY = args.rolling_summary
+    JUDGEMENT_CONFIDENCE = args.judgement_confidence
+    CACHE_FRIENDLY_PROMPTS = args.cache_friendly_prompts
+    if args.pool_size:
+        llm_tools_api.configure_client_pool(args.pool_size)
+    if args.rpm or args.tpm:
+        llm_tools_api.configure_rate_limit(MODEL_NAME, args.rpm, args.tpm)
+    if args.prices:
+        telemetry.load_prices(args.prices)
+    if args.telemetry:
+        telemetry.TELEMETRY.open_sink(args.telemetry)
+    if args.constrained_yes_no:
+        llm_tools_api.enable_constrained_yes_no()
+    if args.fast_classifier:
+        llm_tools_api.enable_fast_classifier(args.fast_classifier, args.fast_threshold, args.fast_audit_rate)
+    if args.cache:
+        llm_tools_api.enable_completion_cache(args.cache, args.cache_ttl, args.cache_max_entries)
+    if args.journal:
+        if args.resume:
+            JOURNAL_STATE = journal.load_journal(args.journal)
+            print(f"从日志恢复：已完成患者 {len(JOURNAL_STATE.finished_patients)} 个，已完成对话 {len(JOURNAL_STATE.finished_dialogues)} 段")
+        JOURNAL = journal.Journal(args.journal)
+    if args.record_cassette or args.replay_cassette:
+        if args.record_cassette and args.replay_cassette:
+            parser.error("--record-cassette 与 --replay-cassette 不能同时使用")
+        if args.journal:
+            parser.error("--record-cassette / --replay-cassette 不能与 --journal 同时使用")
+        CASSETTE = cassette.Cassette(args.record_cassette or args.replay_cassette, "record" if args.record_cassette else "replay")
+    if args.jsonl_output:
+        DIALOGUE_WRITER = dialogue_writer.DialogueWriter(args.jsonl_output, args.compression, args.shard_records)
+
+    filters = emr_store.filters_from_args(args)
+    if args.emr_db:
+        patient_info = list(emr_store.EMRStore(args.emr_db).iter_cases(**filters))
+        print(f"从 {args.emr_db} 选出病例 {len(patient_info)} 个")
+    elif any(value for value in filters.values()):
+        parser.error("--patient-ids / --diagnosis / --gender / --age 需要配合 --emr-db 使用")
+    else:
+        with open(PATIENT_INFO_PATH, 'r', encoding='utf-8') as f:
+            patient_info = json.load(f)
+
+    order_rng = random if args.seed is None else random.Random(args.seed)
+    order_list = [order_rng.sample(original_order, len(original_order)) for _ in range(max(NUM - 1, 1))]   # conversation i > 0 uses order_list[i-1]
+    if JOURNAL is not None:
+        if JOURNAL_STATE.order_list is not None:
+            order_list = JOURNAL_STATE.order_list
+        else:
+            JOURNAL.write("run_start", order_list=order_list)
+    if CASSETTE is not None:
+        order_list = CASSETTE.start_run(order_list)
+
+    if args.queue:
+        queue = job_queue.JobQueue(args.queue)
+        if args.enqueue:
+            if queue.get_meta('order_list') is None:
+                queue.set_meta('order_list', order_list)
+            print(f"新增任务 {queue.enqueue(patient_info, NUM)} 个")
+            return
+        elif args.requeue_failed:
+            print(f"重新排队失败任务 {queue.requeue_failed()} 个")
+        else:
+            asyncio.run(run_worker(queue, patient_info, args.use_async, args.concurrency, args.seed, args.worker_id))
+        print(queue.stats())
+        print("********总价格*********:", queue.total_cost())
+    else:
+        total_cost = asyncio.run(generate_all(patient_info, order_list, args.use_async, args.concurrency, args.seed))
+        print("********总价格*********:", total_cost)
+    if DIALOGUE_WRITER is not None:
+        DIALOGUE_WRITER.close()
+    if CASSETTE is not None:
+        CASSETTE.close()
+        print("录制回放:", CASSETTE.stats())
+    print("调用统计:\n" + telemetry.TELEMETRY.format_summary())
+    telemetry.TELEMETRY.close()
+    if llm_tools_api.PROMPT_CACHE_STATS:
+        print("提示前缀缓存:", llm_tools_api.prompt_cache_stats())
+    if rate_limit.STATS["retries"] or rate_limit.STATS["throttled_seconds"]:
+        print("限流与重试:", rate_limit.STATS)
+    if llm_tools_api.COMPLETION_CACHE is not None:
+        print("分类缓存:", llm_tools_api.COMPLETION_CACHE.stats())
+    if local_models.batch_stats():
+        print("本地批处理:", local_models.batch_stats())
+    if context_builder.STATS:
+        print("对话历史预算:", context_builder.stats())
+    if llm_tools_api.YES_NO_STATS:
+        print("是否分类:", llm_tools_api.yes_no_stats())
+    if llm_tools_api.FAST_CLASSIFIER is not None:
+        print("本地分类:", llm_tools_api.FAST_CLASSIFIER.summary())
+    if SPECULATION_STATS["turns"]:
+        print("推测预取:", speculation_summary())
+
 
-print("********总价格*********:", total_cost)
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,263 @@
+import argparse
+import hashlib
+import json
+import math
+import random
+import threading
+import time
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+TOPICS = ['抑郁', '焦虑', '双相', '多动']
+DOCTOR_LINES = [
+    "最近这段时间，你的睡眠怎么样？",
+    "这种情况大概持续多久了，有两周以上吗？",
+    "你平时对以前喜欢的事情还有兴趣吗？",
+    "这种紧张的感觉会不会让你坐立不安？",
+    "有没有哪段时间你觉得精力特别旺盛，不怎么需要睡觉？",
+    "你做事情的时候容易分心吗，能举个例子吗？",
+    "这些情况对你的工作和生活影响大吗？",
+    "你有没有过伤害自己的想法？",
+]
+PATIENT_LINES = [
+    "最近老是睡不好，半夜醒了就再也睡不着。",
+    "差不多有一个多月了吧，越来越明显。",
+    "以前挺喜欢打球的，现在完全提不起劲。",
+    "有时候会心慌，手心一直出汗。",
+    "好像没有，精神一直不太好。",
+    "上班的时候总是走神，一份报告要改好几遍。",
+    "影响挺大的，最近请了好几次假。",
+    "没有，这个倒是没想过。",
+]
+STORY = ("我从小在一个小县城长大，父母常年在外打工，我跟着奶奶生活。上初中那年奶奶去世了，我一个人住在学校宿舍，"
+         "周末也很少回家。后来考上了大学，毕业后进了一家公司做销售，业绩压力很大，连续几个月没完成任务，"
+         "主管当着全组的面批评我。从那以后我开始睡不着觉，早上起来也不想去上班，慢慢地和朋友也不联系了。")
+CACHE_BLOCK = 128   # prefix-cache granularity in tokens, as on the OpenAI API
+CACHE_MIN_TOKENS = 1024
+CACHE_MAX_ENTRIES = 100000
+
+
+def count_tokens(text):
+    """Rough tokenizer: one token per CJK character, one per four other characters"""
+    cjk = sum(1 for c in text if ord(c) >= 0x2e80)
+    return cjk + math.ceil((len(text) - cjk) / 4)
+
+
+class MockConfig:
+    def __init__(self, latency=0.2, latency_sigma=0.5, token_latency=0.0, error_rate=0.0, rate_limit_rate=0.0,
+                 rpm=None, retry_after=1.0, yes_rate=0.7, probe_rate=0.2, seed=0) -> None:
+        self.latency = latency   # median seconds before the first token (lognormal with latency_sigma)
+        self.latency_sigma = latency_sigma
+        self.token_latency = token_latency   # extra seconds per completion token
+        self.error_rate = error_rate   # share of requests answered with a 500
+        self.rate_limit_rate = rate_limit_rate   # share of requests answered with a 429
+        self.rpm = rpm   # hard requests-per-minute budget; requests over it get a 429 as well
+        self.retry_after = retry_after
+        self.yes_rate = yes_rate   # share of "是" for yes/no classifier prompts
+        self.probe_rate = probe_rate   # share of "是" for the "probe deeper?" prompt
+        self.seed = seed
+
+
+class MockBackend:
+    """Rule-based chat completions with injectable latency, 500s and 429s, and OpenAI-style prefix caching"""
+
+    def __init__(self, config: MockConfig) -> None:
+        self.config = config
+        self.rng = random.Random(config.seed)
+        self.lock = threading.Lock()
+        self.prefixes = OrderedDict()
+        self.window = []   # request times of the last minute, for config.rpm
+        self.stats = {"requests": 0, "ok": 0, "rate_limited": 0, "errors": 0, "prompt_tokens": 0, "cached_tokens": 0, "completion_tokens": 0}
+
+    def _reply_rng(self, text):
+        digest = hashlib.sha256(f"{self.config.seed}:{text}".encode("utf-8")).digest()
+        return random.Random(int.from_bytes(digest[:8], "big"))
+
+    def reply(self, request):
+        """Deterministic reply for a request: the same prompt always gets the same answer"""
+        messages = request.get("messages", [])
+        prompt = messages[-1]["content"] if messages else ""
+        rng = self._reply_rng(prompt)
+        if "四种疾病" in prompt:
+            order = TOPICS[:]
+            rng.shuffle(order)
+            return "[" + ",".join(f"'{topic}'" for topic in order) + "]"
+        if (request.get("response_format") or {}).get("type") == "json_object" or "probe" in prompt:
+            return json.dumps({"probe": "是" if rng.random() < self.config.probe_rate else "否",
+                               "answer": "是" if rng.random() < self.config.yes_rate else "否",
+                               "confidence": round(rng.uniform(0.5, 1.0), 2)}, ensure_ascii=False)
+        if "继续追问" in prompt:
+            return "是" if rng.random() < self.config.probe_rate else "否"
+        if "返回“是”" in prompt:
+            return "是" if rng.random() < self.config.yes_rate else "否"
+        if "编写一个故事" in prompt:
+            return STORY
+        if "患者，正在和一位" in prompt:   # patient persona; the doctor persona also says 你是一名…患者
+            return rng.choice(PATIENT_LINES)
+        return rng.choice(DOCTOR_LINES)
+
+    def logprobs(self, request, content):
+        """OpenAI-style logprobs, one token per character; a leading 是 / 否 gets a reply-specific confidence against the other"""
+        if not request.get("logprobs"):
+            return None
+        rng = self._reply_rng(content + request["messages"][-1]["content"])
+        tokens = []
+        for i, token in enumerate(content):
+            logprob, top = -0.05, [{"token": token, "logprob": -0.05}]
+            if i == 0 and token in "是否":
+                p = rng.uniform(0.55, 0.999)
+                logprob = math.log(p)
+                top = [{"token": token, "logprob": logprob}, {"token": "否" if token == "是" else "是", "logprob": math.log(1 - p)}]
+            tokens.append({"token": token, "logprob": logprob, "top_logprobs": top[:request.get("top_logprobs") or 0]})
+        return {"content": tokens}
+
+    def _cached_tokens(self, text):
+        """Longest previously seen prefix, in CACHE_BLOCK steps from CACHE_MIN_TOKENS on"""
+        boundaries = []
+        tokens = 0
+        next_boundary = CACHE_MIN_TOKENS
+        for i, c in enumerate(text):
+            tokens += 1 if ord(c) >= 0x2e80 else 0.25
+            if tokens >= next_boundary:
+                boundaries.append((next_boundary, hashlib.sha1(text[:i + 1].encode("utf-8")).hexdigest()))
+                next_boundary += CACHE_BLOCK
+        cached = 0
+        with self.lock:
+            for size, key in boundaries:
+                if key in self.prefixes:
+                    self.prefixes.move_to_end(key)
+                    cached = size
+                self.prefixes[key] = True
+            while len(self.prefixes) > CACHE_MAX_ENTRIES:
+                self.prefixes.popitem(last=False)
+        return cached
+
+    def _over_rpm(self, now):
+        if not self.config.rpm:
+            return False
+        self.window = [t for t in self.window if now - t < 60]
+        if len(self.window) >= self.config.rpm:
+            return True
+        self.window.append(now)
+        return False
+
+    def handle(self, request):
+        """(status, headers, body) for one chat.completions request"""
+        now = time.time()
+        with self.lock:
+            self.stats["requests"] += 1
+            roll = self.rng.random()
+            latency = self.config.latency * math.exp(self.rng.gauss(0, self.config.latency_sigma)) if self.config.latency else 0.0
+            limited = roll < self.config.rate_limit_rate or self._over_rpm(now)
+            failed = not limited and roll < self.config.rate_limit_rate + self.config.error_rate
+            if limited:
+                self.stats["rate_limited"] += 1
+            elif failed:
+                self.stats["errors"] += 1
+        if limited:
+            return 429, {"retry-after": str(self.config.retry_after)}, {"error": {"message": "Rate limit reached (mock)", "type": "rate_limit_error"}}
+        if failed:
+            time.sleep(latency)
+            return 500, {}, {"error": {"message": "Internal server error (mock)", "type": "server_error"}}
+
+        content = self.reply(request)
+        finish_reason = "stop"
+        if request.get("max_tokens") and count_tokens(content) > request["max_tokens"]:
+            content, finish_reason = content[:request["max_tokens"]], "length"
+        prompt_text = "".join(message.get("content") or "" for message in request.get("messages", []))
+        prompt_tokens = count_tokens(prompt_text)
+        completion_tokens = count_tokens(content)
+        cached_tokens = self._cached_tokens(prompt_text)
+        time.sleep(latency + completion_tokens * self.config.token_latency)
+        with self.lock:
+            self.stats["ok"] += 1
+            self.stats["prompt_tokens"] += prompt_tokens
+            self.stats["cached_tokens"] += cached_tokens
+            self.stats["completion_tokens"] += completion_tokens
+            completion_id = f"chatcmpl-mock-{self.stats['requests']}"
+        return 200, {}, {
+            "id": completion_id,
+            "object": "chat.completion",
+            "created": int(now),
+            "model": request.get("model", "mock"),
+            "choices": [{"index": 0, "finish_reason": finish_reason, "logprobs": self.logprobs(request, content),
+                         "message": {"role": "assistant", "content": content}}],
+            "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                      "total_tokens": prompt_tokens + completion_tokens,
+                      "prompt_tokens_details": {"cached_tokens": cached_tokens}},
+        }
+
+
+def _make_handler(backend: MockBackend):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"   # keep-alive, like the real endpoints
+        disable_nagle_algorithm = True   # headers and body are separate writes; Nagle + delayed ACK would add ~40 ms
+
+        def _send(self, status, headers, body):
+            data = json.dumps(body, ensure_ascii=False).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            for key, value in headers.items():
+                self.send_header(key, value)
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            if not self.path.rstrip("/").endswith("/chat/completions"):
+                return self._send(404, {}, {"error": {"message": f"unknown path {self.path}", "type": "invalid_request_error"}})
+            try:
+                request = json.loads(body)
+            except json.JSONDecodeError:
+                return self._send(400, {}, {"error": {"message": "invalid JSON body", "type": "invalid_request_error"}})
+            self._send(*backend.handle(request))
+
+        def do_GET(self):
+            if self.path.rstrip("/").endswith("/models"):
+                return self._send(200, {}, {"object": "list", "data": [{"id": "mock", "object": "model", "owned_by": "mock"}]})
+            if self.path.rstrip("/") == "/stats":
+                with backend.lock:
+                    return self._send(200, {}, dict(backend.stats))
+            self._send(404, {}, {"error": {"message": f"unknown path {self.path}", "type": "invalid_request_error"}})
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+def start_server(config: MockConfig = None, host="127.0.0.1", port=0):
+    """Serve in a daemon thread; returns (server, base_url). port=0 picks a free port"""
+    backend = MockBackend(config or MockConfig())
+    server = ThreadingHTTPServer((host, port), _make_handler(backend))
+    server.daemon_threads = True
+    server.backend = backend
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://{host}:{server.server_address[1]}/v1"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local OpenAI-compatible chat completions mock for offline load tests")
+    parser.add_argument('--host', default="127.0.0.1")
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--latency', type=float, default=0.2, help="median seconds per response")
+    parser.add_argument('--latency-sigma', type=float, default=0.5, help="lognormal spread of the latency")
+    parser.add_argument('--token-latency', type=float, default=0.0, help="extra seconds per completion token")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="share of requests answered with a 500")
+    parser.add_argument('--rate-limit-rate', type=float, default=0.0, help="share of requests answered with a 429")
+    parser.add_argument('--rpm', type=int, default=None, help="requests per minute before every request gets a 429")
+    parser.add_argument('--retry-after', type=float, default=1.0, help="Retry-After seconds sent with a 429")
+    parser.add_argument('--yes-rate', type=float, default=0.7, help="share of 是 answers to yes/no classifier prompts")
+    parser.add_argument('--probe-rate', type=float, default=0.2, help="share of 是 answers to the probe-deeper prompt")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    config = MockConfig(args.latency, args.latency_sigma, args.token_latency, args.error_rate, args.rate_limit_rate,
+                        args.rpm, args.retry_after, args.yes_rate, args.probe_rate, args.seed)
+    server = ThreadingHTTPServer((args.host, args.port), _make_handler(MockBackend(config)))
+    server.daemon_threads = True
+    print(f"mock server on http://{args.host}:{args.port}/v1 (set OPENAI_API_BASE to it and OPENAI_API_KEY to anything)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
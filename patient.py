@@ -1,8 +1,10 @@
+import copy
 import json
 import random
-from transformers import AutoModelForCausalLM, AutoTokenizer
-import torch
 import llm_tools_api
+import local_models
+import prompt_layout
+import telemetry
 import re
 
 class Patient(llm_tools_api.PatientCost):
@@ -51,37 +53,62 @@ class Patient(llm_tools_api.PatientCost):
     不要输出思考过程!!
     """
 
-    def __init__(self, patient_template, model_path, use_api, story_path, disease_symptom_map_path) -> None:
+    def __init__(self, patient_template, model_path, use_api, story_path, disease_symptom_map_path, cache_friendly_prompts=False, context_builder=None) -> None:
         super().__init__(model_path.split('/')[-1])
         self.model_path = model_path
         self.model_name = model_path.split('/')[-1]
         self.patient_model = None
         self.patient_tokenizer = None
+        self.kv_session = None
         self.experience = None
         self.patient_template = patient_template
         self.system_prompt = "你是一名{}岁的{}性{}患者，正在和一位精神科医生交流，使用简洁且口语化的表达，要求无空行，回复尽量简短并适当表现出犹豫。".format(self.patient_template['年龄'], self.patient_template['性别'], self.patient_template['诊断结果'])
         self.messages = []
         self.use_api = use_api
         self.client = None
+        self.async_client = None
         self.story_path = story_path
         self.dialbegin = True
         self.target_disease = re.split(r"[，,]\s*", patient_template['诊断结果'])
         self.all_diseases = ['抑郁症', '焦虑症', '双相情感障碍', '多动症']
         self.disease_symptom_map = {}
         self.disease_symptom_map_path = disease_symptom_map_path
+        self.cache_friendly_prompts = cache_friendly_prompts   # static prompt head first, see prompt_layout
+        self.static_prompt = None
+        self.context_builder = context_builder   # context_builder.ContextBuilder choosing the embedded history; None: last 3 turns
         
 
 
+    SNAPSHOT_FIELDS = ("messages", "dialbegin", "story_path", "experience", "static_prompt", "total_cost")
+
+    def snapshot(self) -> dict:
+        """Copy of the dialogue state: messages, background story and cost"""
+        return copy.deepcopy({field: getattr(self, field) for field in self.SNAPSHOT_FIELDS})
+
+    def restore(self, snapshot: dict) -> None:
+        for field in self.SNAPSHOT_FIELDS:
+            setattr(self, field, copy.deepcopy(snapshot[field]))
+
+    def fork(self, story_path=None) -> "Patient":
+        """Independent patient continuing this dialogue, optionally with another background story from here on;
+        API clients and local models are shared, a KV cache starts empty"""
+        clone = copy.copy(self)
+        clone.restore(self.snapshot())
+        if story_path is not None and story_path != self.story_path:
+            clone.story_path = story_path
+            clone.experience = None
+            clone.static_prompt = None   # embeds the story, see _cache_friendly_request
+        if self.kv_session is not None:
+            clone.kv_session = local_models.KVSession(self.patient_model, self.patient_tokenizer)
+        return clone
+
     def patientbot_init(self):
         if self.use_api:
             self.client = llm_tools_api.patient_client_init(self.model_name)
         else:
-            self.patient_model = AutoModelForCausalLM.from_pretrained(
-                self.model_path,
-                torch_dtype=torch.bfloat16,
-                device_map="auto"
-            )
-            self.patient_tokenizer = AutoTokenizer.from_pretrained(self.model_path)
+            self.patient_model, self.patient_tokenizer = local_models.load(self.model_path)
+            if local_models.KV_CACHE_REUSE and not local_models.batching_enabled():
+                self.kv_session = local_models.KVSession(self.patient_model, self.patient_tokenizer)
         self.messages.append({"role": "system", "content": self.system_prompt})
 
     def find_unique_symptoms(self): #Find symptoms that belong only to include_diseases and not to exclude_diseases
@@ -101,60 +128,77 @@ class Patient(llm_tools_api.PatientCost):
         return common_include_symptoms - all_excluded_symptoms
 
 
-    def patient_response_gen(self, current_topic, dialogue_history):
+    def _api_request(self, current_topic, dialogue_history):   # create() arguments for the next turn; local models generate from its messages
+        if self.dialbegin:
+            self.patientbot_init()
+            self.dialbegin = False
+        if self.context_builder is not None:
+            history = self.context_builder.history(dialogue_history, current_topic)
+        else:
+            history = dialogue_history[-3:]
+        if self.cache_friendly_prompts:
+            return self._cache_friendly_request(current_topic, history)
         excluded_symptoms = self.find_unique_symptoms()
-        if self.use_api:
-            if self.dialbegin:
-                self.patientbot_init()
-                self.dialbegin = False
-            patient_template = {key:val for key, val in self.patient_template.items() if key != '处理意见'} 
-            self.experience = llm_tools_api.load_background_story(self.story_path)[0] #Set the patient to answer the experience whenever the doctor asks about it. Can be deleted
-            if self.experience is None:               
-                patient_prompt = "你是一名{}患者，正在和一位精神卫生中心临床心理科医生进行交流。你的回复要尽量简短精确。".format(self.patient_template['诊断结果'])+ self.PATIENT_PROMPT+"\n你的病例为“{}”，\n你和医生的对话历史为{}，你当前的回复需要围绕话题“{}”展开。注意：你没有除了{}之外的心理疾病的症状，被问到是否存在以下症状时你倾向于否定回答：{}。\n".format(patient_template, dialogue_history[-3:], current_topic, self.patient_template['诊断结果'], excluded_symptoms)
-                self.messages.append({"role": "user", "content": patient_prompt})
-                chat_response = self.client.chat.completions.create(
-                        model=self.model_name,
-                        messages=self.messages,
-                        top_p=0.85,
-                        frequency_penalty=0.8
-                    )
-                super().money_cost(chat_response.usage.prompt_tokens, chat_response.usage.completion_tokens)
-                patient_response = chat_response.choices[0].message.content
-                self.messages.pop()
-            else:
-                patient_prompt = "你是一名{}患者，正在和一位心理科医生进行交流。 \
-                    \n\n现在请根据下面要求生成对医生的回答:\n"+self.PATIENT_PROMPT_EXPERIENCE+"1.回复内容必须根据：\n  （1）病例：“{}“\n  （2）过去的创伤经历：“{}”\n  （3）对话历史：“{}”。你当前的回复需要围绕话题“{}”展开。注意：你没有除了{}之外的心理疾病的症状，被问到是否存在以下症状时你倾向于否定回答：{}。\n".format(self.patient_template['诊断结果'], patient_template, self.experience, dialogue_history[-3:], current_topic, self.patient_template['诊断结果'], excluded_symptoms)
-
-                self.messages.append({"role": "user", "content": patient_prompt})
-                chat_response = self.client.chat.completions.create(
-                        model=self.model_name,
-                        messages=self.messages,
-                        top_p=0.85,
-                        frequency_penalty=0.7
-                    )
-                super().money_cost(chat_response.usage.prompt_tokens, chat_response.usage.completion_tokens)
-                patient_response = chat_response.choices[0].message.content
-                self.messages.pop()
+        patient_template = {key:val for key, val in self.patient_template.items() if key != '处理意见'} 
+        self.experience = llm_tools_api.load_background_story(self.story_path)[0] #Set the patient to answer the experience whenever the doctor asks about it. Can be deleted
+        if self.experience is None:               
+            patient_prompt = "你是一名{}患者，正在和一位精神卫生中心临床心理科医生进行交流。你的回复要尽量简短精确。".format(self.patient_template['诊断结果'])+ self.PATIENT_PROMPT+"\n你的病例为“{}”，\n你和医生的对话历史为{}，你当前的回复需要围绕话题“{}”展开。注意：你没有除了{}之外的心理疾病的症状，被问到是否存在以下症状时你倾向于否定回答：{}。\n".format(patient_template, history, current_topic, self.patient_template['诊断结果'], excluded_symptoms)
+            frequency_penalty = 0.8
         else:
-            #TODO
-            if self.dialbegin:
-                self.patientbot_init()
-                self.dialbegin = False
-            text = self.patient_tokenizer.apply_chat_template(
-                self.messages,
-                tokenize=False,
-                add_generation_prompt=True
-            )
-            patient_model_inputs = self.patient_tokenizer([text], return_tensors="pt").to(self.patient_model.device)
-            generated_ids = self.patient_model.generate(
-                patient_model_inputs.input_ids,
-                max_new_tokens=2048
-            )
-            generated_ids = [
-                output_ids[len(input_ids):] for input_ids, output_ids in zip(patient_model_inputs.input_ids, generated_ids)
-            ]
-            patient_response = self.patient_tokenizer.batch_decode(generated_ids, skip_special_tokens=True)[0]
-            self.messages.append({"role": "assistant", "content": patient_response})
-        
+            patient_prompt = "你是一名{}患者，正在和一位心理科医生进行交流。 \
+                    \n\n现在请根据下面要求生成对医生的回答:\n"+self.PATIENT_PROMPT_EXPERIENCE+"1.回复内容必须根据：\n  （1）病例：“{}“\n  （2）过去的创伤经历：“{}”\n  （3）对话历史：“{}”。你当前的回复需要围绕话题“{}”展开。注意：你没有除了{}之外的心理疾病的症状，被问到是否存在以下症状时你倾向于否定回答：{}。\n".format(self.patient_template['诊断结果'], patient_template, self.experience, history, current_topic, self.patient_template['诊断结果'], excluded_symptoms)
+            frequency_penalty = 0.7
+        return dict(
+            model=self.model_name,
+            messages=self.messages + [{"role": "user", "content": patient_prompt}],
+            top_p=0.85,
+            frequency_penalty=frequency_penalty
+        )
+
+    def _cache_friendly_request(self, current_topic, history):
+        if self.static_prompt is None:   # EMR, background story and excluded symptoms are fixed for the dialogue
+            patient_template = {key:val for key, val in self.patient_template.items() if key != '处理意见'}
+            self.experience = llm_tools_api.load_background_story(self.story_path)[0]
+            style_rules = self.PATIENT_PROMPT if self.experience is None else self.PATIENT_PROMPT_EXPERIENCE
+            self.static_prompt = prompt_layout.patient_static_prompt(self.patient_template['诊断结果'], style_rules,
+                patient_template, self.experience, self.find_unique_symptoms())
+        return dict(
+            model=self.model_name,
+            messages=self.messages + [{"role": "user", "content": self.static_prompt + prompt_layout.patient_turn_prompt(history, current_topic)}],
+            top_p=0.85,
+            frequency_penalty=0.8 if self.experience is None else 0.7
+        )
+
+    def _api_response(self, chat_response):
+        usage = chat_response.usage
+        super().money_cost(usage.prompt_tokens, usage.completion_tokens, telemetry.cached_tokens(usage))
+        patient_response = chat_response.choices[0].message.content
+        return patient_response, super().get_cost()
+
+    def _local_response(self, request):
+        if local_models.batching_enabled():
+            patient_response = local_models.engine(self.model_path).generate(request["messages"], max_new_tokens=2048)
+        elif self.kv_session is not None:
+            patient_response = self.kv_session.generate(request["messages"], max_new_tokens=2048)
+        else:
+            patient_response = local_models.generate(self.patient_model, self.patient_tokenizer, request["messages"], max_new_tokens=2048)
         return patient_response, super().get_cost()
-    
\ No newline at end of file
+
+    def patient_response_gen(self, current_topic, dialogue_history):
+        request = self._api_request(current_topic, dialogue_history)
+        if not self.use_api:
+            return self._local_response(request)
+        chat_response = llm_tools_api.chat_completion(self.client, 'patient', **request)
+        return self._api_response(chat_response)
+
+    async def async_patient_response_gen(self, current_topic, dialogue_history):
+        if not self.use_api and not local_models.batching_enabled():
+            raise ValueError("异步生成仅支持API模式或开启批处理的本地模型")
+        request = self._api_request(current_topic, dialogue_history)
+        if not self.use_api:   # the batch engine steps every waiting dialogue together
+            patient_response = await local_models.engine(self.model_path).agenerate(request["messages"], max_new_tokens=2048)
+            return patient_response, super().get_cost()
+        if self.async_client is None:
+            self.async_client = llm_tools_api.async_client_init(self.model_name)
+        chat_response = await llm_tools_api.async_chat_completion(self.async_client, 'patient', **request)
+        return self._api_response(chat_response)
@@ -1,7 +1,10 @@
 import os
-import pandas as pd
+import argparse
+import asyncio
+import time
 import json
 import llm_tools_api
+import emr_store
 
 
 PATIENT_CASES_ORIGIN_PATH = './raw_data/patient_info.xlsx'
@@ -9,9 +12,14 @@ ORIGIN_JSON_PATH = './raw_data/cases_completed.json'
 CASES_JSON_PATH = './raw_data/cases_ready.json'
 PROMPT_PATH = './prompts'
 OUTPUT_PASTEXP_PATH = './prompts/patient/background_story'
-MODELNAME = 'gpt-4o-mini'  
+MODELNAME = 'gpt-4o-mini'
 PATIENT_COUNT = 1 # Number of electronic medical records to be used
 FicExp_COUNT = 1 # 1 EMR will be used to generate FicExp_COUNT fictitious experiences
+EMR_DB_PATH = None # emr_store database to select EMRs from instead of reading ORIGIN_JSON_PATH, e.g. './PsyCoData/emr.db'
+PATIENT_IDS = None # with EMR_DB_PATH: only these EMR ids, e.g. [15290, 14158]
+DIAGNOSES = None # with EMR_DB_PATH: only EMRs with all of these diagnoses, e.g. ['抑郁症', '焦虑症']
+CONCURRENCY = 16 # background stories generated in parallel; 1 generates them one by one with the synchronous client
+CHECKPOINT_SECONDS = 30 # while stories are generated, cases_ready.json is rewritten at most this often
 
 
 class PatientCases():
@@ -22,11 +30,20 @@ class PatientCases():
         self.prompt_path = prompt_path    # root path of prompt
         self.gender_mode = None
         self.age_mode = None
-    
-    def patient_json2json(self, patient_count, conversation_count):
-        with open(self.origin_json_path, 'r', encoding='utf-8') as f:
-            origin_patient_data = json.load(f)
-        patient_data = origin_patient_data[:patient_count]
+        with open(os.path.join(self.prompt_path, 'patient', 'patient_background.txt'), 'r', encoding='utf-8') as f:
+            self.background_prompt = f.readlines()[0]
+
+    def patient_json2json(self, patient_count, conversation_count, patient_data=None, concurrency=CONCURRENCY):
+        """Write the dialogue-ready cases and generate a background story per (EMR, experience combination).
+
+        Stories already on disk are kept, so an interrupted run picks up where it stopped. Up to `concurrency`
+        stories are generated at once; each is written as soon as it is done, and cases_ready.json is
+        checkpointed every CHECKPOINT_SECONDS with the cases whose stories are finished.
+        """
+        if patient_data is None:
+            with open(self.origin_json_path, 'r', encoding='utf-8') as f:
+                origin_patient_data = json.load(f)
+            patient_data = origin_patient_data[:patient_count]
         combine_list = []
         if conversation_count <=5:
             for i in range(conversation_count):
@@ -38,62 +55,91 @@ class PatientCases():
         else:
             return("conversation_count should be less than 50")
 
-        output_list = []
-        for case in patient_data:
-  
-            for [i,k] in combine_list:
-                output_dict = {}
- 
-                output_dict['患者'] = str(case['id']) + f'com{i}_{k}'
-                output_dict['年龄'] = case['年龄']
-                output_dict['性别'] = case['性别'] 
-                output_dict['职业'] = case['职业']
-                output_dict['婚姻状况'] = case['婚姻状况']
-                output_dict['教育背景'] = case['教育背景']
-                output_dict['诊断结果'] = case['初步诊断']
-                output_dict['主诉'] = case['主诉']
-                output_dict['病情状况'] = case['病情状况']
-                output_dict['既往史'] = case['既往史']
-                output_dict['家族史'] = case['家族史']
-                output_dict['个人史'] = case['个人史'][str(i)]
-
-                if self.use_api:                        
-
-                    if output_dict['个人史'] == None:
-                        print(f"警告1：病例 {output_dict['患者']} 的个人史内容为空，使用默认值")
-                    else:
-                        
-                        print(f"个人史：{output_dict['个人史']}")
-                story = self.gen_background_story(case, [i, k])
+        jobs = [(case, i, k) for case in patient_data for [i, k] in combine_list]
+        output_list = [self.case_record(case, i, k) for case, i, k in jobs]
+        asyncio.run(self._generate_stories(jobs, output_list, concurrency))
+        self.write_cases(output_list)
+
+    def case_record(self, case, i, k):
+        output_dict = {}
+
+        output_dict['患者'] = str(case['id']) + f'com{i}_{k}'
+        output_dict['年龄'] = case['年龄']
+        output_dict['性别'] = case['性别']
+        output_dict['职业'] = case['职业']
+        output_dict['婚姻状况'] = case['婚姻状况']
+        output_dict['教育背景'] = case['教育背景']
+        output_dict['诊断结果'] = case['初步诊断']
+        output_dict['主诉'] = case['主诉']
+        output_dict['病情状况'] = case['病情状况']
+        output_dict['既往史'] = case['既往史']
+        output_dict['家族史'] = case['家族史']
+        output_dict['个人史'] = case['个人史'][str(i)]
+        return output_dict
+
+    def write_cases(self, output_list):
+        tmp_path = self.cases_json_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(output_list, f, indent=2, ensure_ascii=False)
+        os.replace(tmp_path, self.cases_json_path)   # never leave a half-written cases_ready.json behind
+
+    async def _generate_stories(self, jobs, output_list, concurrency):
+        use_async = concurrency > 1
+        semaphore = asyncio.Semaphore(max(concurrency, 1))
+        story_paths = [os.path.join(OUTPUT_PASTEXP_PATH, f"patient_{case['id']}", f'story_com{i}_{k}.txt') for case, i, k in jobs]
+        stories = dict(zip(story_paths, jobs))   # more than 5 experiences repeat (i, k) pairs; generate each story once
+        finished = set()
+        last_checkpoint = time.monotonic()
+
+        async def generate(output_path):
+            nonlocal last_checkpoint
+            case, i, k = stories[output_path]
+            if not (os.path.exists(output_path) and os.path.getsize(output_path) > 0):
+                async with semaphore:
+                    if self.use_api:
+                        if case['个人史'][str(i)] == None:
+                            print(f"警告1：病例 {case['id']}com{i}_{k} 的个人史内容为空，使用默认值")
+                        else:
+                            print(f"个人史：{case['个人史'][str(i)]}")
+                    story = await self.gen_background_story(case, [i, k], use_async)
                 if story != '故事生成失败':
-                    output_path = os.path.join(
-                        OUTPUT_PASTEXP_PATH,
-                        f"patient_{case['id']}",
-                        f'story_com{i}_{k}.txt'
-                    )
                     os.makedirs(os.path.dirname(output_path), exist_ok=True)
-                    
-                    with open(output_path, 'w', encoding='utf-8') as f:
+                    with open(output_path + '.tmp', 'w', encoding='utf-8') as f:
                         f.write(story.replace("\n", ""))
-                output_list.append(output_dict)
-        with open (self.cases_json_path, 'w', encoding='utf-8') as f:
-            json.dump(output_list, f, indent=2, ensure_ascii=False)   
+                    os.replace(output_path + '.tmp', output_path)
+            finished.add(output_path)
+            if time.monotonic() - last_checkpoint > CHECKPOINT_SECONDS:
+                last_checkpoint = time.monotonic()
+                self.write_cases([record for record, path in zip(output_list, story_paths) if path in finished])
+
+        await asyncio.gather(*(generate(output_path) for output_path in stories))
 
-    def gen_background_story(self, patient, combine_list):
+    async def gen_background_story(self, patient, combine_list, use_async=False):
         [i,k] = combine_list
-        with open(os.path.join(self.prompt_path, 'patient', 'patient_background.txt'), 'r', encoding='utf-8') as f:
-            text_prompt = f.readlines()[0]
-        text_prompt = text_prompt.format(age=patient['年龄'],gender=patient['性别'],diagnosis=patient['初步诊断'],illness=patient['病情状况'],work=patient['职业'],personal_history=patient['个人史'][str(i)], experience=patient['经历'][str(k)])
-    
-        response = llm_tools_api.api_load_for_background_gen(MODELNAME, text_prompt)
+        text_prompt = self.background_prompt.format(age=patient['年龄'],gender=patient['性别'],diagnosis=patient['初步诊断'],illness=patient['病情状况'],work=patient['职业'],personal_history=patient['个人史'][str(i)], experience=patient['经历'][str(k)])
+
+        try:
+            if use_async:
+                response = await llm_tools_api.async_api_load_for_background_gen(MODELNAME, text_prompt)
+            else:
+                response = llm_tools_api.api_load_for_background_gen(MODELNAME, text_prompt)
+        except Exception as e:   # one failed story should not abort the other stories in flight
+            print(f"病例 {patient['id']} com{i}_{k} 的背景故事生成出错: {e!r}")
+            response = None
         if response is not None:
             return response
         else:
-            print(f"病例 {patient['患者']} 的背景故事生成失败")
+            print(f"病例 {patient['id']} 的背景故事生成失败")
             return '故事生成失败'
-                    
 
 
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build dialogue-ready cases and fictitious experience stories")
+    parser.add_argument('--concurrency', type=int, default=CONCURRENCY, help="background stories generated in parallel (1: sequential)")
+    args = parser.parse_args()
 
-patient = PatientCases(PROMPT_PATH, ORIGIN_JSON_PATH, CASES_JSON_PATH, use_api=True)
-patient.patient_json2json(PATIENT_COUNT, FicExp_COUNT)
+    patient = PatientCases(PROMPT_PATH, ORIGIN_JSON_PATH, CASES_JSON_PATH, use_api=True)
+    patient_data = None
+    if EMR_DB_PATH is not None:
+        patient_data = list(emr_store.EMRStore(EMR_DB_PATH).iter_profiles(ids=PATIENT_IDS, diagnoses=DIAGNOSES, limit=PATIENT_COUNT))
+    patient.patient_json2json(PATIENT_COUNT, FicExp_COUNT, patient_data, args.concurrency)
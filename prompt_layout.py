@@ -0,0 +1,27 @@
+# Providers with automatic prefix caching (OpenAI, DeepSeek, Qwen) only reuse the longest identical request prefix.
+# This layout puts everything fixed for a whole dialogue (persona, style rules, EMR, background story) first and
+# appends the per-turn history and topic last, instead of interleaving them as the default prompts do.
+
+DOCTOR_INSTRUCTION = "\n你回复患者的内容必须完全依据：\n1.对话历史\n2.当前话题。注意输出的问题要符合当前话题并结合上一轮患者的回答，换成口语化的表述方式{}，不能与对话历史的语言结构重复！！如果当前话题有关自杀或者自残，禁止输出冒犯性的提问。"
+PATIENT_EXCLUSION = "注意：你没有除了{}之外的心理疾病的症状，被问到是否存在以下症状时你倾向于否定回答：{}。\n"
+
+
+def doctor_static_prompt(doctor_persona, patient_persona, style_rules, empathy):
+    return doctor_persona + patient_persona + style_rules + DOCTOR_INSTRUCTION.format("加上共情策略" if empathy else "")
+
+
+def doctor_turn_prompt(history, topic_seq):   # history: the window to embed, e.g. dialogue_history[-6:]
+    return "\n你与患者的所有对话历史如下{}\n当前话题：{}".format(history, topic_seq)
+
+
+def patient_static_prompt(diagnosis, style_rules, patient_template, experience, excluded_symptoms):
+    exclusion = PATIENT_EXCLUSION.format(diagnosis, "、".join(sorted(excluded_symptoms)))   # sorted: set order changes between processes
+    if experience is None:
+        return "你是一名{}患者，正在和一位精神卫生中心临床心理科医生进行交流。你的回复要尽量简短精确。".format(diagnosis) + style_rules \
+            + "\n你的病例为“{}”。".format(patient_template) + exclusion
+    return "你是一名{}患者，正在和一位心理科医生进行交流。\n\n现在请根据下面要求生成对医生的回答:\n".format(diagnosis) + style_rules \
+        + "1.回复内容必须根据：\n  （1）病例：“{}“\n  （2）过去的创伤经历：“{}”\n  （3）对话历史。".format(patient_template, experience) + exclusion
+
+
+def patient_turn_prompt(history, current_topic):   # history: the window to embed, e.g. dialogue_history[-3:]
+    return "\n你和医生的对话历史为{}，你当前的回复需要围绕话题“{}”展开。".format(history, current_topic)
@@ -0,0 +1,181 @@
+import asyncio
+import contextvars
+import email.utils
+import random
+import threading
+import time
+from typing import Dict, Optional
+
+import openai
+
+MAX_RETRIES = 6
+BACKOFF_BASE = 1.0   # seconds; attempt n waits up to BACKOFF_BASE * 2**n (full jitter)
+BACKOFF_MAX = 60.0
+TOKENS_PER_CHAR = 0.8   # rough prompt-token estimate for mixed Chinese text, reconciled from usage afterwards
+DEFAULT_COMPLETION_TOKENS = 256
+
+STATS = {"calls": 0, "retries": 0, "throttled_seconds": 0.0}
+_stats_lock = threading.Lock()
+_limiters: Dict[str, "ProviderLimiter"] = {}
+_call_retries = contextvars.ContextVar("call_retries", default=0)
+
+
+class TokenBucket:
+    """Refills `per_minute` units per minute up to `capacity`; reservations may overdraw and return the wait needed"""
+
+    def __init__(self, per_minute: float, capacity: Optional[float] = None) -> None:
+        self.rate = per_minute / 60.0
+        self.capacity = capacity if capacity is not None else per_minute
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, amount: float) -> float:
+        with self.lock:
+            self._refill()
+            self.tokens -= amount
+            return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def refund(self, amount: float) -> None:
+        with self.lock:
+            self._refill()
+            self.tokens = min(self.capacity, self.tokens + amount)
+
+
+class ProviderLimiter:
+    """Requests-per-minute and tokens-per-minute budget of one provider"""
+
+    def __init__(self, rpm: Optional[float] = None, tpm: Optional[float] = None) -> None:
+        self.requests = TokenBucket(rpm) if rpm else None
+        self.tokens = TokenBucket(tpm) if tpm else None
+
+    def reserve(self, estimated_tokens: int) -> float:
+        delay = 0.0
+        if self.requests is not None:
+            delay = max(delay, self.requests.reserve(1))
+        if self.tokens is not None:
+            delay = max(delay, self.tokens.reserve(estimated_tokens))
+        return delay
+
+    def reconcile(self, estimated_tokens: int, actual_tokens: Optional[int]) -> None:
+        if self.tokens is None or actual_tokens is None:
+            return
+        self.tokens.refund(estimated_tokens - actual_tokens)
+
+    def release(self, estimated_tokens: int) -> None:
+        """Give back the token budget of a failed request; it still counts against RPM, as the provider saw it"""
+        if self.tokens is not None:
+            self.tokens.refund(estimated_tokens)
+
+
+def configure_rate_limit(provider: str, rpm: Optional[float] = None, tpm: Optional[float] = None) -> None:
+    _limiters[provider] = ProviderLimiter(rpm, tpm)
+
+
+def estimate_tokens(request: Dict) -> int:
+    chars = sum(len(message.get("content") or "") for message in request.get("messages", []))
+    completion = request.get("max_tokens") or request.get("max_completion_tokens") or DEFAULT_COMPLETION_TOKENS
+    return int(chars * TOKENS_PER_CHAR) + completion
+
+
+def _usage_tokens(response) -> Optional[int]:
+    usage = getattr(response, "usage", None)
+    return getattr(usage, "total_tokens", None) if usage is not None else None
+
+
+def is_retryable(error: Exception) -> bool:
+    if isinstance(error, (openai.RateLimitError, openai.APIConnectionError, openai.InternalServerError)):
+        return True
+    return isinstance(error, openai.APIStatusError) and (error.status_code == 429 or error.status_code >= 500)
+
+
+def retry_delay(attempt: int, error: Exception) -> float:
+    """Retry-After(-ms) from the provider if present, else jittered exponential backoff"""
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None) or {}
+    if headers.get("retry-after-ms"):
+        try:
+            return float(headers["retry-after-ms"]) / 1000
+        except ValueError:
+            pass
+    if headers.get("retry-after"):
+        value = headers["retry-after"]
+        try:
+            return float(value)
+        except ValueError:
+            try:
+                parsed = email.utils.parsedate_to_datetime(value)
+            except (TypeError, ValueError):   # neither seconds nor an HTTP date: fall back to backoff
+                parsed = None
+            if parsed is not None:
+                return max(0.0, parsed.timestamp() - time.time())
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+
+
+def _count(key: str, value=1) -> None:
+    with _stats_lock:
+        STATS[key] += value
+
+
+def last_call_retries() -> int:
+    """Retries of the last call made in this thread / asyncio task"""
+    return _call_retries.get()
+
+
+def call_with_retry(provider: str, request: Dict, create):
+    limiter = _limiters.get(provider)
+    estimate = estimate_tokens(request)
+    _call_retries.set(0)
+    for attempt in range(MAX_RETRIES + 1):
+        if limiter is not None:
+            delay = limiter.reserve(estimate)
+            if delay > 0:
+                _count("throttled_seconds", delay)
+                time.sleep(delay)
+        _count("calls")
+        try:
+            response = create()
+        except Exception as e:
+            if limiter is not None:
+                limiter.release(estimate)
+            if attempt == MAX_RETRIES or not is_retryable(e):
+                raise
+            _count("retries")
+            _call_retries.set(attempt + 1)
+            time.sleep(retry_delay(attempt, e))
+            continue
+        if limiter is not None:
+            limiter.reconcile(estimate, _usage_tokens(response))
+        return response
+
+
+async def async_call_with_retry(provider: str, request: Dict, create):
+    limiter = _limiters.get(provider)
+    estimate = estimate_tokens(request)
+    _call_retries.set(0)
+    for attempt in range(MAX_RETRIES + 1):
+        if limiter is not None:
+            delay = limiter.reserve(estimate)
+            if delay > 0:
+                _count("throttled_seconds", delay)
+                await asyncio.sleep(delay)
+        _count("calls")
+        try:
+            response = await create()
+        except Exception as e:
+            if limiter is not None:
+                limiter.release(estimate)
+            if attempt == MAX_RETRIES or not is_retryable(e):
+                raise
+            _count("retries")
+            _call_retries.set(attempt + 1)
+            await asyncio.sleep(retry_delay(attempt, e))
+            continue
+        if limiter is not None:
+            limiter.reconcile(estimate, _usage_tokens(response))
+        return response
@@ -0,0 +1,202 @@
+import json
+import os
+import sys
+from collections import deque
+from functools import lru_cache
+from types import MappingProxyType
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+INGROUP_RULES_FILE = "ingroup_rules.json"
+CROSSGROUP_RULES_FILE = "crossgroup_rules.json"
+SUBGROUP_RULES_FILE = "subgroup_rules.json"
+DIAGNOSIS_LIST_FILE = "diagnosis_list.json"
+TOPIC_ORDER_FILE = "topic_order_dict.json"   # entry (group, state) of every topic, used for the reachability check
+
+
+class Edge(NamedTuple):
+    target: int   # node id
+    time: str
+
+
+class Subgroup(NamedTuple):
+    name: str
+    states: Tuple[str, ...]   # screening questions, asked in shuffled order
+    threshold: int   # number of "yes" answers that takes the subgroup's Y transition
+    first_time: str
+    other_times: Tuple[str, ...]
+
+
+class RuleGraph:
+    """HDSM rules compiled into an immutable, integer-indexed transition table.
+
+    Every (group, state) pair named anywhere in the rule files is a node. edges[node] is (N edge, Y edge),
+    so `edges[node][is_yes]` is the normal transition; cross[node] is the cross-group jump checked before it;
+    subgroup[node] is the index into subgroups when entering the node starts a screening subgroup.
+    followups[node] holds the per-question follow-up rules of subgroup screening questions.
+    """
+
+    def __init__(self, nodes, edges, cross, subgroup, subgroups, followups, terminals, warnings) -> None:
+        self.nodes: Tuple[Tuple[str, str], ...] = tuple(nodes)
+        self.index = MappingProxyType({node: i for i, node in enumerate(self.nodes)})
+        self.edges: Tuple[Tuple[Optional[Edge], Optional[Edge]], ...] = tuple(edges)
+        self.cross: Tuple[Optional[Edge], ...] = tuple(cross)
+        self.subgroup: Tuple[Optional[int], ...] = tuple(subgroup)
+        self.subgroups: Tuple[Subgroup, ...] = tuple(subgroups)
+        self.subgroup_index = MappingProxyType({s.name: i for i, s in enumerate(self.subgroups)})
+        self.followups: Tuple[Tuple[Optional[Edge], Optional[Edge]], ...] = tuple(followups)
+        self.terminals = frozenset(terminals)
+        self.warnings: Tuple[str, ...] = tuple(warnings)
+
+    def node(self, group: str, state: str) -> int:
+        try:
+            return self.index[(group, state)]
+        except KeyError:
+            raise ValueError(f"状态 {group}.{state} 未在规则中定义") from None
+
+    def name(self, node: int) -> Tuple[str, str]:
+        return self.nodes[node]
+
+
+def _read_json(folder: str, filename: str, required: bool = True):
+    path = os.path.join(folder, filename)
+    if not os.path.exists(path):
+        if required:
+            raise FileNotFoundError(f"规则文件 {path} 不存在")
+        return None
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def compile_rules(folder: str) -> RuleGraph:
+    """Parse and validate the rule files of `folder`; raises ValueError on a target that cannot be resolved"""
+    group_rules: Dict[str, Dict] = _read_json(folder, INGROUP_RULES_FILE)
+    cross_rules_raw: Dict[str, List] = _read_json(folder, CROSSGROUP_RULES_FILE)
+    subgroup_rules: Dict[str, Dict] = _read_json(folder, SUBGROUP_RULES_FILE)
+    diagnoses = set(_read_json(folder, DIAGNOSIS_LIST_FILE, required=False) or [])
+    entries = _read_json(folder, TOPIC_ORDER_FILE, required=False)
+
+    nodes: List[Tuple[str, str]] = []
+    index: Dict[Tuple[str, str], int] = {}
+    errors: List[str] = []
+    warnings: List[str] = []
+
+    def add_node(group, state):
+        if (group, state) not in index:
+            index[(group, state)] = len(nodes)
+            nodes.append((group, state))
+        return index[(group, state)]
+
+    members = {state for rule in subgroup_rules.values() for state in rule["states"]}
+    owners: Dict[str, List[str]] = {}
+    for group, rules in group_rules.items():
+        for state in rules:
+            add_node(group, state)
+            owners.setdefault(state, []).append(group)
+
+    def resolve(group, state, target, time):
+        if target in group_rules[group] or target in diagnoses:
+            return Edge(add_node(group, target), time)
+        other = [g for g in owners.get(target, []) if g != group]
+        if len(other) == 1:   # e.g. A.1 A00 -N-> A96, which is only defined in A.15
+            warnings.append(f"{group}.{state} -> {target} 在组 {other[0]} 中解析")
+            return Edge(add_node(other[0], target), time)
+        if other:
+            errors.append(f"{group}.{state} -> {target} 在多个组中定义: {other}")
+        else:
+            errors.append(f"{group}.{state} -> {target} 未定义")
+        return None
+
+    edges: Dict[int, Tuple[Optional[Edge], Optional[Edge]]] = {}
+    followups: Dict[int, Tuple[Optional[Edge], Optional[Edge]]] = {}
+    for group, rules in group_rules.items():
+        for state, rule in rules.items():
+            node = index[(group, state)]
+            if state in members:   # follow-up question of a screening question, e.g. A9 -Y-> A9Y
+                followups[node] = tuple(Edge(add_node(group, rule[key][0]), rule[key][1]) if rule.get(key) else None
+                                        for key in ("N", "Y"))
+                continue
+            edges[node] = tuple(resolve(group, state, *rule[key]) if rule.get(key) else None for key in ("N", "Y"))
+
+    cross: Dict[int, Edge] = {}
+    for key, (target_group, target_state, target_time) in cross_rules_raw.items():
+        group, state = key.split(':')
+        if (group, state) not in index:
+            errors.append(f"跨组规则 {key} 的起点未定义")
+            continue
+        if target_group not in group_rules:
+            errors.append(f"跨组规则 {key}: 目标组 {target_group} 未在规则中定义")
+            continue
+        if target_state not in group_rules[target_group]:
+            errors.append(f"跨组规则 {key}: 目标状态 {target_state} 未在组 {target_group} 中定义")
+            continue
+        cross[index[(group, state)]] = Edge(index[(target_group, target_state)], target_time)
+
+    subgroups: List[Subgroup] = []
+    subgroup_of: Dict[int, int] = {}
+    for name, rule in subgroup_rules.items():
+        if name not in owners:
+            errors.append(f"子状态组 {name} 没有完成后的转移规则")
+            continue
+        if len(rule["states"]) > 1 and not rule["other_times"]:
+            errors.append(f"子状态组 {name} 缺少时间选项")
+        if not 0 < rule["threshold"] <= len(rule["states"]):
+            errors.append(f"子状态组 {name} 的阈值 {rule['threshold']} 超出范围")
+        for group in owners[name]:
+            owner = index[(group, name)]
+            subgroup_of[owner] = len(subgroups)
+            if owner in cross:   # finalizing a subgroup takes its normal transition directly
+                warnings.append(f"跨组规则 {group}:{name} 不会被触发（{name} 是子状态组）")
+        subgroups.append(Subgroup(name, tuple(rule["states"]), rule["threshold"], rule["first_time"], tuple(rule["other_times"])))
+
+    if errors:
+        raise ValueError(f"状态机规则 {folder} 校验失败:\n" + "\n".join(errors))
+
+    terminals = {i for i, (group, state) in enumerate(nodes) if state in diagnoses}
+    if entries:
+        reached = set()
+        queue = deque(index[tuple(entry)] for entry in entries.values() if tuple(entry) in index)
+        while queue:
+            node = queue.popleft()
+            if node in reached:
+                continue
+            reached.add(node)
+            if node in cross and node not in subgroup_of:   # cross rules fire before (and instead of) normal transitions
+                queue.append(cross[node].target)
+                continue
+            queue.extend(edge.target for edge in edges.get(node, ()) if edge is not None)
+        for group, rules in group_rules.items():
+            for state in rules:
+                if state not in members and index[(group, state)] not in reached:
+                    warnings.append(f"状态 {group}.{state} 不可达")
+        for diagnosis in sorted(diagnoses):
+            if not any(nodes[node][1] == diagnosis for node in reached):
+                warnings.append(f"诊断 {diagnosis} 不可达")
+
+    return RuleGraph(
+        nodes,
+        [edges.get(i, (None, None)) for i in range(len(nodes))],
+        [cross.get(i) for i in range(len(nodes))],
+        [subgroup_of.get(i) for i in range(len(nodes))],
+        subgroups,
+        [followups.get(i, (None, None)) for i in range(len(nodes))],
+        terminals,
+        warnings,
+    )
+
+
+@lru_cache(maxsize=None)
+def _load_rule_graph(folder: str) -> RuleGraph:
+    return compile_rules(folder)
+
+
+def load_rule_graph(folder: str) -> RuleGraph:
+    """Compiled rules of `folder`, compiled once per process and shared by every state machine"""
+    return _load_rule_graph(os.path.abspath(folder))
+
+
+if __name__ == "__main__":
+    graph = compile_rules(sys.argv[1] if len(sys.argv) > 1 else "prompts/diagstatemachine")
+    print(f"{len(graph.nodes)} 个状态，{sum(e is not None for pair in graph.edges for e in pair)} 条转移，"
+          f"{sum(c is not None for c in graph.cross)} 条跨组规则，{len(graph.subgroups)} 个子状态组")
+    for warning in graph.warnings:
+        print("警告:", warning)
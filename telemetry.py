@@ -0,0 +1,195 @@
+import contextvars
+import json
+import os
+import threading
+import time
+from typing import Dict, Optional
+
+import rate_limit
+
+# USD per 1M tokens: (input, cached input, output). Models are matched by the longest prefix, so dated
+# snapshots such as gpt-4o-mini-2024-07-18 use their family's price; override with load_prices().
+PRICES = {
+    "gpt-4o-mini": (0.15, 0.075, 0.60),
+    "gpt-4o": (2.50, 1.25, 10.00),
+    "gpt-4.1-mini": (0.40, 0.10, 1.60),
+    "gpt-4.1": (2.00, 0.50, 8.00),
+    "deepseek-chat": (0.27, 0.07, 1.10),
+    "deepseek-reasoner": (0.55, 0.14, 2.19),
+}
+HOT_SPOTS = 5   # states listed per ranking in the run summary
+
+_current_dialogue = contextvars.ContextVar("current_dialogue", default=None)
+
+
+class DialogueUsage:
+    """Spend of one dialogue and the HDSM state it is currently serving"""
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.state: Optional[str] = None
+        self.calls = 0
+        self.cost = 0.0
+
+
+def start_dialogue(name: str):
+    return _current_dialogue.set(DialogueUsage(name))
+
+
+def end_dialogue(token) -> None:
+    _current_dialogue.reset(token)
+
+
+def current_dialogue() -> Optional[DialogueUsage]:
+    """Usage of the dialogue running in this thread / asyncio task, if any"""
+    return _current_dialogue.get()
+
+
+def set_state(state: str) -> None:
+    """Label the following calls of the current dialogue with the HDSM state (or dialogue phase) they serve"""
+    usage = _current_dialogue.get()
+    if usage is not None:
+        usage.state = state
+
+
+def load_prices(path: str) -> None:
+    """Merge a JSON price table {model: {"input": .., "cached_input": .., "output": ..}} (USD per 1M tokens)"""
+    with open(path, 'r', encoding='utf-8') as f:
+        table = json.load(f)
+    for model, price in table.items():
+        PRICES[model] = (price["input"], price.get("cached_input", price["input"]), price["output"])
+
+
+def price_of(model: str):
+    matches = [name for name in PRICES if model == name or model.startswith(name + "-")]
+    return PRICES[max(matches, key=len)] if matches else None
+
+
+def cached_tokens(usage) -> int:
+    details = getattr(usage, "prompt_tokens_details", None)
+    if details is not None and details.cached_tokens is not None:
+        return details.cached_tokens
+    return getattr(usage, "prompt_cache_hit_tokens", None) or 0   # DeepSeek reports it outside prompt_tokens_details
+
+
+def call_cost(model: str, prompt_tokens: int, completion_tokens: int, cached: int = 0) -> float:
+    """USD cost of one call; 0 for models missing from PRICES"""
+    price = price_of(model)
+    if price is None:
+        return 0.0
+    input_price, cached_price, output_price = price
+    return ((prompt_tokens - cached) * input_price + cached * cached_price + completion_tokens * output_price) / 1000000
+
+
+def _percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round((len(values) - 1) * q)))] if values else 0.0
+
+
+class Telemetry:
+    """Per-call telemetry of every chat completion (an llm_tools_api.CALL_OBSERVERS callback).
+
+    Each call is priced, added to the running dialogue's DialogueUsage and aggregated per role, model and
+    HDSM state; with a sink, it is also appended as one JSON line. Only live calls count towards the run's
+    spend: cache hits cost nothing and journal replays were paid for by an earlier run (they still count
+    towards their dialogue's cost, as before).
+    """
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.sink = None
+        self.roles: Dict[str, Dict] = {}
+        self.states: Dict[str, Dict] = {}
+        self.unpriced = set()
+        self.started = time.time()
+
+    def open_sink(self, path: str) -> None:
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with self.lock:
+            if self.sink is not None:
+                self.sink.close()
+            self.sink = open(path, 'a', encoding='utf-8')
+
+    def close(self) -> None:
+        with self.lock:
+            if self.sink is not None:
+                self.sink.close()
+                self.sink = None
+
+    def on_call(self, role, request, response, seconds, source) -> None:
+        model = request.get("model", "")
+        usage = response.usage
+        prompt = usage.prompt_tokens if usage is not None else 0
+        completion = usage.completion_tokens if usage is not None else 0
+        cached = cached_tokens(usage) if usage is not None else 0
+        cost = call_cost(model, prompt, completion, cached)
+        retries = rate_limit.last_call_retries() if source == "live" else 0
+        dialogue = _current_dialogue.get()
+        state = dialogue.state if dialogue is not None else None
+        if dialogue is not None and source != "cache":
+            dialogue.calls += 1
+            dialogue.cost += cost
+        live = source == "live"
+
+        with self.lock:
+            if price_of(model) is None:
+                self.unpriced.add(model)
+            for table, key in ((self.roles, role), (self.states, state or "-")):
+                stats = table.setdefault(key, {"calls": 0, "live_calls": 0, "prompt_tokens": 0, "cached_tokens": 0,
+                                               "completion_tokens": 0, "cost": 0.0, "seconds": 0.0, "retries": 0, "latencies": []})
+                stats["calls"] += 1
+                stats["seconds"] += seconds
+                stats["latencies"].append(seconds)
+                if live:
+                    stats["live_calls"] += 1
+                    stats["prompt_tokens"] += prompt
+                    stats["cached_tokens"] += cached
+                    stats["completion_tokens"] += completion
+                    stats["cost"] += cost
+                    stats["retries"] += retries
+            if self.sink is not None:
+                self.sink.write(json.dumps({
+                    "ts": time.time(), "dialogue": dialogue.name if dialogue is not None else None, "role": role,
+                    "model": model, "source": source, "state": state, "prompt_tokens": prompt, "cached_tokens": cached,
+                    "completion_tokens": completion, "latency": round(seconds, 4), "retries": retries, "cost": cost,
+                }, ensure_ascii=False) + "\n")
+                self.sink.flush()
+
+    def summary(self) -> Dict:
+        """Run totals, per-role breakdown and the states that took the most time and money"""
+        with self.lock:
+            def brief(stats):
+                return dict({key: value for key, value in stats.items() if key != "latencies"},
+                            p50=_percentile(stats["latencies"], 0.5), p95=_percentile(stats["latencies"], 0.95))
+
+            roles = {role: brief(stats) for role, stats in self.roles.items()}
+            states = {state: brief(stats) for state, stats in self.states.items()}
+            unpriced = sorted(self.unpriced)
+        totals = {key: sum(stats[key] for stats in roles.values())
+                  for key in ("calls", "live_calls", "prompt_tokens", "cached_tokens", "completion_tokens", "cost", "seconds", "retries")}
+        totals["wall_seconds"] = time.time() - self.started
+        return {
+            "totals": totals,
+            "roles": roles,
+            "slowest_states": sorted(states.items(), key=lambda item: item[1]["seconds"], reverse=True)[:HOT_SPOTS],
+            "costliest_states": sorted(states.items(), key=lambda item: item[1]["cost"], reverse=True)[:HOT_SPOTS],
+            "unpriced_models": unpriced,
+        }
+
+    def format_summary(self) -> str:
+        summary = self.summary()
+        totals = summary["totals"]
+        lines = [f"调用 {totals['calls']} 次（实际请求 {totals['live_calls']} 次，重试 {totals['retries']} 次），"
+                 f"输入 {totals['prompt_tokens']} tokens（缓存 {totals['cached_tokens']}），输出 {totals['completion_tokens']} tokens，"
+                 f"费用 ${totals['cost']:.4f}，模型耗时 {totals['seconds']:.1f}s"]
+        for role, stats in sorted(summary["roles"].items(), key=lambda item: item[1]["seconds"], reverse=True):
+            lines.append(f"  {role:<14} {stats['calls']:>7} 次  ${stats['cost']:.4f}  {stats['seconds']:.1f}s  "
+                         f"p50 {stats['p50'] * 1000:.0f}ms  p95 {stats['p95'] * 1000:.0f}ms")
+        lines.append("  耗时最多的状态: " + "，".join(f"{state} {stats['seconds']:.1f}s" for state, stats in summary["slowest_states"]))
+        lines.append("  费用最高的状态: " + "，".join(f"{state} ${stats['cost']:.4f}" for state, stats in summary["costliest_states"]))
+        if summary["unpriced_models"]:
+            lines.append(f"  未配置价格的模型（按 0 计费）: {summary['unpriced_models']}")
+        return "\n".join(lines)
+
+
+TELEMETRY = Telemetry()